@@ -1,7 +1,8 @@
 import argparse
 import csv
 import itertools
-import pandas as pd
+import json
+import os
 # For each workflow, generate two dataframe with parameters (params, params_unique)
 # params list all parameter combinations used for SLiM simulation
 # params_unique iterate through all but random seeds. This is used for analytical step and to average across replicate simulations. 
@@ -40,76 +41,133 @@ column_order = ['seed', 'RUNTIME', 'BURNIN', 'LOGINTERVAL', 'N_POP', 'RECOVERY',
         'CTmin_default', 'B_critical', 'DeltaB', 'CTmin_critical', 'DeltaCTmin', 
         'CTmax_critical', 'DeltaCTmax', 'OUTDIR', 'OUTNAME']
 
+# Replicate simulations share all parameters but the random seed (and the OUTNAME, which includes the seed)
+group_columns = [column for column in column_order if column not in ['seed', 'OUTNAME']]
+
+
+def replicate_index(params):
+    '''
+    Group the rows of params (as in *_params.csv) by their parameter combination, in a single pass over params.
+    Returns a dict from each combination (tuple of the values of the group_columns in params) to the row positions of its replicates.
+    '''
+    columns = [column for column in group_columns if column in params.columns]
+    return params.groupby(columns, sort=False, dropna=False).indices
+
+
+def replicates_of(params_unique, params, index=None):
+    '''
+    List of the replicates (rows of params, as a DataFrame) of each row of params_unique, in the order of params_unique.
+    Replicates are looked up in index (replicate_index(params), built here if not given), so the cost grows linearly with
+    the number of rows instead of comparing every row of params with every row of params_unique.
+    '''
+    if index is None:
+        index = replicate_index(params)
+    columns = [column for column in group_columns if column in params.columns]
+    if len(columns) == 1:
+        keys = params_unique[columns[0]]
+    else:
+        keys = params_unique[columns].itertuples(index=False, name=None)
+    return [params.iloc[index.get(key, [])].reset_index(drop=True) for key in keys]
+
+
+# Each task is described by a spec file, specs/(task).json, with these fields:
+# - params, params_unique: names of the csv files written
+# - constants: parameters changed from params_default, but kept constant across all simulations
+# - scan: parameters to scan, each with a list of values; every combination is simulated (the last parameter changes fastest)
+# - rules (optional): list of {"when": {parameter: value or list of values}, "set": {parameter: value}} applied in order to
+#   each combination, e.g. to give some combinations a longer RUNTIME
+# - seeds: number of random seeds (0, 1, ...) or list of seeds for the replicates of each combination,
+#   or null for a single simulation with the default seed
+# - outname: OUTNAME of each combination, formatted with its parameters, e.g. "gaussian_MEAN_TEMP_{MEAN_TEMP}".
+#   Replicates add "_seed_(seed)" to it, unless seeds is null.
+SPEC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'specs')
+
+
+def load_spec(task):
+    '''
+    spec of a task: the name of a file in specs/ (without .json) or the path of a spec file
+    '''
+    path = task if task.endswith('.json') else os.path.join(SPEC_DIR, task + '.json')
+    with open(path) as f:
+        return json.load(f)
+
+
+def _matches(row, when):
+    return all(row[key] in (value if isinstance(value, list) else [value]) for key, value in when.items())
+
+
+def iter_combinations(spec):
+    '''
+    Generate the parameters of each combination of the scanned parameters (one row of params_unique, as a dictionary in column_order
+    without seed), one at a time.
+    '''
+    scan = spec['scan']
+    for values in itertools.product(*scan.values()):
+        row = dict(params_default, **spec.get('constants', {}))
+        row.update(zip(scan.keys(), values))
+        for rule in spec.get('rules', []):
+            if _matches(row, rule['when']):
+                row.update(rule['set'])
+        row['OUTNAME'] = spec['outname'].format(**row)
+        yield {column: row[column] for column in column_order if column != 'seed'}
+
+
+def iter_replicates(spec, combination):
+    '''
+    Generate the rows of params (dictionaries in column_order) of the replicates of one combination from iter_combinations
+    '''
+    seeds = spec.get('seeds')
+    if seeds is None:
+        yield dict(combination, seed=params_default['seed'])
+        return
+    for seed in (range(seeds) if isinstance(seeds, int) else seeds):
+        yield dict(combination, seed=seed, OUTNAME=f"{combination['OUTNAME']}_seed_{seed}")
+
+
+def iter_params(spec):
+    '''
+    Generate all rows of params (dictionaries in column_order), one at a time
+    '''
+    for combination in iter_combinations(spec):
+        yield from iter_replicates(spec, combination)
+
+
+def generate(spec, directory='.'):
+    '''
+    Write the params and params_unique csv files of a spec in directory, row by row (without holding all rows in memory).
+    Rows of params_unique that are identical to a previous one are skipped, as with drop_duplicates.
+    Returns the number of rows written to params and params_unique.
+    '''
+    num_rows = num_unique_rows = 0
+    seen = set()
+    with open(os.path.join(directory, spec['params']), 'w', newline='') as params_file, \
+         open(os.path.join(directory, spec['params_unique']), 'w', newline='') as params_unique_file:
+        # Columns in the same order as the slurm script in next step (params_unique without seed)
+        params_writer = csv.DictWriter(params_file, fieldnames=column_order, lineterminator='\n')
+        params_unique_writer = csv.DictWriter(params_unique_file, fieldnames=column_order[1:], lineterminator='\n')
+        params_writer.writeheader()
+        params_unique_writer.writeheader()
+        for combination in iter_combinations(spec):
+            for row in iter_replicates(spec, combination):
+                params_writer.writerow(row)
+                num_rows += 1
+            key = tuple(combination.values())
+            if key not in seen:
+                seen.add(key)
+                params_unique_writer.writerow(combination)
+                num_unique_rows += 1
+    return num_rows, num_unique_rows
+
 
 def gaussian():
     '''
     Assume temperature is Gaussian-distributed.
     Use 3 different mean temperatures, 3 different standard deviations, and repeat for 30 different random seeds.
     Simulation data from this pipeline were used to examine generalist-specialist tradeoff in Min et al. manuscript.
+    (see specs/gaussian.json)
     '''
-    param_filename = 'gaussian_params.csv'
-    param_unique_filename = 'gaussian_params_unique.csv'
-
-    # List of params to scan
-    MEAN_TEMP_list = [5, 20, 35]
-    STDEV_TEMP_list = [1, 3, 10]
-    seed_list = range(30)
-    # OUTNAME will reflect the change of these parameters
-
-    # List of parameters to change from default values, but keep constant across all simulations
-    RUNTIME = 20_000 # except runtime is edited for one of the mean & stdev combination (see if statement later)
-    BURNIN = 5000
-    B_default = 31
-    CTmin_default = 5
-    GEN_LEN_DEPENDS_ON_TEMP = 'F'
-    USE_EXTERNAL_TEMP_DATA = 'F'
-    OUTDIR = "/projects/lotterhos/TPC_evol_SLiM"
- 
-    # Other params will use values from params_default
+    return generate(load_spec('gaussian'))
 
-    
-    # Loop through all combinations of parameters to scan (in this case, MEAN_TEMP, STDEV_TEMP, seed)
-    # For each combination, create a new parameter dictionary, add it to the parameter list
-    params_list = []
-    for i, (mean_temp, stdev_temp, seed) in enumerate(itertools.product(MEAN_TEMP_list, STDEV_TEMP_list, seed_list)):
-        if (mean_temp == 35) & (stdev_temp == 3):
-            # needs extra runtime to equilibrate
-            runtime = 40_000
-        else:
-            runtime = RUNTIME
-
-        new_row = {
-                'seed': seed,
-                'RUNTIME': runtime,
-                'BURNIN': BURNIN,
-                'GEN_LEN_DEPENDS_ON_TEMP': GEN_LEN_DEPENDS_ON_TEMP,
-                'USE_EXTERNAL_TEMP_DATA': USE_EXTERNAL_TEMP_DATA,
-                'MEAN_TEMP': mean_temp,
-                'STDEV_TEMP': stdev_temp,
-                'B_default': B_default,
-                'CTmin_default': CTmin_default,
-                'OUTDIR': OUTDIR,
-                'OUTNAME': f"gaussian_MEAN_TEMP_{mean_temp}_STDEV_TEMP_{stdev_temp}_seed_{seed}"
-                }
-        for key in params_default.keys():
-            if key not in new_row.keys():
-                new_row[key] = params_default[key]
-        params_list.append(new_row)
-
-    # Save the parameter list
-    params = pd.DataFrame(params_list)
-    # Re-order columns (matches the order in slurm script in next step)
-    params = params[column_order]
-    # Save as csv file
-    params.to_csv(param_filename, index=False)
-
-    # Drop seed and outname columns
-    params_unique = params.drop(columns=['seed', 'OUTNAME']).drop_duplicates().reset_index(drop=True)
-    # Add OUTNAME again without seed
-    params_unique['OUTNAME'] = "gaussian_MEAN_TEMP_" + params_unique['MEAN_TEMP'].astype(str) + "_STDEV_TEMP_" + params_unique['STDEV_TEMP'].astype(str)
-    # Save as csv file
-    params_unique.to_csv(param_unique_filename, index=False)
-    
 
 def sine():
     '''
@@ -117,80 +175,18 @@ def sine():
     Additionally individuals experience random fluctuation with stdev = 1
     Generate 4 rows choosing whether generation is temperature dependent or not,
     and whether to use recovery or no-recovery model
+    (see specs/sine.json)
     '''
-    param_filename = 'sine_params.csv'
-    param_unique_filename = 'sine_params_unique.csv'
-
-    # List of params to scan
-    RECOVERY_list = ['T', 'F']
-    GEN_LEN_DEPENDS_ON_TEMP_list = ['T', 'F']
-    # OUTNAME will reflect the change of these parameters
-
-    # List of parameters to change from default values, but keep constant across all simulations
-    RUNTIME = 20_000
-    NUM_REP_TEMP_DATA = 200
-    # runtime will be shorter than the length of repeated temperature data, so simulation will end at
-    # generation = 20_000
-    BURNIN = 5000
-    STDEV_TEMP = 1
-    B_default = 31
-    CTmin_default = 5
-    N_POP = 50_000 # using bigger population to see tracking more clearly
-    TEMPDATA_PATH = "./sine.csv"
-    OUTDIR = "/projects/lotterhos/TPC_evol_SLiM"
- 
-    # Other params will use values from params_default
-
-    # Loop through all combinations of parameters to scan
-    # For each combination, create a new parameter dictionary, add it to the parameter list
-    params_list = []
-    for i, (recovery, gen_len_depends_on_temp) in enumerate(itertools.product(RECOVERY_list, GEN_LEN_DEPENDS_ON_TEMP_list)):
-        new_row = {
-                'RUNTIME': RUNTIME,
-                'NUM_REP_TEMP_DATA': NUM_REP_TEMP_DATA,
-                'BURNIN': BURNIN,
-                'STDEV_TEMP': STDEV_TEMP,
-                'B_default': B_default,
-                'CTmin_default': CTmin_default,
-                'N_POP': N_POP,
-                'TEMPDATA_PATH': TEMPDATA_PATH,
-                'OUTDIR': OUTDIR,
-                'RECOVERY': recovery,
-                'GEN_LEN_DEPENDS_ON_TEMP': gen_len_depends_on_temp,
-                'OUTNAME': f"sine_RECOVERY_{recovery}_GEN_LEN_DEPENDS_ON_TEMP_{gen_len_depends_on_temp}"
-                }
-        for key in params_default.keys():
-            if key not in new_row.keys():
-                new_row[key] = params_default[key]
-        params_list.append(new_row)
-
-    # Save the parameter list
-    params = pd.DataFrame(params_list)
-    # Re-order columns (matches the order in slurm script in next step)
-    params = params[column_order]
-    # Save as csv file
-    params.to_csv(param_filename, index=False)
-
-    # Drop seed and outname columns
-    params_unique = params.drop(columns=['seed', 'OUTNAME']).drop_duplicates().reset_index(drop=True)
-    # Add OUTNAME again without seed
-    params_unique['OUTNAME'] = "sine_RECOVERY_" + \
-        params_unique['RECOVERY'].astype(str) + \
-            "_GEN_LEN_DEPENDS_ON_TEMP_" + \
-                params_unique['GEN_LEN_DEPENDS_ON_TEMP'].astype(str)
-    # Save as csv file
-    params_unique.to_csv(param_unique_filename, index=False)    
+    return generate(load_spec('sine'))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Prepare simulation parameters')
     parser.add_argument('--task', type=str, required=True,
-                       choices=['gaussian', 'sine'],
-                       help='Type of simulation task')
+                       help='Type of simulation task: gaussian, sine, or any other spec in specs/ (or the path of a spec file)')
+    parser.add_argument('--outdir', type=str, default='.',
+                       help='Directory where the csv files are written')
     
     args = parser.parse_args()
-    if args.task == 'gaussian':
-        print("making parameter files for gaussian task.")
-        gaussian()
-    elif args.task == 'sine':
-        print("making parameter files for sine task.")
-        sine()
+    print(f"making parameter files for {args.task} task.")
+    num_rows, num_unique_rows = generate(load_spec(args.task), args.outdir)
+    print(f"{num_rows} simulations, {num_unique_rows} unique parameter sets")
@@ -0,0 +1,119 @@
+# Check that a SLiM run interrupted twice resumes from its checkpoint both times (CHECKPOINT_INTERVAL of master_WF.slim).
+# The run is killed as soon as it has written a new checkpoint, restarted, killed again after the next checkpoint, and restarted
+# to the end. The final log must have a single header and every generation from BURNIN once, in order, and the checkpoint must be removed.
+# Exits with 1 otherwise.
+# Usage:
+#   python check_resume.py
+#   python check_resume.py --n-pop 5000 --runtime 80 --keep ./resume_check
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import tskit
+from wf_surrogate import SLIM_DIR
+from schedule import slim_command
+
+parser = argparse.ArgumentParser(description='Check that master_WF.slim resumes from its checkpoint after two interruptions')
+parser.add_argument('--runtime', type=int, default=60, help='RUNTIME of the run')
+parser.add_argument('--burnin', type=int, default=10, help='BURNIN of the run')
+parser.add_argument('--n-pop', type=int, default=2000, help='N_POP of the run (large enough for a generation to take a moment)')
+parser.add_argument('--checkpoint-interval', type=int, default=5, help='CHECKPOINT_INTERVAL of the run')
+parser.add_argument('--keep', type=str, default=None, help='directory to keep the outputs in (default: a temporary directory)')
+parser.add_argument('--slim', type=str, default='slim', help='SLiM executable')
+parser.add_argument('--slim-dir', type=str, default=SLIM_DIR, help='directory with master_WF.slim (SLiM runs from there)')
+
+
+def complete_checkpoint(path, after):
+    '''modification time of the checkpoint at path if it is newer than after and can be read, otherwise None'''
+    if not os.path.exists(path) or os.path.getmtime(path) <= after:
+        return None
+    try:
+        tskit.load(path)
+    except Exception:
+        return None
+    return os.path.getmtime(path)
+
+
+def run(command, slim_dir, out, checkpoint, log, interrupt_after=None):
+    '''
+    run SLiM to the end, or with interrupt_after (a modification time), kill it once it has written a newer checkpoint
+    after it started logging (from BURNIN).
+    Returns the modification time of that checkpoint, or None if the run finished.
+    '''
+    process = subprocess.Popen(command, cwd=slim_dir, stdout=out, stderr=subprocess.STDOUT)
+    if interrupt_after is None:
+        if process.wait() != 0:
+            sys.exit(f"SLiM failed with exit code {process.returncode}, see {out.name}")
+        return None
+    while process.poll() is None:
+        logging = os.path.exists(log) and os.path.getsize(log) > 0
+        if logging and os.path.exists(checkpoint) and os.path.getmtime(checkpoint) > interrupt_after:
+            # stop SLiM before checking the checkpoint, so that it is not being written while it is read
+            process.send_signal(signal.SIGSTOP)
+            mtime = complete_checkpoint(checkpoint, interrupt_after)
+            if mtime is not None:
+                process.kill()
+                process.wait()
+                return mtime
+            process.send_signal(signal.SIGCONT)
+        time.sleep(0.01)
+    if process.returncode != 0:
+        sys.exit(f"SLiM failed with exit code {process.returncode}, see {out.name}")
+    sys.exit(f"SLiM finished before writing a new checkpoint, see {out.name} "
+             "(increase --n-pop or --runtime)")
+
+
+def check_log(path, burnin):
+    '''problems with the log of the finished run (an empty list if there are none)'''
+    with open(path) as f:
+        lines = f.read().splitlines()
+    problems = []
+    headers = [line for line in lines if line == lines[0]]
+    if len(headers) > 1:
+        problems.append(f"{len(headers)} header lines")
+    cycles = [int(line.split(',')[0]) for line in lines[1:] if line != lines[0]]
+    if cycles != list(range(burnin, burnin + len(cycles))):
+        problems.append(f"generations are not logged once each from {burnin}: {cycles}")
+    return problems
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        outdir = os.path.abspath(tmp if args.keep is None else args.keep)
+        os.makedirs(outdir, exist_ok=True)
+        params_row = {'seed': 1, 'RUNTIME': args.runtime, 'BURNIN': args.burnin, 'LOGINTERVAL': 1, 'N_POP': args.n_pop,
+                      'RECOVERY': 'F', 'GEN_LEN_DEPENDS_ON_TEMP': 'F', 'FIXED_GEN_LEN': 10, 'USE_EXTERNAL_TEMP_DATA': 'F',
+                      'TEMPDATA_PATH': './VT_weather.txt', 'MEAN_TEMP': 20, 'STDEV_TEMP': 5, 'NUM_REP_TEMP_DATA': 1,
+                      'B_default': 30, 'CTmin_default': 0, 'B_critical': 40, 'DeltaB': 2, 'CTmin_critical': 0,
+                      'DeltaCTmin': 2, 'CTmax_critical': 40, 'DeltaCTmax': 0.2, 'OUTDIR': outdir, 'OUTNAME': 'resume'}
+        command = slim_command(params_row, args.slim, args.checkpoint_interval)
+        checkpoint = os.path.join(outdir, 'resume_checkpoint.trees')
+        log = os.path.join(outdir, 'resume.txt')
+        problems = []
+        mtime = 0
+        for attempt in range(3):
+            with open(os.path.join(outdir, f"resume_slim_{attempt}.out"), 'w') as out:
+                # the first two runs are interrupted after their first new checkpoint, the last one runs to the end
+                mtime = run(command, args.slim_dir, out, checkpoint, log, mtime if attempt < 2 else None)
+            with open(out.name) as f:
+                resumed = 'resumed from checkpoint' in f.read()
+            if resumed != (attempt > 0):
+                problems.append(f"run {attempt} {'resumed' if resumed else 'did not resume'} from the checkpoint")
+            with open(log) as f:
+                lines = f.read().splitlines()
+            print(f"run {attempt}: {'finished' if mtime is None else 'interrupted'}, "
+                  f"log has {len(lines)} lines ({lines.count(lines[0])} headers)")
+        if os.path.exists(checkpoint):
+            problems.append("the checkpoint was not removed")
+        if not os.path.exists(os.path.join(outdir, 'resume.trees')):
+            problems.append("no tree sequence was saved")
+        problems += check_log(log, args.burnin)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)
+    print("the run resumed twice and its log has every generation once")
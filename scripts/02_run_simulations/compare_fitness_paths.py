@@ -0,0 +1,80 @@
+# Check that the vectorized fitness of master_WF.slim (VECTORIZED_FITNESS=T) gives the same simulation as the fitnessEffect() callback.
+# For each seed, a short run is made with both, with RECOVERY=T and RECOVERY=F. Both draw the same random numbers in the same order,
+# so with the same seed their logs should agree up to rounding. Exits with 1 if a log column differs by more than --tol.
+# No result of this check has been recorded yet, which is why VECTORIZED_FITNESS is off by default in master_WF.slim.
+# This needs a single-threaded SLiM build: multithreaded builds draw large vectors of random numbers in parallel, in a different order.
+# Usage:
+#   python compare_fitness_paths.py
+#   python compare_fitness_paths.py --seeds 1,2,3 --n-pop 500 --runtime 60 --keep ./fitness_paths
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from wf_surrogate import SLIM_DIR
+from schedule import slim_command
+
+parser = argparse.ArgumentParser(description='Compare the callback and vectorized fitness of master_WF.slim with the same seed')
+parser.add_argument('--seeds', type=str, default='1', help='comma separated seeds, each run with both fitness paths')
+parser.add_argument('--runtime', type=int, default=30, help='RUNTIME of the runs')
+parser.add_argument('--burnin', type=int, default=10, help='BURNIN of the runs')
+parser.add_argument('--n-pop', type=int, default=200, help='N_POP of the runs')
+parser.add_argument('--mean-temp', type=float, default=20,
+                    help='MEAN_TEMP (constant temperature): with the default TPC (CTmin 0, B 30) Topt is 20 and CTmax 30')
+parser.add_argument('--stdev-temp', type=float, default=5,
+                    help='STDEV_TEMP, large enough for some days to exceed CTmax, so that the no-recovery model differs from the recovery model')
+parser.add_argument('--tol', type=float, default=1e-9, help='largest difference allowed, relative to 1 + |value|')
+parser.add_argument('--keep', type=str, default=None, help='directory to keep the logs in (default: a temporary directory)')
+parser.add_argument('--slim', type=str, default='slim', help='SLiM executable')
+parser.add_argument('--slim-dir', type=str, default=SLIM_DIR, help='directory with master_WF.slim (SLiM runs from there)')
+
+
+def run(outdir, outname, seed, recovery, vectorized, args):
+    '''run master_WF.slim with one of the fitness paths and return its log'''
+    params_row = {'seed': seed, 'RUNTIME': args.runtime, 'BURNIN': args.burnin, 'LOGINTERVAL': 1, 'N_POP': args.n_pop,
+                  'RECOVERY': recovery, 'GEN_LEN_DEPENDS_ON_TEMP': 'F', 'FIXED_GEN_LEN': 10, 'USE_EXTERNAL_TEMP_DATA': 'F',
+                  'TEMPDATA_PATH': './VT_weather.txt', 'MEAN_TEMP': args.mean_temp, 'STDEV_TEMP': args.stdev_temp,
+                  'NUM_REP_TEMP_DATA': 1, 'B_default': 30, 'CTmin_default': 0, 'B_critical': 40, 'DeltaB': 2,
+                  'CTmin_critical': 0, 'DeltaCTmin': 2, 'CTmax_critical': 40, 'DeltaCTmax': 0.2,
+                  'OUTDIR': os.path.abspath(outdir), 'OUTNAME': outname}
+    command = slim_command(params_row, args.slim)
+    command = command[:-1] + ['-d', f"VECTORIZED_FITNESS={vectorized}", command[-1]]
+    with open(os.path.join(outdir, outname + '_slim.out'), 'w') as out:
+        exit_code = subprocess.run(command, cwd=args.slim_dir, stdout=out, stderr=subprocess.STDOUT).returncode
+    if exit_code != 0:
+        sys.exit(f"{' '.join(command)} failed with exit code {exit_code}, see {outdir}/{outname}_slim.out")
+    return pd.read_csv(os.path.join(outdir, outname + '.txt'))
+
+
+def compare(callback, vectorized):
+    '''largest difference of each log column relative to 1 + |value| (inf if the logs do not have the same cycles)'''
+    if list(callback['cycle']) != list(vectorized['cycle']):
+        return pd.Series(np.inf, index=callback.columns)
+    return ((callback - vectorized).abs() / (1 + callback.abs())).max()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    seeds = [int(seed) for seed in args.seeds.split(',')]
+    with tempfile.TemporaryDirectory() as tmp:
+        outdir = tmp if args.keep is None else args.keep
+        os.makedirs(outdir, exist_ok=True)
+        rows = []
+        for recovery in ['T', 'F']:
+            for seed in seeds:
+                name = f"recovery{recovery}_seed{seed}"
+                logs = {vectorized: run(outdir, f"{name}_vectorized{vectorized}", seed, recovery, vectorized, args)
+                        for vectorized in ['F', 'T']}
+                differences = compare(logs['F'], logs['T'])
+                rows.append({'RECOVERY': recovery, 'seed': seed, 'cycles': len(logs['F']),
+                             'fitness_mean': logs['F']['fitness_mean'].iloc[-1],
+                             'largest_difference': differences.max(), 'column': differences.idxmax()})
+    table = pd.DataFrame(rows)
+    print(table.to_string(index=False))
+    failed = table['largest_difference'] > args.tol
+    if failed.any():
+        print(f"{failed.sum()} of {len(table)} comparisons differ by more than {args.tol}")
+        sys.exit(1)
+    print(f"callback and vectorized logs agree within {args.tol} in all {len(table)} comparisons")
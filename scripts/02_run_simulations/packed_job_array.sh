@@ -0,0 +1,32 @@
+#!/bin/bash
+#SBATCH --job-name=TPC_evol_sim_packed
+#SBATCH --output=/scratch/j.min/slurm_out/job_%A_%a.out
+#SBATCH --error=/scratch/j.min/slurm_err/job_%A_%a.err
+#SBATCH --array=1-20
+#SBATCH --time=0-12:00:00
+#SBATCH --mem=4G
+#SBATCH --partition=lotterhos
+#SBATCH --cpus-per-task=1
+
+# Each array task runs one group of rows packed by cost, written by
+# python schedule.py <CSV_FILE> pack --tasks 20   (or --hours 10 to fit the --time limit)
+# Set --array to the number of groups printed by pack.
+
+module load anaconda3
+eval "$(conda shell.bash hook)"
+conda activate tpc_evo_slim
+
+# Path to csv parameter file - edit based on user name
+CSV_FILE="/home/j.min/TPC_evolution_SLiM/scripts/01_prepare_input_parameters/gaussian_params.csv"
+PACKS_FILE="${CSV_FILE%.csv}_packs.json"
+
+# Path to the scheduler and to the slim folder
+SCHEDULE="/home/j.min/TPC_evolution_SLiM/scripts/02_run_simulations/schedule.py"
+SLIM_PATH="/home/j.min/TPC_evolution_SLiM/slim"
+CHECKPOINT_INTERVAL=1000
+
+# runs the rows of the group one after another, recording each in the run manifest
+python "$SCHEDULE" "$CSV_FILE" run-pack "$PACKS_FILE" "$SLURM_ARRAY_TASK_ID" \
+  --slim-dir "$SLIM_PATH" --checkpoint-interval ${CHECKPOINT_INTERVAL}
+
+echo "group ${SLURM_ARRAY_TASK_ID} finished"
@@ -0,0 +1,193 @@
+# Cost-aware scheduling of the SLiM simulations of a params csv, as an alternative to one fixed-size array task per row.
+# The cost of a run is estimated as seconds_per_unit x RUNTIME x N_POP x (expected generation length in days),
+# where seconds_per_unit is fitted to the wall times of the runs already completed (recorded in the run manifest, see run_manifest.py).
+# Usage:
+#   python schedule.py CSV estimate                   estimated wall time of every row that is not complete
+#   python schedule.py CSV run --workers 8            run them locally, up to 8 SLiM processes at once, longest first
+#   python schedule.py CSV pack --tasks 20            pack them into 20 groups of similar total cost (written to CSV_packs.json)
+#   python schedule.py CSV run-pack PACKS TASK_ID     run the rows of one group one after another (see packed_job_array.sh)
+import argparse
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from wf_surrogate import gen_len, read_params, SLIM_DIR
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import run_manifest
+
+# prior for the wall time (in seconds) per unit of RUNTIME x N_POP x generation length, used until runs have completed
+DEFAULT_SECONDS_PER_UNIT = 1e-6
+# parameters of master_WF.slim set from the params csv, in the order of the slurm scripts
+slim_params = ['seed', 'RUNTIME', 'BURNIN', 'LOGINTERVAL', 'N_POP', 'RECOVERY', 'GEN_LEN_DEPENDS_ON_TEMP', 'FIXED_GEN_LEN',
+               'USE_EXTERNAL_TEMP_DATA', 'TEMPDATA_PATH', 'MEAN_TEMP', 'STDEV_TEMP', 'NUM_REP_TEMP_DATA', 'B_default',
+               'CTmin_default', 'B_critical', 'DeltaB', 'CTmin_critical', 'DeltaCTmin', 'CTmax_critical', 'DeltaCTmax',
+               'OUTDIR', 'OUTNAME']
+# parameters that are strings in SLiM (quoted on the command line)
+string_params = ['TEMPDATA_PATH', 'OUTDIR', 'OUTNAME']
+
+parser = argparse.ArgumentParser(description='Cost-aware scheduling of SLiM simulations')
+parser.add_argument('csv', help='params csv, e.g. ../01_prepare_input_parameters/gaussian_params.csv')
+parser.add_argument('command', choices=['estimate', 'run', 'pack', 'run-pack'])
+parser.add_argument('packs', nargs='?', help='packs file written by pack (run-pack)')
+parser.add_argument('task_id', type=int, nargs='?', help='group to run, numbered from 1 as SLURM_ARRAY_TASK_ID (run-pack)')
+parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of simulations run at once (run)')
+parser.add_argument('--tasks', type=int, default=None, help='number of groups (pack)')
+parser.add_argument('--hours', type=float, default=None,
+                    help='with pack, use as many groups as needed to keep each one under this many estimated hours')
+parser.add_argument('--slim', type=str, default='slim', help='SLiM executable')
+parser.add_argument('--slim-dir', type=str, default=SLIM_DIR, help='directory with master_WF.slim (SLiM runs from there)')
+parser.add_argument('--checkpoint-interval', type=int, default=1000,
+                    help='CHECKPOINT_INTERVAL of master_WF.slim, so that interrupted runs resume (0 disables checkpoints)')
+parser.add_argument('--dry-run', action='store_true', help='print the SLiM commands instead of running them (run, run-pack)')
+
+
+def expected_gen_len(params, slim_dir=SLIM_DIR, _temperature_data={}):
+    '''
+    expected generation length in days of a run (params from wf_surrogate.read_params): FIXED_GEN_LEN, gen_len(MEAN_TEMP),
+    or the average of gen_len over the days of the external temperature data
+    '''
+    if not params['GEN_LEN_DEPENDS_ON_TEMP']:
+        return float(params['FIXED_GEN_LEN'])
+    if not params['USE_EXTERNAL_TEMP_DATA']:
+        return float(gen_len(float(params['MEAN_TEMP'])))
+    path = os.path.join(slim_dir, params['TEMPDATA_PATH'])
+    if path not in _temperature_data:
+        _temperature_data[path] = np.mean([gen_len(temp) for temp in pd.read_csv(path)['T2M'].values])
+    return _temperature_data[path]
+
+
+def cost_units(params, slim_dir=SLIM_DIR):
+    '''work of a run in units of RUNTIME x N_POP x generation length (individual-days simulated)'''
+    return float(params['RUNTIME']) * float(params['N_POP']) * expected_gen_len(params, slim_dir)
+
+
+def fit_seconds_per_unit(params_df, slim_dir=SLIM_DIR):
+    '''
+    seconds per cost unit fitted (least squares through the origin) to the wall times of the completed runs of params_df
+    recorded in the run manifest, or DEFAULT_SECONDS_PER_UNIT if none has completed yet.
+    Returns (seconds_per_unit, number of runs used).
+    '''
+    units, seconds = [], []
+    for _, row in params_df.iterrows():
+        record = run_manifest.read_record(row['OUTDIR'], row['OUTNAME'])
+        if record is not None and record.get('status') == 'complete' and record.get('wall_time'):
+            units.append(cost_units(read_params(row), slim_dir))
+            seconds.append(record['wall_time'])
+    if not units:
+        return DEFAULT_SECONDS_PER_UNIT, 0
+    units, seconds = np.array(units), np.array(seconds)
+    return float(units @ seconds / (units @ units)), len(units)
+
+
+def estimate(params_df, slim_dir=SLIM_DIR):
+    '''
+    table of the rows of params_df (numbered from 1) that are not complete, with their estimated wall time in seconds,
+    longest first
+    '''
+    seconds_per_unit, n_fitted = fit_seconds_per_unit(params_df, slim_dir)
+    rows = []
+    for row, (_, params_row) in enumerate(params_df.iterrows(), start=1):
+        status = run_manifest.status(params_row['OUTDIR'], params_row['OUTNAME'])
+        if status == 'complete':
+            continue
+        rows.append({'row': row, 'OUTNAME': params_row['OUTNAME'], 'status': status,
+                     'seconds': seconds_per_unit * cost_units(read_params(params_row), slim_dir)})
+    print(f"cost model: {seconds_per_unit:.3g} s per unit of RUNTIME x N_POP x generation length "
+          f"({'fitted to ' + str(n_fitted) + ' completed runs' if n_fitted else 'default, no completed runs yet'})")
+    table = pd.DataFrame(rows, columns=['row', 'OUTNAME', 'status', 'seconds'])
+    return table.sort_values('seconds', ascending=False, kind='stable').reset_index(drop=True)
+
+
+def pack(table, tasks=None, hours=None):
+    '''
+    split the rows of an estimate table into groups of similar total cost: each row, longest first,
+    goes to the group with the smallest total so far. With hours, use the smallest number of groups
+    (at least tasks, if given) for which no group is estimated to take longer than hours.
+    Returns a list of groups, each a list of rows.
+    '''
+    if hours is not None:
+        tasks = max(tasks or 1, int(np.ceil(table['seconds'].sum() / (hours * 3600))))
+    tasks = max(1, min(tasks or 1, len(table)))
+    while True:
+        groups = [[] for _ in range(tasks)]
+        totals = np.zeros(tasks)
+        for row, seconds in zip(table['row'], table['seconds']):
+            i = int(np.argmin(totals))
+            groups[i].append(int(row))
+            totals[i] += seconds
+        if hours is None or totals.max() <= hours * 3600 or tasks >= len(table):
+            return groups, totals
+        tasks += 1
+
+
+def slim_command(params_row, slim='slim', checkpoint_interval=0):
+    '''command line running master_WF.slim for a row of a params csv (as in the slurm scripts)'''
+    command = [slim]
+    for param in slim_params:
+        value = params_row[param]
+        command += ['-d', f"{param}='{value}'" if param in string_params else f"{param}={value}"]
+    command += ['-d', f"CHECKPOINT_INTERVAL={checkpoint_interval}", 'master_WF.slim']
+    return command
+
+
+def run_row(row, params_row, slim='slim', slim_dir=SLIM_DIR, checkpoint_interval=0, dry_run=False):
+    '''
+    run the simulation of one row (numbered from 1) unless it is already complete, recording it in the run manifest.
+    SLiM's output goes to OUTDIR/OUTNAME_slim.out. Returns the exit code of SLiM.
+    '''
+    OUTDIR, OUTNAME = params_row['OUTDIR'], params_row['OUTNAME']
+    if run_manifest.status(OUTDIR, OUTNAME) == 'complete':
+        print(f"row {row} {OUTNAME}: already complete, skipping")
+        return 0
+    command = slim_command(params_row, slim, checkpoint_interval)
+    if dry_run:
+        print(' '.join(command))
+        return 0
+    os.makedirs(OUTDIR, exist_ok=True)
+    run_manifest.start(row, OUTDIR, OUTNAME)
+    with open(f"{OUTDIR}/{OUTNAME}_slim.out", 'w') as out:
+        exit_code = subprocess.run(command, cwd=slim_dir, stdout=out, stderr=subprocess.STDOUT).returncode
+    record = run_manifest.finish(row, OUTDIR, OUTNAME, exit_code)
+    print(f"row {row} {OUTNAME}: {record['status']} in {record['wall_time']:.0f} s")
+    return exit_code
+
+
+def run_rows(params_df, rows, workers=1, **options):
+    '''run the simulations of rows (in this order) with up to workers running at once; returns their exit codes'''
+    if workers <= 1:
+        return [run_row(row, params_df.iloc[row - 1], **options) for row in rows]
+    # each worker thread waits for its own SLiM process
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda row: run_row(row, params_df.iloc[row - 1], **options), rows))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    params_df = pd.read_csv(args.csv)
+    options = {'slim': args.slim, 'slim_dir': args.slim_dir, 'checkpoint_interval': args.checkpoint_interval,
+               'dry_run': args.dry_run}
+    if args.command == 'run-pack':
+        if args.packs is None or args.task_id is None:
+            parser.error("run-pack needs a packs file and a task id")
+        with open(args.packs) as f:
+            groups = json.load(f)['groups']
+        run_rows(params_df, groups[args.task_id - 1], **options)
+        sys.exit(0)
+
+    table = estimate(params_df, args.slim_dir)
+    if args.command == 'estimate':
+        print(table.to_string(index=False))
+        print(f"{len(table)} runs, {table['seconds'].sum() / 3600:.1f} hours in total")
+    elif args.command == 'run':
+        # longest first, so that the last runs to finish are short ones
+        run_rows(params_df, list(table['row']), args.workers, **options)
+    elif args.command == 'pack':
+        groups, totals = pack(table, args.tasks, args.hours)
+        packs_file = os.path.splitext(args.csv)[0] + '_packs.json'
+        with open(packs_file, 'w') as f:
+            json.dump({'csv': os.path.abspath(args.csv), 'groups': groups, 'estimated_seconds': list(totals)}, f, indent=1)
+        print(f"{len(groups)} groups, longest estimated at {totals.max() / 3600:.1f} hours, saved in {packs_file}")
+        print(f"submit with: sbatch --array=1-{len(groups)} packed_job_array.sh")
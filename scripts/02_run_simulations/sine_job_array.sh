@@ -15,6 +15,19 @@ conda activate tpc_evo_slim
 # Path to csv parameter file - edit based on user name
 CSV_FILE="/home/j.min/TPC_evolution_SLiM/scripts/01_prepare_input_parameters/sine_params.csv"
 
+# Path to the run manifest script (records status, wall time and output checksums of each row)
+MANIFEST="/home/j.min/TPC_evolution_SLiM/scripts/run_manifest.py"
+# Save a checkpoint every CHECKPOINT_INTERVAL generations, so a preempted task resumes from it when resubmitted (0 disables checkpoints)
+CHECKPOINT_INTERVAL=1000
+
+# Skip rows that already completed. Resubmit only the missing work with
+# sbatch --array=$(python run_manifest.py pending <CSV_FILE>) <this script>
+if python "$MANIFEST" done "$CSV_FILE" "$SLURM_ARRAY_TASK_ID"; then
+  echo "row ${SLURM_ARRAY_TASK_ID} already complete, skipping"
+  exit 0
+fi
+python "$MANIFEST" start "$CSV_FILE" "$SLURM_ARRAY_TASK_ID"
+
 # skip header
 LINE_NUM=$((SLURM_ARRAY_TASK_ID + 1))
 PARAMS=$(sed -n "${LINE_NUM}p" "$CSV_FILE")
@@ -58,6 +71,9 @@ slim -d seed=${seed} -d RUNTIME=${RUNTIME} -d BURNIN=${BURNIN} \
  -d CTmin_critical=${CTmin_critical} -d DeltaCTmin=${DeltaCTmin}\
   -d CTmax_critical=${CTmax_critical} -d DeltaCTmax=${DeltaCTmax}\
    -d OUTDIR=\'${OUTDIR}\' -d OUTNAME=\'${OUTNAME}\' \
+   -d CHECKPOINT_INTERVAL=${CHECKPOINT_INTERVAL} \
    master_WF.slim
+SLIM_EXIT_CODE=$?
+python "$MANIFEST" finish "$CSV_FILE" "$SLURM_ARRAY_TASK_ID" "$SLIM_EXIT_CODE"
 
 echo "slim simulation finished. output name = ${OUTNAME}"
@@ -0,0 +1,207 @@
+# Fast Wright-Fisher surrogate of slim/master_WF.slim for screening parameter sets before running SLiM.
+# The population is stored as NumPy arrays: for each trait (B, CTmin), individual, genome and linkage group, the sum of the effects of its QTNs.
+# Each run writes OUTDIR/OUTNAME.txt with the same columns as the SLiM log, and OUTDIR/OUTNAME_surrogate.npz with the final B and CTmin.
+# Usage: python wf_surrogate.py ../01_prepare_input_parameters/gaussian_params.csv --workers 8 --outdir ../../data/screen
+#
+# Parents are drawn independently as in SLiM's WF model, so an individual is its own mate with probability about 1 / N (incidental selfing).
+# Differences from SLiM: recombination within a linkage group (1e-8 per bp, i.e. 5e-5 per group and generation) is ignored,
+# and neutral mutations are not simulated (they are not in the SLiM simulation either, see tree_sequences.py).
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# Genetic architecture of master_WF.slim (see its initialize() block)
+QTN_MEAN = (0, 0)
+QTN_VAR = (0.05, 0.05)
+ENV_VAR = 0.5
+MU = 1e-7
+QTN_REGION_LENGTH = 60_000
+NUM_LINKAGE_GROUPS = 12
+
+# columns of the SLiM log file (see the BURNIN early() event of master_WF.slim)
+log_columns = ['cycle', 'day', 'Temp', 'B_mean', 'B_sd', 'CTmin_mean', 'CTmin_sd', 'CTmax_mean', 'CTmax_sd',
+               'Topt_mean', 'Topt_sd', 'B_CTmin_cov', 'fitness_mean', 'fitness_sd']
+
+SLIM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'slim')
+
+parser = argparse.ArgumentParser(description='Screen parameter sets with a NumPy surrogate of master_WF.slim')
+parser.add_argument('csv', help='params csv, e.g. ../01_prepare_input_parameters/gaussian_params.csv')
+parser.add_argument('--rows', type=str, default=None,
+                    help='rows of the csv to simulate (0 is the first row after the header), e.g. 0-29 or 0,30,60. Default: all')
+parser.add_argument('--workers', type=int, default=1, help='number of simulations run at once')
+parser.add_argument('--outdir', type=str, default=None, help='write all outputs here instead of the OUTDIR column of the csv')
+parser.add_argument('--slim-dir', type=str, default=SLIM_DIR,
+                    help='directory relative to which TEMPDATA_PATH is read (SLiM runs from the slim folder)')
+
+
+def read_params(row):
+    '''
+    dictionary of the parameters of master_WF.slim from a row of a params csv (T and F become booleans)
+    '''
+    params = dict(row)
+    for key, value in params.items():
+        if isinstance(value, str) and value in ('T', 'F'):
+            params[key] = value == 'T'
+    return params
+
+
+def gen_len(current_temp):
+    '''generation length (in days) for the temperature of the first day of the generation, as gen_len in master_WF.slim'''
+    if current_temp > 40:
+        return 14
+    if current_temp < 0:
+        return 30
+    # Eidos round() rounds halves away from zero
+    return int(np.floor(30 - 0.4 * current_temp + 0.5))
+
+
+def w_enzymatic(temp, CTmin, B):
+    '''enzymatic component of fitness, as w_enzymatic in master_WF.slim'''
+    Topt = CTmin + 2 / 3 * B
+    CTmax = CTmin + B
+    u = (3 * temp - 3 * CTmin - 2 * B) / B
+    return (temp <= Topt) * np.exp(-u**2) + (temp <= CTmax) * (temp > Topt) * (1 - u**2)
+
+
+def population_fitness(daily_temps, CTmin, B, recovery, params, rng):
+    '''
+    fitness of every individual (B and CTmin have one entry per individual) for given daily temperatures at population level,
+    as fitness_function (or population_fitness) in master_WF.slim, with the daily temperatures in an N x GEN_LEN array
+    '''
+    CTmax = CTmin + B
+    w_B = 1 / (1 + np.exp((B - params['B_critical']) / params['DeltaB']))
+    w_CTmin = 1 / (1 + np.exp((-CTmin + params['CTmin_critical']) / params['DeltaCTmin']))
+    w_CTmax = 1 / (1 + np.exp((CTmax - params['CTmax_critical']) / params['DeltaCTmax']))
+    # Individuals deviate from global daily temperature slightly due to random noise set by STDEV_TEMP
+    temps = daily_temps[None, :] + rng.normal(0, params['STDEV_TEMP'], (len(B), len(daily_temps)))
+    w_enzymatic_conditional = w_enzymatic(temps, CTmin[:, None], B[:, None])
+    if not recovery:
+        # zero after the first day of overheating (temperature > CTmax) of the same generation
+        overheated = temps > CTmax[:, None]
+        alive = (np.cumsum(overheated, axis=1) - overheated) == 0
+        w_enzymatic_conditional = alive * w_enzymatic_conditional
+    return w_CTmin * w_B * w_CTmax * w_enzymatic_conditional.mean(axis=1)
+
+
+def reproduce(genomes, fitness, rng):
+    '''
+    Wright-Fisher generation: draw two parents per offspring independently with probability proportional to fitness
+    (the same one twice with probability sum of p_i^2, about 1 / N: SLiM allows such incidental selfing by default),
+    one gamete from each (free recombination between linkage groups), and add new QTN mutations to the gametes.
+    genomes has shape (2 traits (B, CTmin), N, 2 genomes, NUM_LINKAGE_GROUPS).
+    '''
+    N = genomes.shape[1]
+    if not fitness.sum() > 0:
+        raise ValueError("total fitness of the population is zero")
+    # sampling proportional to fitness by inverting its cumulative sum
+    cumulative = np.cumsum(fitness)
+    parents = np.searchsorted(cumulative, rng.random((N, 2)) * cumulative[-1], side='right')
+    # for each gamete and linkage group, which of the parent's two genomes it comes from
+    which = rng.random((N, 2, NUM_LINKAGE_GROUPS)) < 0.5
+    source = (parents[:, :, None] * 2 + which) * NUM_LINKAGE_GROUPS + np.arange(NUM_LINKAGE_GROUPS)
+    offspring = np.take(genomes.reshape(2, -1), source.ravel(), axis=1).reshape(genomes.shape)
+    # new mutations (uniformly placed in the QTN region, each a QTN for B or CTmin with 50-50 chance)
+    num_mutations = rng.poisson(2 * N * MU * QTN_REGION_LENGTH)
+    if num_mutations:
+        individual = rng.integers(0, N, num_mutations)
+        genome = rng.integers(0, 2, num_mutations)
+        group = rng.integers(0, NUM_LINKAGE_GROUPS, num_mutations)
+        trait = rng.integers(0, 2, num_mutations)
+        effect = rng.normal(np.take(QTN_MEAN, trait), np.sqrt(np.take(QTN_VAR, trait)))
+        np.add.at(offspring, (trait, individual, genome, group), effect)
+    return offspring
+
+
+def simulate(params, slim_dir=SLIM_DIR, outdir=None):
+    '''
+    Run the surrogate for one parameter set (a dictionary from read_params), following the order of events of master_WF.slim in each cycle:
+    daily temperatures of the generation (early), reproduction, then B, CTmin and fitness of the new generation, logged every LOGINTERVAL cycles from BURNIN.
+    Returns the path of the log file.
+    '''
+    outdir = params['OUTDIR'] if outdir is None else outdir
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.default_rng(int(params['seed']))
+    N = int(params['N_POP'])
+
+    if params['USE_EXTERNAL_TEMP_DATA']:
+        path = params['TEMPDATA_PATH']
+        if not os.path.isabs(path):
+            path = os.path.join(slim_dir, path)
+        daily_temp_data = np.tile(pd.read_csv(path)['T2M'].values.astype(float), int(params['NUM_REP_TEMP_DATA']))
+    day_counter = 0
+    if params['GEN_LEN_DEPENDS_ON_TEMP']:
+        GEN_LEN = gen_len(daily_temp_data[day_counter] if params['USE_EXTERNAL_TEMP_DATA'] else float(params['MEAN_TEMP']))
+    else:
+        GEN_LEN = int(params['FIXED_GEN_LEN'])
+
+    genomes = np.zeros((2, N, 2, NUM_LINKAGE_GROUPS))
+    fitness = np.ones(N)
+    log = []
+    for cycle in range(1, int(params['RUNTIME']) + 1):
+        # early(): daily temperatures of the current generation
+        if cycle >= params['BURNIN']:
+            if params['USE_EXTERNAL_TEMP_DATA']:
+                daily_temps = daily_temp_data[day_counter:day_counter + GEN_LEN]
+            else:
+                daily_temps = np.full(GEN_LEN, float(params['MEAN_TEMP']))
+            day_counter += GEN_LEN
+            if params['USE_EXTERNAL_TEMP_DATA'] and params['GEN_LEN_DEPENDS_ON_TEMP']:
+                GEN_LEN = gen_len(daily_temp_data[day_counter])
+
+        genomes = reproduce(genomes, fitness, rng)
+
+        # B and CTmin combine genetic and environmental factors; everyone has fitness = 1 during burn-in
+        traits = genomes.reshape(2, N, -1).sum(axis=2)
+        epsilon = rng.normal(0, np.sqrt(ENV_VAR), (2, N))
+        B = params['B_default'] + traits[0] + epsilon[0]
+        CTmin = params['CTmin_default'] + traits[1] + epsilon[1]
+        if cycle <= params['BURNIN']:
+            fitness = np.ones(N)
+        else:
+            fitness = population_fitness(daily_temps, CTmin, B, params['RECOVERY'], params, rng)
+
+        if cycle >= params['BURNIN'] and (cycle - params['BURNIN']) % params['LOGINTERVAL'] == 0:
+            CTmax = CTmin + B
+            Topt = CTmin + B * 2 / 3
+            # sd and cov as in Eidos (n - 1 in the denominator)
+            log.append([cycle, day_counter, daily_temps[0],
+                        B.mean(), B.std(ddof=1), CTmin.mean(), CTmin.std(ddof=1), CTmax.mean(), CTmax.std(ddof=1),
+                        Topt.mean(), Topt.std(ddof=1), np.cov(B, CTmin)[0, 1], fitness.mean(), fitness.std(ddof=1)])
+
+        # stop when the external temperature data runs out (late() event of master_WF.slim)
+        if cycle >= params['BURNIN'] and params['USE_EXTERNAL_TEMP_DATA'] and day_counter + GEN_LEN >= len(daily_temp_data):
+            break
+
+    log_file = f"{outdir}/{params['OUTNAME']}.txt"
+    pd.DataFrame(log, columns=log_columns).to_csv(log_file, index=False)
+    np.savez(f"{outdir}/{params['OUTNAME']}_surrogate.npz", Bs_final=B, CTmins_final=CTmin)
+    return log_file
+
+
+def parse_rows(rows, n):
+    '''row indices from a string like 0-29 or 0,30,60 (None for all n rows)'''
+    if rows is None:
+        return list(range(n))
+    indices = []
+    for part in rows.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            indices += list(range(int(start), int(end) + 1))
+        else:
+            indices.append(int(part))
+    return indices
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    params_df = pd.read_csv(args.csv)
+    params_list = [read_params(params_df.iloc[i]) for i in parse_rows(args.rows, len(params_df))]
+    if args.workers <= 1:
+        log_files = [simulate(params, args.slim_dir, args.outdir) for params in params_list]
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            log_files = list(pool.map(simulate, params_list, [args.slim_dir] * len(params_list), [args.outdir] * len(params_list)))
+    for log_file in log_files:
+        print(f"saved {log_file}")
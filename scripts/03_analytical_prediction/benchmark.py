@@ -0,0 +1,306 @@
+# Benchmarks of tpc_functions and of the stages of predict.py, compared with stored baselines.
+# The first run stores the time of every case in BASELINE_DIR/baseline.json and its output in BASELINE_DIR/reference.npz.
+# Later runs report the time relative to the baseline (flagging cases slower than --threshold times the baseline),
+# and the largest absolute difference of each output from its reference: the stored output of the same case, or for the
+# 'fixed' and 'analytic' engines the stored output of the 'quad' case they approximate. The exit status is 1 if any
+# case is slower than the threshold or further from its reference than its tolerance.
+# The 'quad' trajectories and the end-to-end run with 'quad', the defaults of predict.py, take seconds each and are timed once.
+# Cases marked slow (the 'quad' trajectories with a gradient surrogate) are only timed with --all,
+# but are computed once (untimed) when they are needed as a reference.
+# --baseline-from REV stores as the baseline the times of tpc_functions_oo.py as it was in git revision REV (e.g. the commit
+# before a series of changes), so that the changes are timed against the code they replace. Cases that the older code cannot
+# run (options it did not have yet) are skipped, and their times are added from the current code on the next run.
+# Usage: python benchmark.py [--all] [--cases expected_w_TPC] [--repeat 3] [--threshold 1.5] [--update-baseline]
+#        python benchmark.py --baseline-from REV [--all]
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+# set by --baseline-from: directory with the tpc_functions_oo.py of an older revision, imported instead of the current one
+MODULE_DIR = os.environ.get('BENCHMARK_MODULE_DIR')
+if MODULE_DIR:
+    sys.path.insert(0, MODULE_DIR)
+from tpc_functions_oo import tpc_functions
+import predict
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.benchmark')
+muT = 20
+sigmaT_list = [1, 3, 6]
+# (CTmin, B) points at which the 'quad' partial derivatives are evaluated one by one, at sigmaT in sigmaT_list + [10].
+# The last one has B << sigmaT, where exp(-u^2) is narrow compared with the temperature range.
+points = np.array([[5, 31], [0, 20], [10, 25], [15, 10], [-2, 38], [22, 0.5]], dtype=float)
+# reduced grid of the end-to-end run (predict.py uses 450 x 300)
+CTmin_reduced = np.linspace(-5, 40, 45)
+B_reduced = np.linspace(1e-3, 40, 30)
+
+parser = argparse.ArgumentParser(description='Benchmarks of tpc_functions and predict.py')
+parser.add_argument('--all', action='store_true', help='also time the slow cases')
+parser.add_argument('--cases', type=str, default=None, help='only run cases whose name matches this regular expression')
+parser.add_argument('--repeat', type=int, default=3, help='time each case this many times and report the fastest (slow cases once)')
+parser.add_argument('--threshold', type=float, default=1.5, help='report cases slower than threshold x their baseline as regressions')
+parser.add_argument('--update-baseline', action='store_true', help='replace the stored times with the times of this run')
+parser.add_argument('--update-reference', action='store_true',
+                    help='replace the stored outputs with the outputs of this run (after an intended change of results)')
+parser.add_argument('--baseline-dir', type=str, default=BASELINE_DIR, help='where baseline.json and reference.npz are kept')
+parser.add_argument('--baseline-from', type=str, default=None, metavar='REV',
+                    help='replace the stored times with those of tpc_functions_oo.py in git revision REV (outputs are not stored)')
+
+
+def grid(n_CTmin, n_B):
+    '''CTmin and B lists spanning the landscape of predict.py with n_CTmin x n_B points'''
+    return np.linspace(-5, 40, n_CTmin), np.linspace(1e-3, 40, n_B)
+
+
+def engine_options(engine):
+    '''
+    keyword arguments selecting engine; none for 'quad', the default engine, so that the 'quad' cases also run
+    with revisions from before the engine option (see --baseline-from)
+    '''
+    return {} if engine == 'quad' else {'engine': engine}
+
+
+@functools.lru_cache(maxsize=None)
+def sine_distribution():
+    '''temperature histogram of the sine task with individual noise (computed when first needed)'''
+    sine_csv = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'slim', 'sine.csv')
+    return predict.temperature_distribution({'TEMPDATA': os.path.normpath(sine_csv), 'STDEV_TEMP': 1.0})
+
+
+def trajectory_output(sol):
+    '''states of a trajectory at a few times spread over its whole length (solve_ivp solution with dense output)'''
+    return sol.sol(np.geomspace(1, sol.t[-1], 12)).ravel()
+
+
+def predict_output(engine, CTmin_list=CTmin_reduced, B_list=B_reduced):
+    '''landscape, optimum and trajectory of the stages of predict.py (not saved) for the default gaussian parameters'''
+    params = predict.parse_params(['T', 10, muT, 3, 31, 5, 40, 2, 0, 2, 40, 0.2, '.', 'benchmark', engine])
+    W = predict.landscape(params, CTmin_list, B_list, store=False)
+    CTmin_grid, B_grid = np.meshgrid(CTmin_list, B_list)
+    CTmin_opt, B_opt = predict.optimum(params, CTmin_grid, B_grid, W)
+    sol = predict.trajectory(params)
+    return np.concatenate([W.ravel(), [CTmin_opt, B_opt], trajectory_output(sol)])
+
+
+def cases():
+    '''
+    list of benchmark cases: dictionaries with the name, a function returning the output as an array,
+    the case whose stored output is the reference, the tolerance (largest absolute difference), whether the case is slow,
+    and how many times it is timed (None for --repeat)
+    '''
+    tpc = tpc_functions()
+    case_list = []
+    def add(name, run, reference=None, tol=1e-9, slow=False, repeat=None):
+        case_list.append({'name': name, 'run': run, 'reference': reference or name, 'tol': tol, 'slow': slow, 'repeat': repeat})
+
+    # w_TPC on large CTmin x B x T grids
+    for n_T in [10, 100]:
+        CTmin_list, B_list = grid(450, 300)
+        add(f"w_TPC/450x300x{n_T}", lambda CTmin_list=CTmin_list, B_list=B_list, n_T=n_T:
+            tpc.w_TPC(B=B_list, CTmin=CTmin_list, T=np.linspace(0, 40, n_T)))
+
+    # expected w_TPC on landscapes of several sizes and sigmaT ('fixed' and 'analytic' are checked against 'quad' on the small grid)
+    for model, function in [('recovery', tpc.expected_w_TPC_recovery), ('no_recovery', tpc.expected_w_TPC_no_recovery)]:
+        for sigmaT in sigmaT_list:
+            quad_name = f"expected_w_TPC_{model}/quad/12x8/sigmaT={sigmaT}"
+            for engine in ['quad', 'fixed', 'analytic']:
+                sizes = [(12, 8)] if engine == 'quad' else [(12, 8), (90, 60), (450, 300)]
+                for n_CTmin, n_B in sizes:
+                    CTmin_list, B_list = grid(n_CTmin, n_B)
+                    small = (n_CTmin, n_B) == (12, 8)
+                    add(f"expected_w_TPC_{model}/{engine}/{n_CTmin}x{n_B}/sigmaT={sigmaT}",
+                        lambda function=function, CTmin_list=CTmin_list, B_list=B_list, sigmaT=sigmaT, engine=engine:
+                        function(B=B_list, CTmin=CTmin_list, muT=muT, sigmaT=sigmaT, **engine_options(engine)),
+                        reference=quad_name if small else None, tol=1e-6 if small and engine != 'quad' else 1e-9)
+
+    # expected w_TPC under the temperature data of the sine task, with individual noise
+    for recovery in [True, False]:
+        CTmin_list, B_list = grid(450, 300)
+        add(f"expected_w_TPC_empirical/{'recovery' if recovery else 'no_recovery'}/450x300/sine", lambda recovery=recovery:
+            tpc.expected_w_TPC_empirical(*sine_distribution(), CTmin=CTmin_list, B=B_list, recovery=recovery))
+
+    # partial derivatives: 'quad' one point at a time, the vectorized engines at the same points and on a landscape
+    for name in ['dexpected_w_TPC_recovery_dCTmin', 'dexpected_w_TPC_recovery_dB',
+                 'dexpected_w_TPC_no_recovery_dCTmin', 'dexpected_w_TPC_no_recovery_dB']:
+        function = getattr(tpc, name)
+        for sigmaT in sigmaT_list + [10]:
+            quad_name = f"{name}/quad/points/sigmaT={sigmaT}"
+            add(quad_name, lambda function=function, sigmaT=sigmaT:
+                np.array([function(muT=muT, sigmaT=sigmaT, CTmin=CTmin, B=B) for CTmin, B in points]))
+            for engine in ['fixed', 'analytic']:
+                add(f"{name}/{engine}/points/sigmaT={sigmaT}", lambda function=function, sigmaT=sigmaT, engine=engine:
+                    function(muT=muT, sigmaT=sigmaT, CTmin=points[:, 0], B=points[:, 1], engine=engine),
+                    reference=quad_name, tol=1e-6)
+        CTmin_grid, B_grid = np.meshgrid(*grid(90, 60))
+        add(f"{name}/analytic/90x60/sigmaT=3", lambda function=function:
+            function(muT=muT, sigmaT=3, CTmin=CTmin_grid, B=B_grid, engine='analytic'))
+
+    # the three trajectory solvers
+    add("CTmin_B_traj_fixed_T/T=20", lambda: trajectory_output(tpc.CTmin_B_traj_fixed_T(CTmin0=5, B0=31, T=muT)))
+    for model in ['recovery', 'no_recovery']:
+        function = getattr(tpc, f"expected_CTmin_B_traj_{model}")
+        quad_name = f"expected_CTmin_B_traj_{model}/quad/sigmaT=3"
+        for engine in ['quad', 'fixed', 'analytic']:
+            add(f"expected_CTmin_B_traj_{model}/{engine}/sigmaT=3", lambda function=function, engine=engine:
+                trajectory_output(function(CTmin0=5, B0=31, muT=muT, sigmaT=3, **engine_options(engine))),
+                reference=quad_name, tol=1e-6 if engine == 'quad' else 1e-4, repeat=1 if engine == 'quad' else None)
+        # 'quad' with the right-hand side from a spline surrogate of the gradient, built with 'analytic' (see scripts/README.md)
+        add(f"expected_CTmin_B_traj_{model}/quad+surrogate/sigmaT=3", lambda function=function:
+            trajectory_output(function(CTmin0=5, B0=31, muT=muT, sigmaT=3, engine='quad', surrogate='analytic')),
+            reference=quad_name, tol=1e-3, slow=True)
+
+    # predict.py end to end (landscape, optimum and trajectory) on a reduced grid.
+    # L-BFGS-B stops within ~1e-4 of the optimum, so the optimum found with 'analytic' is only that close to 'quad'
+    for engine in ['quad', 'analytic']:
+        add(f"predict/{engine}/{len(CTmin_reduced)}x{len(B_reduced)}", lambda engine=engine: predict_output(engine),
+            reference="predict/quad/45x30", tol=1e-6 if engine == 'quad' else 1e-3, repeat=1 if engine == 'quad' else None)
+    return case_list
+
+
+def measure(run, repeat, min_time=0.2):
+    '''
+    fastest of at least repeat timed calls of run (repeated until they add up to min_time seconds, so that fast cases
+    are timed more often), and the output of the last call. Prints of run are discarded.
+    '''
+    times = []
+    while len(times) < repeat or (sum(times) < min_time and len(times) < 1000):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            output = run()
+            times.append(time.perf_counter() - start)
+    return min(times), np.ravel(np.asarray(output, dtype=float))
+
+
+def load_baseline(baseline_dir):
+    '''stored times (dictionary by case name) and outputs (dictionary of arrays), empty if there are none yet'''
+    times, outputs = {}, {}
+    if os.path.exists(os.path.join(baseline_dir, 'baseline.json')):
+        with open(os.path.join(baseline_dir, 'baseline.json')) as f:
+            times = json.load(f)['seconds']
+    if os.path.exists(os.path.join(baseline_dir, 'reference.npz')):
+        with np.load(os.path.join(baseline_dir, 'reference.npz')) as stored:
+            outputs = {name: stored[name] for name in stored.files}
+    return times, outputs
+
+
+def save_baseline(baseline_dir, times, outputs):
+    os.makedirs(baseline_dir, exist_ok=True)
+    with open(os.path.join(baseline_dir, 'baseline.json'), 'w') as f:
+        json.dump({'host': platform.node(), 'python': platform.python_version(), 'numpy': np.__version__,
+                   'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'seconds': times}, f, indent=1)
+    np.savez(os.path.join(baseline_dir, 'reference.npz'), **outputs)
+
+
+def benchmark(case_list, all_cases, baseline_times, reference_outputs, repeat=3, run_slow=False, threshold=1.5, compare=True):
+    '''
+    time the cases and compare them with the baseline. Returns the report (one dictionary per case),
+    and the times and outputs measured in this run.
+    References (cases in all_cases, by name) without a stored output are computed once, untimed, when they are needed.
+    Slow cases are skipped unless run_slow is True.
+    compare : False to only time the cases, skipping those that raise an error (for --baseline-from)
+    '''
+    times, outputs, report = {}, {}, []
+    for case in case_list:
+        name = case['name']
+        if case['slow'] and not run_slow:
+            continue
+        reference_name = case['reference'] if compare else name
+        if reference_name != name and reference_name not in reference_outputs and reference_name not in outputs:
+            print(f"computing the reference {reference_name} (not timed)")
+            outputs[reference_name] = measure(all_cases[reference_name]['run'], 1, min_time=0)[1]
+        once = case['slow'] or case['repeat'] == 1
+        try:
+            times[name], outputs[name] = measure(case['run'], case['repeat'] or (1 if case['slow'] else repeat),
+                                                 min_time=0 if once else 0.2)
+        except Exception as error:
+            if compare:
+                raise
+            print(f"{name:<58} skipped ({type(error).__name__}: {error})")
+            continue
+        reference = reference_outputs.get(reference_name, outputs.get(reference_name)) if compare else None
+        error = None
+        if reference is not None and reference.shape == outputs[name].shape:
+            error = float(np.max(np.abs(outputs[name] - reference), initial=0))
+        elif reference is not None:
+            error = np.inf
+        baseline = baseline_times.get(name)
+        ratio = times[name] / baseline if baseline else None
+        if ratio is None:
+            status = 'new'
+        elif ratio > threshold:
+            status = 'SLOWER'
+        elif ratio < 1 / threshold:
+            status = 'faster'
+        else:
+            status = 'ok'
+        accuracy = '' if error is None else ('ok' if error <= case['tol'] else 'FAIL')
+        report.append({'case': name, 'seconds': times[name], 'baseline': baseline, 'ratio': ratio, 'status': status,
+                       'error': error, 'tol': case['tol'], 'accuracy': accuracy})
+        print(f"{name:<58} {times[name]:10.4f} s  {'' if ratio is None else f'{ratio:5.2f}x':>6} {status:<7}"
+              f"{'' if error is None else f'err {error:.1e} {accuracy}'}")
+    return report, times, outputs
+
+
+def baseline_from(revision, args):
+    '''
+    run this benchmark in a subprocess with tpc_functions_oo.py from git revision (timing only), storing its times as the baseline
+    '''
+    module = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tpc_functions_oo.py')
+    source = subprocess.run(['git', 'show', f"{revision}:./tpc_functions_oo.py"], cwd=os.path.dirname(module),
+                            capture_output=True, text=True, check=True).stdout
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'tpc_functions_oo.py'), 'w') as f:
+            f.write(source)
+        command = [sys.executable, os.path.abspath(__file__), '--baseline-dir', args.baseline_dir, '--repeat', str(args.repeat)]
+        command += (['--all'] if args.all else []) + (['--cases', args.cases] if args.cases else [])
+        return subprocess.run(command, env=dict(os.environ, BENCHMARK_MODULE_DIR=directory)).returncode
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.baseline_from:
+        print(f"timing tpc_functions_oo.py of {args.baseline_from} for the baseline")
+        raise SystemExit(baseline_from(args.baseline_from, args))
+    all_cases = {case['name']: case for case in cases()}
+    case_list = [case for name, case in all_cases.items() if args.cases is None or re.search(args.cases, name)]
+    baseline_times, reference_outputs = load_baseline(args.baseline_dir)
+    if MODULE_DIR:
+        # timing an older revision for --baseline-from: its times replace the baseline, and nothing else is stored
+        report, times, _ = benchmark(case_list, all_cases, {}, {}, args.repeat, args.all, args.threshold, compare=False)
+        baseline_times.update(times)
+        save_baseline(args.baseline_dir, baseline_times, reference_outputs)
+        print(f"\n{len(report)} cases timed, baseline stored in {args.baseline_dir}")
+        raise SystemExit(0)
+    report, times, outputs = benchmark(case_list, all_cases, baseline_times, reference_outputs, args.repeat, args.all,
+                                       args.threshold)
+
+    first_run = not baseline_times
+    # times are only added for cases without a stored time, unless the baseline is updated
+    for name, seconds in times.items():
+        if args.update_baseline or name not in baseline_times:
+            baseline_times[name] = seconds
+    # outputs are only added for cases without a stored output, unless the reference is updated
+    for name, output in outputs.items():
+        if args.update_reference or name not in reference_outputs:
+            reference_outputs[name] = output
+    save_baseline(args.baseline_dir, baseline_times, reference_outputs)
+
+    regressions = [row['case'] for row in report if row['status'] == 'SLOWER']
+    failures = [row['case'] for row in report if row['accuracy'] == 'FAIL']
+    print(f"\n{len(report)} cases timed, {len(regressions)} slower than {args.threshold} x baseline, "
+          f"{len(failures)} outside their tolerance")
+    for name in regressions:
+        print(f"  slower: {name}")
+    for name in failures:
+        print(f"  inaccurate: {name}")
+    if first_run:
+        print(f"baseline stored in {args.baseline_dir}")
+    raise SystemExit(1 if regressions or failures else 0)
@@ -33,6 +33,27 @@ IFS=',' read -r RUNTIME BURNIN LOGINTERVAL N_POP\
 # The analytical model cannot account for changing generation length
 # Thus, define the average generation length here (default is 10)
 AVG_GEN_LEN=10
+# Method for integrating over temperature: 'quad' (adaptive, per grid cell), 'fixed' (Gauss-Legendre, whole grid at once)
+# or 'analytic' (closed form, whole grid at once)
+ENGINE=quad
+# Landscape: 'full' (every grid point) or 'adaptive' (coarse grid refined near the ridge and the maximum, rest interpolated)
+LANDSCAPE=full
+# Skip integrating cells where w_B * w_CTmin * w_CTmax < PRUNE_EPS (expected fitness there is below PRUNE_EPS); 0 integrates every cell
+PRUNE_EPS=0
+# Directory of a landscape store shared between runs: stored landscapes are reused, and computed ones are added (empty for none)
+STORE=
+# With USE_EXTERNAL_TEMP_DATA = T, the temperature follows the data at TEMPDATA_PATH (relative to the slim directory),
+# with STDEV_TEMP as the noise of each individual, instead of Normal(MEAN_TEMP, STDEV_TEMP)
+TEMPDATA=
+if [ "${USE_EXTERNAL_TEMP_DATA}" = "T" ]; then
+    TEMPDATA=../../slim/${TEMPDATA_PATH}
+fi
+# T to solve the trajectory with a spline surrogate of the gradient built with the analytic engine (see ../README.md)
+SURROGATE=F
+# The time and work (quad calls, ODE evaluations, optimizer iterations) of each stage are written to OUTDIR/OUTNAME_profile.json,
+# also during a stage every TPC_PROFILE_HEARTBEAT seconds. TPC_PROFILE=sample (or cprofile, slower) also lists the functions taking the most time.
+export TPC_PROFILE=
+export TPC_PROFILE_HEARTBEAT=60
 
 echo "Running job ${SLURM_ARRAY_TASK_ID} with \
 N_POP=${N_POP}
@@ -49,13 +70,19 @@ DeltaCTmin=${DeltaCTmin}, \
 CTmax_critical=${CTmax_critical}, \
 DeltaCTmax=${DeltaCTmax}, \
 OUTDIR=${OUTDIR},\
-OUTNAME=${OUTNAME}"
+OUTNAME=${OUTNAME}, \
+ENGINE=${ENGINE}, \
+LANDSCAPE=${LANDSCAPE}, \
+PRUNE_EPS=${PRUNE_EPS}, \
+STORE=${STORE}, \
+TEMPDATA=${TEMPDATA}, \
+SURROGATE=${SURROGATE}"
 
 # Run python script for analytical predictions
 python -u predict.py ${RECOVERY} \
 ${AVG_GEN_LEN} ${MEAN_TEMP} ${STDEV_TEMP} \
 ${B_default} ${CTmin_default} ${B_critical} \
 ${DeltaB} ${CTmin_critical} ${DeltaCTmin} \
-${CTmax_critical} ${DeltaCTmax} ${OUTDIR} ${OUTNAME}
+${CTmax_critical} ${DeltaCTmax} ${OUTDIR} ${OUTNAME} ${ENGINE} ${LANDSCAPE} ${PRUNE_EPS} "${STORE}" "${TEMPDATA}" ${SURROGATE}
 
 echo "Analytical prediction job finished for output name = ${OUTNAME}"
@@ -0,0 +1,94 @@
+## On-disk store of precomputed expected fitness landscapes
+
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+class landscape_store:
+    """
+    Directory of expected fitness landscapes (W_contour arrays), shared by runs of predict.py and by tpc_functions objects.
+    Each landscape is one .npy file, read memory-mapped, next to a .json file holding its key (see tpc_functions.landscape_key):
+    the model, muT, sigmaT, the physiological constants, the CTmin x B grid, prune_eps and the engine (with n_nodes for 'fixed').
+    Both files are named by a hash of the key.
+    Files are written under a temporary name and then renamed, so several processes can fill the same store at once.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, extension):
+        name = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.directory, name + extension)
+
+    def _write(self, path, write):
+        # write to a temporary file in the same directory, then rename it, so readers never see a partial file
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'wb') as f:
+            write(f)
+        os.replace(temporary_path, path)
+
+    def get(self, key):
+        '''
+        memory-mapped landscape stored under key, or None if there is none
+        '''
+        path = self._path(key, '.npy')
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def put(self, key, W):
+        '''
+        store landscape W under key (the .json file is written last, so keys() only lists complete landscapes)
+        '''
+        self._write(self._path(key, '.npy'), lambda f: np.save(f, np.asarray(W, dtype=float)))
+        self._write(self._path(key, '.json'), lambda f: f.write(json.dumps(key, sort_keys=True).encode()))
+
+    def keys(self):
+        '''
+        list of the keys of all stored landscapes
+        '''
+        keys = []
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.json'))):
+            with open(path) as f:
+                keys.append(json.load(f))
+        return keys
+
+    def query(self, key):
+        '''
+        landscape for key, linearly interpolated in muT and sigmaT between stored landscapes if it is not stored itself.
+        The stored landscapes used must agree with key on every other field, and have the nearest stored muT and sigmaT on each side of
+        the requested ones (bilinear interpolation between four landscapes, or linear between two if muT or sigmaT is stored exactly).
+        Raises KeyError if the requested muT and sigmaT are not surrounded by stored landscapes.
+        Note that the ridge of the landscape moves with muT and sigmaT, so interpolating between distant slices blurs it.
+        '''
+        stored = self.get(key)
+        if stored is not None:
+            return np.array(stored)
+        others = {field: value for field, value in key.items() if field not in ('muT', 'sigmaT')}
+        slices = {(k['muT'], k['sigmaT']) for k in self.keys()
+                  if {field: value for field, value in k.items() if field not in ('muT', 'sigmaT')} == others}
+        muT, sigmaT = key['muT'], key['sigmaT']
+        def bracket(values, x):
+            # nearest stored values at or below and at or above x, with the interpolation weight of the upper one
+            values = sorted(set(values))
+            lower = [v for v in values if v <= x]
+            upper = [v for v in values if v >= x]
+            if not lower or not upper:
+                raise KeyError(f"no stored landscapes on both sides of {x} for {others}")
+            lower, upper = lower[-1], upper[0]
+            return lower, upper, 0 if upper == lower else (x - lower) / (upper - lower)
+        muT_lower, muT_upper, t = bracket([m for m, s in slices], muT)
+        sigmaT_lower, sigmaT_upper, u = bracket([s for m, s in slices if m in (muT_lower, muT_upper)], sigmaT)
+        W = 0
+        for m, weight_m in ((muT_lower, 1 - t), (muT_upper, t)):
+            for s, weight_s in ((sigmaT_lower, 1 - u), (sigmaT_upper, u)):
+                if weight_m * weight_s == 0:
+                    continue
+                corner = self.get(dict(key, muT=m, sigmaT=s))
+                if corner is None:
+                    raise KeyError(f"no stored landscape at muT = {m}, sigmaT = {s} for {others}")
+                W = W + weight_m * weight_s * corner
+        return np.array(W)
@@ -1,116 +1,337 @@
 # Make expected fitness landscape, optimal B and CTmin (peak of landscape),
 # and expected path to the optimum from initial state
+# Usage: python predict.py RECOVERY AVG_GEN_LEN MEAN_TEMP STDEV_TEMP B_default CTmin_default B_critical DeltaB
+#                          CTmin_critical DeltaCTmin CTmax_critical DeltaCTmax OUTDIR OUTNAME [ENGINE] [LANDSCAPE] [PRUNE_EPS] [STORE]
+#                          [TEMPDATA] [SURROGATE]
+# The stages are also importable (see sweep.py, which runs them for a whole params_unique csv in a process pool).
+# The time and work of each stage are written to OUTDIR/OUTNAME_profile.json (see profiling.py; set TPC_PROFILE=cprofile or sample
+# to also list the functions taking the most time).
+import functools
 import numpy as np
+import pandas as pd
 from tpc_functions_oo import *
+from landscape_store import landscape_store
+from profiling import stage_profile
 import scipy
 import sys
 import os
 
-RECOVERY = sys.argv[1] # string either T or F
-AVG_GEN_LEN = int(sys.argv[2])
-MEAN_TEMP = float(sys.argv[3]) 
-STDEV_TEMP = float(sys.argv[4])
-B_default = float(sys.argv[5]) 
-CTmin_default = float(sys.argv[6])
-B_critical = float(sys.argv[7])
-DeltaB = float(sys.argv[8])
-CTmin_critical = float(sys.argv[9])
-DeltaCTmin = float(sys.argv[10])
-CTmax_critical = float(sys.argv[11]) 
-DeltaCTmax = float(sys.argv[12])
-OUTDIR = sys.argv[13]
-OUTNAME = sys.argv[14]
-
-
-# Initiate a tpc object
-tpc = tpc_functions(B_critical = B_critical,
-                    Delta_B = DeltaB, 
-                    CTmin_critical = CTmin_critical,
-                    Delta_CTmin = DeltaCTmin,
-                    CTmax_critical = CTmax_critical,
-                    Delta_CTmax = DeltaCTmax,
-                    num_days_per_gen = AVG_GEN_LEN)
-
-## 1. Find expected fitness landscape with given temperature distribution (Gaussian)
-
+# grid of the expected fitness landscape
 CTmin_list = np.linspace(-5, 40, 450)
 B_list = np.linspace(1e-3, 40, 300)
-[CTmin_grid, B_grid] = np.meshgrid(CTmin_list, B_list)
-CTmax_grid = CTmin_grid + B_grid
-if STDEV_TEMP < np.nextafter(0, 1):
-    # (using nextafter to check if sigmaT is zero since it is always a float)
-    # if T is constant, use a fitness function without integration over T to save time.
-    meanWcontour = tpc.w_TPC(CTmin=CTmin_list, 
-                            B=B_list,
-                            T=MEAN_TEMP)
-else:
-    if RECOVERY == 'F':
-        meanWcontour = tpc.expected_w_TPC_no_recovery(muT=MEAN_TEMP, 
-                                                    sigmaT=STDEV_TEMP,
+
+
+def parse_params(argv):
+    '''
+    convert the positional command line arguments (without the script name) into a dictionary of parameters
+    '''
+    return {'RECOVERY': argv[0], # string either T or F
+            'AVG_GEN_LEN': int(argv[1]),
+            'MEAN_TEMP': float(argv[2]),
+            'STDEV_TEMP': float(argv[3]),
+            'B_default': float(argv[4]),
+            'CTmin_default': float(argv[5]),
+            'B_critical': float(argv[6]),
+            'DeltaB': float(argv[7]),
+            'CTmin_critical': float(argv[8]),
+            'DeltaCTmin': float(argv[9]),
+            'CTmax_critical': float(argv[10]),
+            'DeltaCTmax': float(argv[11]),
+            'OUTDIR': argv[12],
+            'OUTNAME': argv[13],
+            # optional: method used to integrate over temperature ('quad', 'fixed' or 'analytic', see tpc_functions.expected_w_TPC_recovery)
+            'ENGINE': argv[14] if len(argv) > 14 else 'quad',
+            # optional: 'full' evaluates every point of the landscape grid, 'adaptive' refines a coarse grid (see adaptive_landscape)
+            'LANDSCAPE': argv[15] if len(argv) > 15 else 'full',
+            # optional: skip integrating cells where w_B * w_CTmin * w_CTmax < PRUNE_EPS (0 integrates every cell)
+            'PRUNE_EPS': float(argv[16]) if len(argv) > 16 else 0,
+            # optional: directory of a landscape_store; landscapes found there are reused, and computed ones are added ('' for none)
+            'STORE': argv[17] if len(argv) > 17 else '',
+            # optional: csv of daily temperatures (column T2M, e.g. ../../slim/VT_weather.txt) to use instead of Normal(MEAN_TEMP, STDEV_TEMP).
+            # STDEV_TEMP is then the noise added to the temperature of each individual, as in master_WF.slim ('' for none)
+            'TEMPDATA': argv[18] if len(argv) > 18 else '',
+            # optional: T to take the trajectory ODE's right-hand side from spline interpolants of the gradient, built first with the
+            # 'analytic' engine (see tpc_functions.gradient_surrogate_expected_w_TPC). Only faster with ENGINE=quad
+            'SURROGATE': argv[19] if len(argv) > 19 else 'F'}
+
+
+def make_tpc(params, store=True):
+    '''
+    Initiate a tpc object (using the landscape store in params['STORE'], if any, unless store is False)
+    '''
+    use_store = store and params.get('STORE', '')
+    return tpc_functions(B_critical = params['B_critical'],
+                         Delta_B = params['DeltaB'],
+                         CTmin_critical = params['CTmin_critical'],
+                         Delta_CTmin = params['DeltaCTmin'],
+                         CTmax_critical = params['CTmax_critical'],
+                         Delta_CTmax = params['DeltaCTmax'],
+                         num_days_per_gen = params['AVG_GEN_LEN'],
+                         landscape_store = landscape_store(params['STORE']) if use_store else None)
+
+
+@functools.lru_cache(maxsize=None)
+def _temperature_histogram(path, noise_sd):
+    return temperature_histogram(sample=pd.read_csv(path)['T2M'].values, noise_sd=noise_sd)
+
+
+def temperature_distribution(params):
+    '''
+    empirical temperature distribution (p, edges) of params['TEMPDATA'] with individual noise STDEV_TEMP
+    (see tpc_functions_oo.temperature_histogram), or None if the temperature is Normal(MEAN_TEMP, STDEV_TEMP)
+    '''
+    if not params.get('TEMPDATA', ''):
+        return None
+    return _temperature_histogram(params['TEMPDATA'], params['STDEV_TEMP'])
+
+
+def landscape(params, CTmin_list=CTmin_list, B_list=B_list, store=True):
+    '''
+    1. expected fitness landscape with given temperature distribution (Gaussian, or empirical with params['TEMPDATA']), shape (len(B_list), len(CTmin_list)).
+    Any sub-grid (tile) of the landscape can be computed separately by passing parts of CTmin_list and B_list.
+    Every point is evaluated, unless params['LANDSCAPE'] is 'adaptive' (see adaptive_landscape).
+    Full landscapes are looked up in and added to the landscape store in params['STORE'], unless store is False.
+    '''
+    if params.get('LANDSCAPE', 'full') == 'adaptive':
+        meanWcontour, n_evaluated = adaptive_landscape(params, CTmin_list, B_list)
+        print(f"adaptive landscape: evaluated {n_evaluated} of {meanWcontour.size} points")
+        return meanWcontour
+    return evaluate_landscape(params, CTmin_list, B_list, store=store)
+
+
+def evaluate_landscape(params, CTmin_list=CTmin_list, B_list=B_list, verbose=True, store=True, tpc=None):
+    '''
+    expected fitness at every point of the CTmin_list x B_list grid, shape (len(B_list), len(CTmin_list)).
+    verbose : print the number of pruned cells if params['PRUNE_EPS'] > 0
+    tpc : tpc object to evaluate with (default: a new one from make_tpc)
+    '''
+    verbose = verbose and params.get('PRUNE_EPS', 0) > 0
+    if tpc is None:
+        tpc = make_tpc(params, store=store)
+    histogram = temperature_distribution(params)
+    if histogram is not None:
+        if params['RECOVERY'] not in ('T', 'F'):
+            raise ValueError("invalid RECOVERY input. It should be either T or F")
+        meanWcontour = tpc.expected_w_TPC_empirical(*histogram,
                                                     CTmin=CTmin_list,
-                                                    B=B_list)
-    elif RECOVERY == 'T':
-        meanWcontour = tpc.expected_w_TPC_recovery(B=B_list, 
+                                                    B=B_list,
+                                                    recovery=params['RECOVERY'] == 'T',
+                                                    prune_eps=params.get('PRUNE_EPS', 0),
+                                                    verbose=verbose)
+    elif params['STDEV_TEMP'] < np.nextafter(0, 1):
+        # (using nextafter to check if sigmaT is zero since it is always a float)
+        # if T is constant, use a fitness function without integration over T to save time.
+        meanWcontour = tpc.w_TPC(CTmin=CTmin_list,
+                                 B=B_list,
+                                 T=params['MEAN_TEMP'])
+    elif params['RECOVERY'] == 'F':
+        meanWcontour = tpc.expected_w_TPC_no_recovery(muT=params['MEAN_TEMP'],
+                                                      sigmaT=params['STDEV_TEMP'],
+                                                      CTmin=CTmin_list,
+                                                      B=B_list,
+                                                      engine=params['ENGINE'],
+                                                      prune_eps=params.get('PRUNE_EPS', 0),
+                                                      verbose=verbose)
+    elif params['RECOVERY'] == 'T':
+        meanWcontour = tpc.expected_w_TPC_recovery(B=B_list,
                                                    CTmin=CTmin_list,
-                                                   muT=MEAN_TEMP,
-                                                   sigmaT=STDEV_TEMP)
+                                                   muT=params['MEAN_TEMP'],
+                                                   sigmaT=params['STDEV_TEMP'],
+                                                   engine=params['ENGINE'],
+                                                   prune_eps=params.get('PRUNE_EPS', 0),
+                                                   verbose=verbose)
     else:
-        print("invalid RECOVERY input. It should be either T or F")
-
-print("contour made")
-
-## 2. Find where fitness is maximized on the landscape
-max_idx = np.unravel_index(np.argmax(meanWcontour), np.shape(meanWcontour))
-CTmin0 = CTmin_grid[max_idx]
-B0 = B_grid[max_idx]
-if STDEV_TEMP < np.nextafter(0,1):
-    print("standard deviation of temperature too small, returning maximum found from the contour plot")
-    CTmin_opt = CTmin0
-    B_opt = B0
-else:
-    if RECOVERY == 'F':
-        CTmin_opt, B_opt = tpc.optimize_expected_w_TPC_no_recovery(
-                                muT=MEAN_TEMP,
-                                sigmaT=STDEV_TEMP,
-                                CTmin0=CTmin0,
-                                B0=B0
-                               )
+        raise ValueError("invalid RECOVERY input. It should be either T or F")
+    # w_TPC, expected_w_TPC_recovery and expected_w_TPC_empirical squeeze their output, so restore the axes of length one (single-row tiles)
+    return np.reshape(meanWcontour, (len(B_list), len(CTmin_list)))
+
+
+def _store_and_key(params):
+    '''
+    landscape store in params['STORE'] and the key of the full landscape of params in it, or (None, None) if there is no store
+    or the landscape is not stored (adaptive landscapes, fixed temperature and empirical temperature distributions)
+    '''
+    if (not params.get('STORE', '') or params.get('LANDSCAPE', 'full') != 'full' or params.get('TEMPDATA', '')
+            or params['STDEV_TEMP'] < np.nextafter(0, 1)):
+        return None, None
+    tpc = make_tpc(params)
+    key = tpc.landscape_key(recovery=params['RECOVERY'] == 'T', muT=params['MEAN_TEMP'], sigmaT=params['STDEV_TEMP'],
+                            CTmin=CTmin_list, B=B_list, prune_eps=params.get('PRUNE_EPS', 0), engine=params['ENGINE'])
+    return tpc.landscape_store, key
+
+
+def stored_landscape(params):
+    '''
+    full landscape of params from the landscape store in params['STORE'], or None if it is not there
+    '''
+    store, key = _store_and_key(params)
+    W = None if store is None else store.get(key)
+    return None if W is None else np.array(W)
+
+
+def store_landscape(params, meanWcontour):
+    '''
+    add a full landscape computed in tiles to the landscape store in params['STORE'], if any
+    '''
+    store, key = _store_and_key(params)
+    if store is not None:
+        store.put(key, meanWcontour)
+
+
+def adaptive_landscape(params, CTmin_list=CTmin_list, B_list=B_list, stride=16, tol=0.05, peak=0.05):
+    '''
+    Coarse-to-fine approximation of evaluate_landscape on the same grid, returned with the number of evaluated points.
+    Every stride-th point in each direction (and the last one) is evaluated first. Each cell between evaluated points is then
+    refined (points at half the stride inside and on the cell are evaluated) if the values at its corners differ by more than
+    tol * the landscape maximum or if one of them is within peak * the landscape maximum of the maximum. This repeats until the stride is 1.
+    Points of cells that are not refined are linearly interpolated from the cell corners, so the output is a regular W_contour.
+    With the defaults, about a tenth of the 450 x 300 grid is evaluated; the argmax is the same as the full grid's
+    and the interpolated values are within ~2% of the maximum (tol = 0.01 gives ~0.3% with about a third of the grid evaluated).
+    '''
+    shape = (len(B_list), len(CTmin_list))
+    meanWcontour = np.zeros(shape)
+    evaluated = np.zeros(shape, dtype=bool)
+    tpc = make_tpc(params, store=False)
+    def lattice(n, step):
+        return np.unique(np.append(np.arange(0, n, step), n - 1))
+    def evaluate(rows, cols, mask):
+        for i, row in enumerate(rows):
+            c = cols[mask[i]]
+            if len(c) > 0:
+                meanWcontour[row, c] = evaluate_landscape(params, CTmin_list[c], B_list[[row]], verbose=False, tpc=tpc)[0]
+                evaluated[row, c] = True
+    def cells(points, lattice_points):
+        # indices of the (at most two) lattice cells whose closure contains each point
+        last = max(len(lattice_points) - 2, 0)
+        lower = np.clip(np.searchsorted(lattice_points, points, 'left') - 1, 0, last)
+        upper = np.clip(np.searchsorted(lattice_points, points, 'right') - 1, 0, last)
+        return lower, upper
+
+    rows, cols = lattice(shape[0], stride), lattice(shape[1], stride)
+    evaluate(rows, cols, np.ones((len(rows), len(cols)), dtype=bool))
+    while stride > 1:
+        corners = meanWcontour[np.ix_(rows, cols)]
+        W_max = corners.max()
+        # corners of each cell along the last two axes
+        cell_corners = np.stack([corners[:-1, :-1], corners[:-1, 1:], corners[1:, :-1], corners[1:, 1:]])
+        refine = ((cell_corners.max(axis=0) - cell_corners.min(axis=0) > tol * W_max)
+                  | (cell_corners.max(axis=0) >= (1 - peak) * W_max))
+        stride = stride // 2
+        fine_rows, fine_cols = lattice(shape[0], stride), lattice(shape[1], stride)
+        row_lower, row_upper = cells(fine_rows, rows)
+        col_lower, col_upper = cells(fine_cols, cols)
+        in_refined = (refine[np.ix_(row_lower, col_lower)] | refine[np.ix_(row_lower, col_upper)]
+                      | refine[np.ix_(row_upper, col_lower)] | refine[np.ix_(row_upper, col_upper)])
+        new = ~evaluated[np.ix_(fine_rows, fine_cols)]
+        evaluate(fine_rows, fine_cols, in_refined & new)
+        # interpolate the remaining new points bilinearly from the corners of their cell
+        interpolate = ~in_refined & new
+        if np.any(interpolate):
+            i, j = np.nonzero(interpolate)
+            a, b = row_upper[i], col_upper[j]
+            t = (fine_rows[i] - rows[a]) / np.maximum(rows[a + 1] - rows[a], 1)
+            u = (fine_cols[j] - cols[b]) / np.maximum(cols[b + 1] - cols[b], 1)
+            meanWcontour[fine_rows[i], fine_cols[j]] = ((1 - t) * (1 - u) * corners[a, b] + (1 - t) * u * corners[a, b + 1]
+                                                       + t * (1 - u) * corners[a + 1, b] + t * u * corners[a + 1, b + 1])
+        rows, cols = fine_rows, fine_cols
+    return meanWcontour, int(evaluated.sum())
+
+
+def optimum(params, CTmin_grid, B_grid, meanWcontour):
+    '''
+    2. Find where fitness is maximized on the landscape
+    '''
+    tpc = make_tpc(params, store=False)
+    max_idx = np.unravel_index(np.argmax(meanWcontour), np.shape(meanWcontour))
+    CTmin0 = CTmin_grid[max_idx]
+    B0 = B_grid[max_idx]
+    histogram = temperature_distribution(params)
+    if histogram is not None:
+        return tpc.optimize_expected_w_TPC_empirical(*histogram, CTmin0=CTmin0, B0=B0, recovery=params['RECOVERY'] == 'T')
+    if params['STDEV_TEMP'] < np.nextafter(0,1):
+        print("standard deviation of temperature too small, returning maximum found from the contour plot")
+        return CTmin0, B0
+    if params['RECOVERY'] == 'F':
+        optimize_expected_w_TPC = tpc.optimize_expected_w_TPC_no_recovery
     else:
-        CTmin_opt, B_opt = tpc.optimize_expected_w_TPC_recovery(
-                                muT=MEAN_TEMP,
-                                sigmaT=STDEV_TEMP,
-                                CTmin0=CTmin0,
-                                B0=B0
-                                )
-print("optimal B and CTmin found")
-
-# 3. Find theoretical trajectory from initial B and CTmin to the optimal B and CTmin (numerical solution to initial value problem)
-if STDEV_TEMP < np.nextafter(0, 1):
-    print("standard deviation of temperature too small. Using ODE for fixed temperature.")
-    sol = tpc.CTmin_B_traj_fixed_T(
-                                    CTmin0=CTmin_default,
-                                    B0=B_default,
-                                    T=MEAN_TEMP
-            )
-else:
-    if RECOVERY == 'F':
-        sol = tpc.expected_CTmin_B_traj_no_recovery(CTmin0=CTmin_default,
-                                                B0=B_default,
-                                                muT=MEAN_TEMP,
-                                                sigmaT=STDEV_TEMP
-                                                )
+        optimize_expected_w_TPC = tpc.optimize_expected_w_TPC_recovery
+    CTmin_opt, B_opt = optimize_expected_w_TPC(muT=params['MEAN_TEMP'],
+                                               sigmaT=params['STDEV_TEMP'],
+                                               CTmin0=CTmin0,
+                                               B0=B0,
+                                               engine=params['ENGINE'])
+    return CTmin_opt, B_opt
+
+
+def trajectory(params):
+    '''
+    3. Find theoretical trajectory from initial B and CTmin to the optimal B and CTmin (numerical solution to initial value problem)
+    '''
+    tpc = make_tpc(params, store=False)
+    histogram = temperature_distribution(params)
+    if histogram is not None:
+        return tpc.expected_CTmin_B_traj_empirical(CTmin0=params['CTmin_default'],
+                                                   B0=params['B_default'],
+                                                   p=histogram[0],
+                                                   edges=histogram[1],
+                                                   recovery=params['RECOVERY'] == 'T',
+                                                   verbose=True)
+    if params['STDEV_TEMP'] < np.nextafter(0, 1):
+        print("standard deviation of temperature too small. Using ODE for fixed temperature.")
+        return tpc.CTmin_B_traj_fixed_T(CTmin0=params['CTmin_default'],
+                                        B0=params['B_default'],
+                                        T=params['MEAN_TEMP'],
+                                        verbose=True)
+    if params['RECOVERY'] == 'F':
+        expected_CTmin_B_traj = tpc.expected_CTmin_B_traj_no_recovery
     else:
-        sol = tpc.expected_CTmin_B_traj_recovery(CTmin0=CTmin_default,
-                                                 B0=B_default,
-                                                 muT=MEAN_TEMP,
-                                                 sigmaT=STDEV_TEMP
-                                                 )
-
-print("theoretical trajectory calculated.")
-np.savez(f"{OUTDIR}/{OUTNAME}_analytical_info.npz", 
-         CTmin_grid=CTmin_grid, 
-         B_grid=B_grid, 
-         W_contour=meanWcontour, 
-         CTmin_opt=CTmin_opt, 
-         B_opt=B_opt, 
-         sol=sol)
+        expected_CTmin_B_traj = tpc.expected_CTmin_B_traj_recovery
+    return expected_CTmin_B_traj(CTmin0=params['CTmin_default'],
+                                 B0=params['B_default'],
+                                 muT=params['MEAN_TEMP'],
+                                 sigmaT=params['STDEV_TEMP'],
+                                 engine=params['ENGINE'],
+                                 verbose=True,
+                                 surrogate='analytic' if params.get('SURROGATE', 'F') == 'T' else None)
+
+
+def finish(params, meanWcontour, profile=None, landscape_stage=None):
+    '''
+    optimum and trajectory for a finished landscape, saved with the landscape in OUTDIR/OUTNAME_analytical_info.npz.
+    The stages are added to profile (a new stage_profile if None).
+    landscape_stage : seconds, counters and other details of a landscape computed elsewhere, recorded as the landscape stage
+                      (see stage_profile.add_stage and sweep.py)
+    '''
+    if profile is None:
+        profile = stage_profile(params)
+    if landscape_stage is not None:
+        profile.add_stage('landscape', **landscape_stage)
+    [CTmin_grid, B_grid] = np.meshgrid(CTmin_list, B_list)
+    with profile.stage('optimum'):
+        CTmin_opt, B_opt = optimum(params, CTmin_grid, B_grid, meanWcontour)
+    print("optimal B and CTmin found")
+    with profile.stage('trajectory'):
+        sol = trajectory(params)
+    print("theoretical trajectory calculated.")
+    np.savez(f"{params['OUTDIR']}/{params['OUTNAME']}_analytical_info.npz",
+             CTmin_grid=CTmin_grid,
+             B_grid=B_grid,
+             W_contour=meanWcontour,
+             CTmin_opt=CTmin_opt,
+             B_opt=B_opt,
+             sol=sol)
+
+
+def predict(params):
+    '''
+    run all three stages for one set of parameters
+    '''
+    profile = stage_profile(params)
+    with profile.stage('landscape'):
+        meanWcontour = landscape(params)
+    print("contour made")
+    finish(params, meanWcontour, profile)
+
+
+if __name__ == '__main__':
+    predict(parse_params(sys.argv[1:]))
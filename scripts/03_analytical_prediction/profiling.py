@@ -0,0 +1,164 @@
+## Stage timing and work counts of predict.py, written to OUTDIR/OUTNAME_profile.json
+
+import contextlib
+import cProfile
+import json
+import os
+import platform
+import pstats
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+import tpc_functions_oo
+
+# Set TPC_PROFILE=cprofile to run each stage under cProfile (also saved as OUTNAME_profile_<stage>.prof, for pstats or snakeviz),
+# or TPC_PROFILE=sample to sample the stack every TPC_PROFILE_INTERVAL seconds (default 0.01), which slows the stages much less.
+# The functions taking the most time are listed in the profile either way.
+PROFILE_HOOK = os.environ.get('TPC_PROFILE', '')
+PROFILE_INTERVAL = float(os.environ.get('TPC_PROFILE_INTERVAL', 0.01))
+# while a stage runs, its time and counters so far are written every HEARTBEAT seconds (0 to only write between stages)
+HEARTBEAT = float(os.environ.get('TPC_PROFILE_HEARTBEAT', 60))
+# number of functions listed per stage
+TOP = 25
+
+
+class stage_sampler:
+    """
+    Sampling profiler: a background thread records the stack of the profiled thread every interval seconds.
+    top() lists the functions seen most often at the top of the stack, with the fraction of wall time spent in them
+    (own_fraction, in Python code and the compiled functions it calls) and in them and their callees (fraction).
+    """
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.inclusive = Counter()
+        self.own = Counter()
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.own[self._name(frame)] += 1
+            # count each function once per sample, even if it is recursive
+            seen = set()
+            while frame is not None:
+                seen.add(self._name(frame))
+                frame = frame.f_back
+            self.inclusive.update(seen)
+
+    def _name(self, frame):
+        code = frame.f_code
+        return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+    # same names as cProfile.Profile
+    def enable(self):
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+    def top(self, n=TOP):
+        total = max(self.samples, 1)
+        return [{'function': name, 'own_fraction': count / total, 'fraction': self.inclusive[name] / total}
+                for name, count in self.own.most_common(n)]
+
+
+class stage_profile:
+    """
+    Wall time and tpc_functions counters of each stage of predict.py, rewritten every heartbeat seconds during a stage
+    so that a job killed at its time limit still shows how far it got.
+    hook : 'cprofile', 'sample' or '' (default: the TPC_PROFILE environment variable)
+    """
+    def __init__(self, params, hook=PROFILE_HOOK, heartbeat=HEARTBEAT):
+        self.params = params
+        self.hook = hook
+        self.heartbeat = heartbeat
+        self._lock = threading.Lock()
+        self.path = f"{params['OUTDIR']}/{params['OUTNAME']}_profile.json"
+        self.record = {'OUTNAME': params['OUTNAME'],
+                       'params': {key: value for key, value in params.items() if isinstance(value, (str, int, float))},
+                       'host': platform.node(), 'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'hook': hook, 'running': None, 'stages': {}, 'counters': {}, 'seconds': 0.0}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        time the block as stage name, counting the tpc_functions work done in it
+        '''
+        counters_before = tpc_functions_oo.counters.copy()
+        start = time.perf_counter()
+        def progress():
+            return {'stage': name, 'seconds': time.perf_counter() - start,
+                    'counters': dict(tpc_functions_oo.counters - counters_before)}
+        self.record['running'] = progress()
+        self.write()
+        stop = threading.Event()
+        def beat():
+            while not stop.wait(self.heartbeat):
+                self.record['running'] = progress()
+                self.write()
+        heartbeat = threading.Thread(target=beat, daemon=True)
+        if self.heartbeat > 0:
+            heartbeat.start()
+        profiler = cProfile.Profile() if self.hook == 'cprofile' else stage_sampler() if self.hook == 'sample' else None
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            stop.set()
+            if self.heartbeat > 0:
+                heartbeat.join()
+            seconds = time.perf_counter() - start
+            counts = dict(tpc_functions_oo.counters - counters_before)
+            entry = {'seconds': seconds, 'counters': counts}
+            if self.hook == 'cprofile':
+                profiler.dump_stats(f"{self.params['OUTDIR']}/{self.params['OUTNAME']}_profile_{name}.prof")
+                entry['top'] = self._cprofile_top(profiler)
+            elif self.hook == 'sample':
+                entry['samples'] = profiler.samples
+                entry['top'] = profiler.top()
+            self.record['stages'][name] = entry
+            self.record['seconds'] += seconds
+            self.record['counters'] = dict(Counter(self.record['counters']) + Counter(counts))
+            self.record['running'] = None
+            self.write()
+            print(f"{name}: {seconds:.1f} s" + ''.join(f", {key} = {value}" for key, value in sorted(counts.items())))
+
+    def add_stage(self, name, seconds, counters, **details):
+        '''
+        record a stage timed elsewhere (e.g. split over other processes), with its counters and any other details
+        '''
+        self.record['stages'][name] = {'seconds': seconds, 'counters': dict(counters), **details}
+        self.record['seconds'] += seconds
+        self.record['counters'] = dict(Counter(self.record['counters']) + Counter(counters))
+        self.write()
+        print(f"{name}: {seconds:.1f} s" + ''.join(f", {key} = {value}" for key, value in sorted(counters.items())))
+
+    def _cprofile_top(self, profiler, n=TOP):
+        stats = pstats.Stats(profiler).stats
+        rows = sorted(stats.items(), key=lambda item: -item[1][3])[:n]
+        return [{'function': f"{os.path.basename(file)}:{line}({function})", 'calls': calls,
+                 'own_seconds': own_time, 'cumulative_seconds': cumulative_time}
+                for (file, line, function), (primitive_calls, calls, own_time, cumulative_time, callers) in rows]
+
+    def write(self):
+        '''
+        write the profile (under a temporary name, then renamed, so readers never see a partial file)
+        '''
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with self._lock:
+            descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(descriptor, 'w') as f:
+                json.dump(self.record, f, indent=1)
+            os.replace(temporary_path, self.path)
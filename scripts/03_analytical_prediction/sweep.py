@@ -0,0 +1,116 @@
+# Run the stages of predict.py (landscape, optimum, trajectory) for every row of a params_unique csv
+# in a local process pool, writing the same OUTDIR/OUTNAME_analytical_info.npz files as predict.py.
+# Each landscape is split into tiles x tiles grid tiles, so that a single large landscape is also shared across workers.
+# The landscape stage in each OUTNAME_profile.json spans its tiles (seconds from the first tile started to the last one finished,
+# worker_seconds summed over the tiles, and the counters of all tiles).
+# Usage: python sweep.py ../01_prepare_input_parameters/gaussian_params_unique.csv --workers 8 --engine analytic --outdir ../../data
+import argparse
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import predict
+import tpc_functions_oo
+
+# columns of the params csv passed to predict.py, in the order of its command line arguments (after RECOVERY and AVG_GEN_LEN)
+PARAM_COLUMNS = ['MEAN_TEMP', 'STDEV_TEMP', 'B_default', 'CTmin_default', 'B_critical', 'DeltaB',
+                 'CTmin_critical', 'DeltaCTmin', 'CTmax_critical', 'DeltaCTmax']
+# directory of master_WF.slim, which TEMPDATA_PATH of the params csv is relative to
+SLIM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'slim')
+
+parser = argparse.ArgumentParser()
+parser.add_argument("csv", help="params_unique csv, e.g. ../01_prepare_input_parameters/gaussian_params_unique.csv")
+parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+parser.add_argument("--avg-gen-len", type=int, default=10,
+                    help="average generation length (the analytical model cannot account for changing generation length)")
+parser.add_argument("--engine", default='quad', help="'quad', 'fixed' or 'analytic' (see tpc_functions.expected_w_TPC_recovery)")
+parser.add_argument("--landscape", default='full', help="'full' or 'adaptive' (see predict.adaptive_landscape)")
+parser.add_argument("--prune-eps", type=float, default=0,
+                    help="skip integrating cells where w_B * w_CTmin * w_CTmax < PRUNE_EPS (see tpc_functions.expected_w_TPC_recovery)")
+parser.add_argument("--store", default='',
+                    help="directory of a landscape store: landscapes found there are reused, and computed ones are added")
+parser.add_argument("--tiles", type=int, default=None,
+                    help="split each landscape into tiles x tiles grid tiles. Default: enough tiles to give every worker a task")
+parser.add_argument("--surrogate", action='store_true',
+                    help="solve the trajectories with a spline surrogate of the gradient, built with the 'analytic' engine "
+                         "(see scripts/README.md)")
+parser.add_argument("--outdir", default=None, help="write all outputs here instead of the OUTDIR column of the csv")
+
+
+def read_params(csv, avg_gen_len, engine, outdir=None, landscape='full', prune_eps=0, store='', surrogate=False):
+    '''
+    list of predict.py parameter dictionaries, one per row of the csv, converted the same way as predict.py's command line.
+    Rows with USE_EXTERNAL_TEMP_DATA = T use the temperature data at TEMPDATA_PATH (see predict.temperature_distribution).
+    '''
+    params_df = pd.read_csv(csv)
+    params_list = []
+    for _, row in params_df.iterrows():
+        argv = ([row['RECOVERY'], avg_gen_len] + [row[column] for column in PARAM_COLUMNS]
+                + [outdir if outdir is not None else row['OUTDIR'], row['OUTNAME'], engine, landscape, prune_eps, store])
+        external = str(row.get('USE_EXTERNAL_TEMP_DATA', 'F')) in ('T', 'True')
+        argv += [os.path.normpath(os.path.join(SLIM_DIR, row['TEMPDATA_PATH'])) if external else '', 'T' if surrogate else 'F']
+        params_list.append(predict.parse_params([str(value) for value in argv]))
+    return params_list
+
+
+def landscape_tile(params, CTmin_tile, B_tile):
+    '''
+    a tile of the landscape (see predict.landscape), with the times it started and finished and the tpc_functions counters of its work
+    '''
+    counters_before = tpc_functions_oo.counters.copy()
+    started = time.time()
+    tile = predict.landscape(params, CTmin_tile, B_tile, store=False)
+    return tile, started, time.time(), dict(tpc_functions_oo.counters - counters_before)
+
+
+def landscape_stage(results):
+    '''
+    landscape and profile stage (see stage_profile.add_stage) assembled from the landscape_tile results of a grid of tiles
+    '''
+    flat = [result for row in results for result in row]
+    counters = sum((Counter(result[3]) for result in flat), Counter())
+    stage = {'seconds': max(result[2] for result in flat) - min(result[1] for result in flat), 'counters': dict(counters),
+             'worker_seconds': sum(result[2] - result[1] for result in flat), 'tiles': len(flat)}
+    return np.block([[result[0] for result in row] for row in results]), stage
+
+
+def sweep(params_list, workers, tiles=None):
+    '''
+    compute the landscape tiles of all rows in a process pool, then the optimum and trajectory of each row once its landscape is done.
+    Landscapes found in the landscape store (if any) are not computed again, and the assembled landscapes are added to it.
+    '''
+    if tiles is None:
+        tiles = max(1, int(np.ceil(np.sqrt(workers / len(params_list)))))
+    CTmin_tiles = np.array_split(predict.CTmin_list, tiles)
+    B_tiles = np.array_split(predict.B_list, tiles)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        stored, lookup_seconds = [], []
+        for params in params_list:
+            start = time.perf_counter()
+            stored.append(predict.stored_landscape(params))
+            lookup_seconds.append(time.perf_counter() - start)
+        tile_futures = [[[pool.submit(landscape_tile, params, CTmin_tile, B_tile) for CTmin_tile in CTmin_tiles]
+                         for B_tile in B_tiles] if W is None else None
+                        for params, W in zip(params_list, stored)]
+        finish_futures = []
+        for params, futures, meanWcontour, seconds in zip(params_list, tile_futures, stored, lookup_seconds):
+            if meanWcontour is None:
+                meanWcontour, stage = landscape_stage([[future.result() for future in row] for row in futures])
+                predict.store_landscape(params, meanWcontour)
+                print(f"contour made for {params['OUTNAME']}")
+            else:
+                stage = {'seconds': seconds, 'counters': {}, 'from_store': True}
+                print(f"contour for {params['OUTNAME']} found in the landscape store")
+            finish_futures.append(pool.submit(predict.finish, params, meanWcontour, landscape_stage=stage))
+        for params, future in zip(params_list, finish_futures):
+            future.result()
+            print(f"saved {params['OUTDIR']}/{params['OUTNAME']}_analytical_info.npz")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    params_list = read_params(args.csv, args.avg_gen_len, args.engine, args.outdir, args.landscape, args.prune_eps, args.store,
+                              args.surrogate)
+    sweep(params_list, args.workers, args.tiles)
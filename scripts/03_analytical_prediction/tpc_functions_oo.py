@@ -1,18 +1,156 @@
 ## Define a TPC object for analysis
 
+import functools
+import hashlib
+import inspect
+import warnings
+from collections import Counter, OrderedDict
 import numpy as np
 from scipy import optimize
 import scipy
 from scipy.integrate import solve_ivp, quad, dblquad
 
+# largest temporary array (in bytes) of w_enzymatic and w_TPC, which evaluate long T arrays in chunks
+CHUNK_BYTES = 64 * 2 ** 20
+# bin width (degrees) of the temperature histograms made by temperature_histogram
+TEMP_BIN_WIDTH = 0.1
+
+# Work done by all tpc_functions objects in this process (quad calls, cells of the vectorized engines, ODE and optimizer
+# evaluations, surrogate grid points), reported per stage of predict.py by profiling.py
+counters = Counter()
+
+def _counted(integrand):
+    '''
+    wrap a quad integrand so that its evaluations are counted
+    '''
+    def wrapper(T):
+        counters['integrand_evaluations'] += 1
+        return integrand(T)
+    return wrapper
+
+def _quad(integrand, a, b):
+    '''
+    scipy.integrate.quad, counting the call and the integrand evaluations
+    '''
+    counters['quad_calls'] += 1
+    return quad(_counted(integrand), a, b)
+
+def _quad_vec(integrand, a, b, points=None):
+    '''
+    scipy.integrate.quad_vec, counting the call and the integrand evaluations.
+    The absolute tolerance is quad's default (quad_vec's is 1e-200, which makes it refine integrals close to zero,
+    such as the partials near the optimum, to many digits).
+    '''
+    counters['quad_calls'] += 1
+    return scipy.integrate.quad_vec(_counted(integrand), a, b, epsabs=1.49e-8, points=points)
+
+def _minimize(*args, **kwargs):
+    '''
+    scipy.optimize.minimize, counting the run, its iterations and its objective evaluations
+    '''
+    result = optimize.minimize(*args, **kwargs)
+    counters['optimizer_runs'] += 1
+    counters['optimizer_iterations'] += int(result.nit)
+    counters['optimizer_function_evaluations'] += int(result.nfev)
+    return result
+
+def _memoized(method):
+    '''
+    Decorator caching the output of a tpc_functions method when the object's cache is enabled (cache_size > 0).
+    Arguments are matched by name after filling in defaults, so positional and keyword calls share entries.
+    '''
+    signature = inspect.signature(method)
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.cache_size:
+            return method(self, *args, **kwargs)
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        key = (method.__name__,) + tuple(self._cache_key(value) for name, value in bound.arguments.items() if name != 'self')
+        return self._cache_lookup(key, lambda: method(self, *args, **kwargs))
+    return wrapper
+
+def _copy_output(output):
+    '''
+    copy arrays in a cached output (also inside tuples) so callers cannot modify the cached values
+    '''
+    if isinstance(output, tuple):
+        return tuple(_copy_output(item) for item in output)
+    return output.copy() if isinstance(output, np.ndarray) else output
+
+def temperature_histogram(sample=None, counts=None, edges=None, noise_sd=0, bin_width=TEMP_BIN_WIDTH, chunk_bytes=CHUNK_BYTES):
+    '''
+    empirical temperature distribution for expected_w_TPC_empirical and the other *_empirical methods of tpc_functions,
+    returned as (p, edges) like np.histogram: the probability of each of the bins between edges, all bin_width wide.
+    The *_empirical methods take the temperatures to be spread uniformly within each bin.
+    sample : temperatures, e.g. the T2M column of VT_weather.txt or sine.csv, or
+    counts, edges : a histogram of temperatures (such as the output of np.histogram), spread uniformly within each bin.
+    noise_sd : standard deviation of the normal noise added to the temperature of each individual (STDEV_TEMP in master_WF.slim).
+               The probabilities of the noisy temperatures are exact: the sample values (or the uniform bins of the histogram)
+               are convolved with the noise before binning.
+    '''
+    if sample is not None:
+        sample = np.asarray(sample, dtype=float).ravel()
+        sample = sample[np.isfinite(sample)]
+        lo, hi = sample.min(), sample.max()
+    elif counts is not None and edges is not None:
+        counts, edges = np.asarray(counts, dtype=float), np.asarray(edges, dtype=float)
+        lo, hi = edges[0], edges[-1]
+    else:
+        raise ValueError("give either a sample or the counts and edges of a histogram")
+    if noise_sd > 0:
+        lo, hi = lo - 6 * noise_sd, hi + 6 * noise_sd
+    first = np.floor(lo / bin_width)
+    n_bins = int(np.floor(hi / bin_width) - first) + 1
+    new_edges = (first + np.arange(n_bins + 1)) * bin_width
+    if noise_sd <= 0:
+        if sample is not None:
+            p = np.histogram(sample, new_edges)[0].astype(float)
+        else:
+            # the cumulative distribution is linear within each bin of the given histogram
+            p = np.diff(np.interp(new_edges, edges, np.concatenate([[0], np.cumsum(counts)])))
+        return p / p.sum(), new_edges
+
+    # cumulative distribution of the noisy temperature at the new edges, summed over the distinct sample values
+    # (or over the bins of the histogram) in chunks of edges
+    if sample is not None:
+        values, weights = np.unique(sample, return_counts=True)
+    else:
+        weights = counts
+    def psi(z):
+        # integral of the standard normal cdf
+        return z * scipy.special.ndtr(z) + scipy.stats.norm.pdf(z)
+    cumulative = np.zeros(len(new_edges))
+    chunk = max(1, chunk_bytes // (8 * len(weights)))
+    for start in range(0, len(new_edges), chunk):
+        e = new_edges[start:start + chunk, None]
+        if sample is not None:
+            cdf = scipy.special.ndtr((e - values) / noise_sd)
+        else:
+            # mean of the normal cdf over each bin [a, b]
+            a, b = edges[:-1], edges[1:]
+            cdf = noise_sd / (b - a) * (psi((e - a) / noise_sd) - psi((e - b) / noise_sd))
+        cumulative[start:start + chunk] = cdf @ weights
+    p = np.diff(cumulative)
+    return p / p.sum(), new_edges
+
 class tpc_functions:
     """
     object contatining functions related to thermal performance curve model of Min et al. 
     (incorporating enzymatic and physiological fitness components.)
     By default, B, CTmin, T (entry for w_TPC) is not an attribute.
     Parameters for the physiological constraints attributed and have default values.
+    cache_size : if > 0, keep the outputs of up to cache_size calls of the expected fitness functions and their derivatives,
+                 discarding the least recently used first (see cache_info). Off by default.
+    cache_decimals : if not None, round float inputs to this many decimals before looking them up in the cache,
+                     so that inputs closer than 10 ** -cache_decimals share an entry.
+    landscape_store : a landscape_store (see landscape_store.py). expected_w_TPC_recovery and _no_recovery then return stored
+                      landscapes instead of computing them, and store the landscapes they compute (grids with more than one cell only).
     """
-    def __init__(self, B_critical=40, Delta_B=2, CTmin_critical=0, Delta_CTmin=2, CTmax_critical=40, Delta_CTmax=0.2, num_days_per_gen=10):
+    _cache_attributes = ('B_critical', 'Delta_B', 'CTmin_critical', 'Delta_CTmin', 'CTmax_critical', 'Delta_CTmax', 'num_days_per_gen')
+
+    def __init__(self, B_critical=40, Delta_B=2, CTmin_critical=0, Delta_CTmin=2, CTmax_critical=40, Delta_CTmax=0.2, num_days_per_gen=10,
+                 cache_size=0, cache_decimals=None, landscape_store=None):
         self.B_critical= B_critical
         self.Delta_B = Delta_B
 
@@ -23,6 +161,106 @@ class tpc_functions:
         self.Delta_CTmax = Delta_CTmax
 
         self.num_days_per_gen = num_days_per_gen
+
+        self.cache_size = cache_size
+        self.cache_decimals = cache_decimals
+        self.clear_cache()
+
+        self.landscape_store = landscape_store
+
+    #######################################################################
+    # Caches of expected fitness evaluations (in memory, and landscapes on disk)
+
+    def clear_cache(self):
+        '''
+        empty the cache and reset its statistics
+        '''
+        self._cache = OrderedDict()
+        self._cache_state = None
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+    def cache_info(self):
+        '''
+        return a dictionary with the number of cache hits and misses, the number of stored entries (currsize) and maxsize.
+        '''
+        return {'hits': self._cache_hits, 'misses': self._cache_misses,
+                'currsize': len(self._cache), 'maxsize': self.cache_size}
+
+    def _cache_key(self, value):
+        '''
+        hashable key for an argument; numbers and arrays are keyed by their (optionally rounded) float values
+        '''
+        if value is None or isinstance(value, (str, bool)):
+            return value
+        array = np.asarray(value, dtype=float)
+        if self.cache_decimals is not None:
+            # adding 0.0 turns -0.0 into 0.0, so both round to the same key
+            array = np.round(array, self.cache_decimals) + 0.0
+        return (array.shape, array.tobytes())
+
+    def _cache_lookup(self, key, compute):
+        '''
+        return the cached output for key, or call compute() and store its output.
+        Entries are dropped when any physiological parameter (e.g. Delta_CTmax or num_days_per_gen) has changed since they were stored.
+        '''
+        state = tuple(getattr(self, name) for name in self._cache_attributes)
+        if state != self._cache_state:
+            self._cache.clear()
+            self._cache_state = state
+        if key in self._cache:
+            self._cache_hits += 1
+            self._cache.move_to_end(key)
+            return _copy_output(self._cache[key])
+        self._cache_misses += 1
+        output = compute()
+        self._cache[key] = _copy_output(output)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return output
+
+    def landscape_key(self, recovery, muT, sigmaT, CTmin, B, prune_eps=0, engine='quad', n_nodes=64):
+        '''
+        key of the landscape of expected w_TPC over the CTmin x B grid in a landscape_store.
+        Landscapes computed with different engines are kept apart, so a 'fixed' landscape is never returned for an 'analytic' or
+        'quad' one; n_nodes is only part of the key for 'fixed', the only engine whose accuracy depends on it.
+        '''
+        CTmin_array = np.array(CTmin, dtype=float, ndmin=1)
+        B_array = np.array(B, dtype=float, ndmin=1)
+        key = {name: float(getattr(self, name)) for name in self._cache_attributes}
+        key.update({'recovery': bool(recovery), 'muT': float(muT), 'sigmaT': float(sigmaT), 'prune_eps': float(prune_eps),
+                    'engine': engine, 'n_nodes': int(n_nodes) if engine == 'fixed' else None,
+                    'shape': [len(B_array), len(CTmin_array)],
+                    'grid': hashlib.sha1(CTmin_array.tobytes() + B_array.tobytes()).hexdigest()})
+        return key
+
+    def query_landscape(self, recovery, muT, sigmaT, CTmin, B, prune_eps=0, engine='quad', n_nodes=64):
+        '''
+        landscape of expected w_TPC over the CTmin x B grid (shape (len(B), len(CTmin))) from the landscape store,
+        interpolated in muT and sigmaT between stored landscapes if needed (see landscape_store.query), without computing anything.
+        '''
+        return self.landscape_store.query(self.landscape_key(recovery, muT, sigmaT, CTmin, B, prune_eps, engine, n_nodes))
+
+    def _stored_landscape(self, recovery, muT, sigmaT, CTmin_array, B_array, prune_eps, engine, n_nodes):
+        '''
+        stored landscape (a copy, not memory-mapped), or None if there is none, there is no store or the grid has a single cell
+        '''
+        if self.landscape_store is None or len(CTmin_array) * len(B_array) < 2:
+            return None
+        stored = self.landscape_store.get(self.landscape_key(recovery, muT, sigmaT, CTmin_array, B_array, prune_eps,
+                                                             engine, n_nodes))
+        return None if stored is None else np.array(stored)
+
+    def _store_landscape(self, W, recovery, muT, sigmaT, CTmin_array, B_array, prune_eps, engine, n_nodes):
+        '''
+        put a computed landscape in the landscape store, if there is one and the grid has more than one cell
+        '''
+        if self.landscape_store is not None and np.size(W) > 1:
+            self.landscape_store.put(self.landscape_key(recovery, muT, sigmaT, CTmin_array, B_array, prune_eps,
+                                                        engine, n_nodes), W)
+
+    #######################################################################
+    # Fitness components
     def w_B(self, B):
         '''
         w_B fitness component constraining B, for a given value(s) of B
@@ -41,86 +279,154 @@ class tpc_functions:
         '''
         return scipy.special.expit(-(CTmax - self.CTmax_critical) / self.Delta_CTmax)
 
-    def w_enzymatic(self, B, CTmin, T, squeeze=True):
+    def w_enzymatic(self, B, CTmin, T, squeeze=True, reduce=None, dtype=np.float64, out=None, chunk_bytes=CHUNK_BYTES):
         '''
-        enzymatic component with given array or a value of B, CTmin, T
+        enzymatic component with given array or a value of B, CTmin, T, on the B x CTmin x T grid (options as in w_TPC)
         '''
-        CTmin_array = np.array(CTmin, ndmin=1)
-        B_array = np.array(B, ndmin=1)
-        T_array = np.array(T, ndmin=1)
-
-        CTmin_grid, B_grid, T_grid = np.meshgrid(CTmin_array, B_array, T_array)
-        Topt_grid = CTmin_grid + 2 / 3 * B_grid
-
-        # Gaussian part of Deutsch et al. model
-        row_left = np.exp(-(3 * (T_grid - CTmin_grid - 2 / 3 * B_grid) / B_grid) ** 2)
-        
-        # Parabolic part
-        row_right = 1 - ((T_grid - CTmin_grid - 2 /3 * B_grid) / (1 / 3 * B_grid)) ** 2
-
-        # Apply conditions: w_enzymatic = row_left if T < Topt, = row_right if T > Topt
-        out = row_left * (T_grid <= Topt_grid) + row_right * (T_grid > Topt_grid)
-        # Also, w_enzymatic cannot be negative. Replace all negative values with zeros.
-        out = out * (out >= 0)
+        out = self._w_over_T(B, CTmin, T, physiological=False, reduce=reduce, dtype=dtype, out=out, chunk_bytes=chunk_bytes)
         return np.squeeze(out) if squeeze else out
 
-    def w_TPC(self, B, CTmin, T):
+    def w_TPC(self, B, CTmin, T, reduce=None, dtype=np.float64, out=None, chunk_bytes=CHUNK_BYTES):
         '''
-        w_TPC at a given arrary or a value o B, CTmin, and T.
+        w_TPC at a given arrary or a value o B, CTmin, and T, on the B x CTmin x T grid (squeezed), or its 'mean', 'sum' or 'prod' over T
+        with reduce. T is evaluated in chunks of about chunk_bytes, and the output can be written into out.
+        dtype=np.float32 halves the memory but has absolute errors up to 2e-4 (for small B), so it is for plotting only.
         '''
-        CTmin_array = np.array(CTmin, ndmin=1)
-        B_array = np.array(B, ndmin=1)
-        T_array = np.array(T, ndmin=1)
-        CTmin_grid, B_grid, T_grid = np.meshgrid(CTmin_array, B_array, T_array)
-        CTmax_grid = CTmin_grid + B_grid
+        out = self._w_over_T(B, CTmin, T, physiological=True, reduce=reduce, dtype=dtype, out=out, chunk_bytes=chunk_bytes)
+        return np.squeeze(out)
 
-        w_TPC = (self.w_enzymatic(CTmin=CTmin_array, B=B_array, T=T_array, squeeze=False)
-                * self.w_B(B_grid)
-                * self.w_CTmin(CTmin_grid)
-                * self.w_CTmax(CTmax_grid))
-        return np.squeeze(w_TPC)
+    def _w_over_T(self, B, CTmin, T, physiological, reduce, dtype, out, chunk_bytes):
+        '''
+        w_enzymatic (times w_B * w_CTmin * w_CTmax if physiological) on the B x CTmin x T grid, or reduced over T, one chunk of T at a time
+        '''
+        if reduce not in (None, 'mean', 'sum', 'prod'):
+            raise ValueError(f"unknown reduce {reduce!r}, use None, 'mean', 'sum' or 'prod'")
+        dtype = np.dtype(dtype)
+        B_array = np.array(B, dtype=dtype, ndmin=1).ravel()[:, None, None]
+        CTmin_array = np.array(CTmin, dtype=dtype, ndmin=1).ravel()[None, :, None]
+        T_array = np.array(T, dtype=dtype, ndmin=1).ravel()
+        shape = (B_array.shape[0], CTmin_array.shape[1])
+        out_shape = shape + (len(T_array),) if reduce is None else shape
+        if out is None:
+            out = np.empty(out_shape, dtype=dtype)
+        elif out.shape != out_shape or out.dtype != dtype:
+            raise ValueError(f"out must have shape {out_shape} and dtype {dtype}, not {out.shape} and {out.dtype}")
+        if reduce is not None:
+            out.fill(1 if reduce == 'prod' else 0)
+
+        Topt = CTmin_array + 2 / 3 * B_array
+        # u = (T - Topt) / (B / 3): w_enzymatic is exp(-u^2) for T <= Topt and 1 - u^2, but at least 0, for T > Topt
+        inverse_scale = 3 / B_array
+        prefactor = self._prefactor(CTmin_array, B_array).astype(dtype) if physiological else None
+        chunk = int(max(1, min(len(T_array), chunk_bytes // (dtype.itemsize * shape[0] * shape[1] or 1))))
+        parabolic_buffer = np.empty(shape + (chunk,), dtype=dtype)
+        parabolic_mask = np.empty(shape + (chunk,), dtype=bool)
+        w_buffer = np.empty(shape + (chunk,), dtype=dtype) if reduce is not None else None
+        for start in range(0, len(T_array), chunk):
+            T_chunk = T_array[start:start + chunk]
+            n = len(T_chunk)
+            w = out[..., start:start + n] if reduce is None else w_buffer[..., :n]
+            parabolic, mask = parabolic_buffer[..., :n], parabolic_mask[..., :n]
+            np.subtract(T_chunk, Topt, out=w)
+            # the branch is set by T > Topt (not u > 0), as in the original model, so it also holds for B < 0
+            np.greater(w, 0, out=mask)
+            np.multiply(w, inverse_scale, out=w)
+            np.square(w, out=w)
+            np.subtract(1, w, out=parabolic)
+            np.maximum(parabolic, 0, out=parabolic)
+            np.negative(w, out=w)
+            np.exp(w, out=w)
+            np.copyto(w, parabolic, where=mask)
+            if physiological:
+                np.multiply(w, prefactor, out=w)
+            if reduce == 'prod':
+                out *= w.prod(axis=-1)
+            elif reduce is not None:
+                out += w.sum(axis=-1)
+        if reduce == 'mean':
+            out /= len(T_array)
+        return out
 
-    def expected_w_TPC_recovery(self, B, CTmin, muT, sigmaT):
+    @_memoized
+    def expected_w_TPC_recovery(self, B, CTmin, muT, sigmaT, engine='quad', n_nodes=64, prune_eps=0, verbose=False):
         '''
         expected value of w_TPC for a given array or value of B, CTmin, muT (mean of normal distributed T), and sigmaT (standard deivation of T).
         Using recovery model. 
+        engine : 'quad' integrates each (CTmin, B) cell separately with scipy's adaptive quad.
+                 'fixed' uses Gauss-Legendre quadrature with n_nodes nodes on each branch of w_enzymatic ([CTmin, Topt] and [Topt, CTmax]),
+                 evaluated for the whole CTmin x B grid at once. The error comes from resolving the normal density
+                 on branches up to ~B long, so it depends on sigmaT: on the grid used in predict.py (B <= 40),
+                 the absolute error is < 1e-12 for sigmaT >= 1 with the default n_nodes=64, and ~1e-7 with n_nodes >= 32 / sigmaT.
+                 Differences from 'quad' (up to ~2e-7 on the same grid) are dominated by quad's own error around Topt.
+        prune_eps : skip the integration and return 0 where w_B * w_CTmin * w_CTmax < prune_eps (see _unpruned).
+        verbose : print how many cells were pruned
         '''
         CTmin_array = np.array(CTmin, ndmin=1)
         B_array = np.array(B, ndmin=1)
         CTmin_grid, B_grid = np.meshgrid(CTmin_array, B_array)
         CTmax_grid = CTmin_grid + B_grid
+        output = self._stored_landscape(True, muT, sigmaT, CTmin_array, B_array, prune_eps, engine, n_nodes)
+        if output is not None:
+            return np.squeeze(output)
+        keep = self._unpruned(CTmin_grid, B_grid, prune_eps, verbose)
 
-        output = np.zeros(CTmin_grid.shape)
-        for i in range(output.shape[0]):
-            for j in range(output.shape[1]):
-                CTmin = CTmin_grid[i,j]
-                B = B_grid[i,j]
-                CTmax = CTmax_grid[i,j]
-                fun = lambda T: self.w_TPC(B=B, CTmin=CTmin, T=T) * scipy.stats.norm.pdf(T, muT, sigmaT)
-                meanPn, err = scipy.integrate.quad(fun, CTmin, CTmax)
-                output[i,j] = meanPn
+        if engine == 'quad':
+            output = np.zeros(CTmin_grid.shape)
+            for i in range(output.shape[0]):
+                for j in range(output.shape[1]):
+                    if not keep[i,j]:
+                        continue
+                    CTmin = CTmin_grid[i,j]
+                    B = B_grid[i,j]
+                    CTmax = CTmax_grid[i,j]
+                    fun = lambda T: self.w_TPC(B=B, CTmin=CTmin, T=T) * scipy.stats.norm.pdf(T, muT, sigmaT)
+                    meanPn, err = _quad(fun, CTmin, CTmax)
+                    output[i,j] = meanPn
+        else:
+            output = np.zeros(CTmin_grid.shape)
+            output[keep] = self._expected_w_TPC_vectorized(CTmin=CTmin_grid[keep], B=B_grid[keep], muT=muT, sigmaT=sigmaT,
+                                                           engine=engine, n_nodes=n_nodes)
+        self._store_landscape(output, True, muT, sigmaT, CTmin_array, B_array, prune_eps, engine, n_nodes)
         return np.squeeze(output)
 
-    def optimize_expected_w_TPC_recovery(self, muT, sigmaT, CTmin0, B0):
+    def _unpruned(self, CTmin_grid, B_grid, prune_eps, verbose=False):
+        '''
+        mask of the cells of the landscape that have to be integrated: w_enzymatic <= 1 and the normal density integrates to <= 1,
+        so expected w_TPC <= w_B * w_CTmin * w_CTmax (and the no-recovery factor C <= 1), and cells where this bound is below
+        prune_eps can be set to 0 with an absolute error below prune_eps. prune_eps = 0 keeps every cell.
+        '''
+        keep = self._prefactor(CTmin_grid, B_grid) >= prune_eps
+        if verbose:
+            print(f"pruned {keep.size - np.count_nonzero(keep)} of {keep.size} cells with w_B * w_CTmin * w_CTmax < {prune_eps}")
+        return keep
+
+    def optimize_expected_w_TPC_recovery(self, muT, sigmaT, CTmin0, B0, engine='quad', use_jac=False):
         '''
         Given mean and standard deviation of temperature, return optimal B and CTmin, assuming that the temperature is normal-distributed.
         CTmin0 and B0 are initial guesses
+        engine selects how expected w_TPC is integrated (see expected_w_TPC_recovery)
+        use_jac : give L-BFGS-B the exact gradient (see _exact_grad_expected_w_TPC) instead of finite differences.
+                  The value and gradient then come from the 'analytic' engine if engine = 'quad'.
         '''
         # lower bound for B (small positive value)
         B_tiny = 1e-3
+        if use_jac:
+            return self._optimize_with_gradient(muT, sigmaT, [CTmin0, B0], recovery=True, engine=engine, B_tiny=B_tiny).x
         def objective(params):
             CTmin, B = params
-            expected_w_TPC_recovery = self.expected_w_TPC_recovery(B = B, CTmin = CTmin, muT = muT, sigmaT = sigmaT)
+            expected_w_TPC_recovery = self.expected_w_TPC_recovery(B = B, CTmin = CTmin, muT = muT, sigmaT = sigmaT, engine = engine)
             return -expected_w_TPC_recovery
         bnds = ((None, None), (B_tiny, None))
-        result = optimize.minimize(objective, [CTmin0, B0], method='L-BFGS-B', bounds = bnds)
+        result = _minimize(objective, [CTmin0, B0], method='L-BFGS-B', bounds = bnds)
         return result.x
 
-    def expected_w_TPC_no_recovery(self, muT, sigmaT, CTmin, B):
+    @_memoized
+    def expected_w_TPC_no_recovery(self, muT, sigmaT, CTmin, B, engine='quad', n_nodes=64, prune_eps=0, verbose=False):
         '''
         Expected TPC given mean and standard deviation of temperature, assuming reproductive output per day after heat damage is zero (no-recovery model).
         The expected value is derived in the SI of the manuscript. 
         In short, it involves calculating probability that the temperature stays under lethal limit for various number of days.
+        engine and n_nodes select the integration method, and prune_eps and verbose skip cells, as in expected_w_TPC_recovery.
         '''
         nr = self.num_days_per_gen 
 
@@ -129,36 +435,319 @@ class tpc_functions:
         
 
         CTmin_grid, B_grid = np.meshgrid(CTmin_array, B_array)
+        output = self._stored_landscape(False, muT, sigmaT, CTmin_array, B_array, prune_eps, engine, n_nodes)
+        if output is not None:
+            return output
+        keep = self._unpruned(CTmin_grid, B_grid, prune_eps, verbose)
         output = np.zeros(CTmin_grid.shape)
+        if engine != 'quad':
+            CTmin_kept, B_kept = CTmin_grid[keep], B_grid[keep]
+            integral = self._expected_w_TPC_vectorized(CTmin=CTmin_kept, B=B_kept, muT=muT, sigmaT=sigmaT,
+                                                       engine=engine, n_nodes=n_nodes)
+            r = scipy.stats.norm.cdf(CTmin_kept + B_kept, muT, sigmaT)
+            output[keep] = self._C_no_recovery(r) * integral
+            self._store_landscape(output, False, muT, sigmaT, CTmin_array, B_array, prune_eps, engine, n_nodes)
+            return output
+
         for i in range(output.shape[0]):
             for j in range(output.shape[1]):
+                if not keep[i,j]:
+                    continue
                 CTmin = CTmin_grid[i,j]
                 B = B_grid[i,j]
                 CTmax = CTmin + B
                 fun = lambda T: self.w_TPC(T=T, CTmin=CTmin, B=B) * scipy.stats.norm.pdf(T, muT, sigmaT)
-                integral, err = scipy.integrate.quad(fun, CTmin, CTmax)
+                integral, err = _quad(fun, CTmin, CTmax)
                 r = scipy.stats.norm.cdf(CTmax, muT, sigmaT)
                 if (1 - r) < np.finfo(np.float64).tiny:
                     C = 1
                 else:
                     C = (1 - nr * r ** (nr - 1) + (-1 + nr) * r ** nr) / (nr * (1 - r)) + r ** (nr - 1)
                 output[i,j] = C * integral
+        self._store_landscape(output, False, muT, sigmaT, CTmin_array, B_array, prune_eps, engine, n_nodes)
         return output
 
-    def optimize_expected_w_TPC_no_recovery(self, muT, sigmaT, CTmin0, B0):
+    def optimize_expected_w_TPC_no_recovery(self, muT, sigmaT, CTmin0, B0, engine='quad', use_jac=False):
         '''
         Find optimal CTmin and B that maximize expected w_TPC using no-recovery model.
         CTmin0 and B0 are initial guess
+        engine selects how expected w_TPC is integrated (see expected_w_TPC_recovery)
+        use_jac : give L-BFGS-B the exact gradient (see optimize_expected_w_TPC_recovery)
         '''
         B_tiny = 1e-3
+        if use_jac:
+            return self._optimize_with_gradient(muT, sigmaT, [CTmin0, B0], recovery=False, engine=engine, B_tiny=B_tiny).x
         def objective(params):
             CTmin, B = params
-            expected_w_TPC = self.expected_w_TPC_no_recovery(muT=muT, sigmaT=sigmaT, B=B, CTmin=CTmin)
+            expected_w_TPC = self.expected_w_TPC_no_recovery(muT=muT, sigmaT=sigmaT, B=B, CTmin=CTmin, engine=engine)
             return -expected_w_TPC
         bnds = ((None, None), (B_tiny, None))
-        results = optimize.minimize(objective, [CTmin0, B0], method='L-BFGS-B', bounds=bnds)
+        results = _minimize(objective, [CTmin0, B0], method='L-BFGS-B', bounds=bnds)
         return results.x
 
+    def _optimize_with_gradient(self, muT, sigmaT, x0, recovery, engine, B_tiny=1e-3, n_nodes=64):
+        '''
+        run L-BFGS-B from x0 = [CTmin0, B0] with the exact gradient of expected w_TPC and return scipy's OptimizeResult.
+        '''
+        engine = 'analytic' if engine == 'quad' else engine
+        def objective(params):
+            CTmin, B = params
+            value, grad = self._exact_grad_expected_w_TPC(muT=muT, sigmaT=sigmaT, CTmin=CTmin, B=B, recovery=recovery,
+                                                          engine=engine, n_nodes=n_nodes)
+            return -value, -np.array(grad)
+        bnds = ((None, None), (B_tiny, None))
+        return _minimize(objective, x0, jac=True, method='L-BFGS-B', bounds=bnds)
+
+    def multistart_optimize_expected_w_TPC(self, muT, sigmaT, recovery=True, starts=None, n_starts=8, engine='analytic', n_nodes=64):
+        '''
+        Find optimal CTmin and B without a landscape to start from.
+        All candidate starts are evaluated at once, and L-BFGS-B with the exact gradient is run from the n_starts best of them.
+        Returns [CTmin, B] of the best local optimum found.
+        starts : array of candidate (CTmin, B) pairs, shape (n, 2). By default a 24 x 24 grid with
+                 CTmin in [muT - 5 sigmaT - B_critical, muT + 5 sigmaT] and B in [1e-3, B_critical + 5 Delta_B],
+                 which holds every (CTmin, B) with a non-negligible expected w_TPC.
+        engine : 'analytic' or 'fixed' (see _branch_moments)
+        '''
+        if engine == 'quad':
+            raise ValueError("multistart_optimize_expected_w_TPC has no 'quad' engine, use 'analytic' or 'fixed'")
+        B_tiny = 1e-3
+        if starts is None:
+            CTmin_candidates = np.linspace(muT - 5 * sigmaT - self.B_critical, muT + 5 * sigmaT, 24)
+            B_candidates = np.linspace(B_tiny, self.B_critical + 5 * self.Delta_B, 24)
+            starts = np.stack([grid.ravel() for grid in np.meshgrid(CTmin_candidates, B_candidates)], axis=-1)
+        starts = np.array(starts, dtype=float, ndmin=2)
+        value, _ = self._exact_grad_expected_w_TPC(muT=muT, sigmaT=sigmaT, CTmin=starts[:, 0], B=starts[:, 1],
+                                                   recovery=recovery, engine=engine, n_nodes=n_nodes)
+        best = None
+        for i in np.argsort(-value)[:n_starts]:
+            result = self._optimize_with_gradient(muT, sigmaT, starts[i], recovery=recovery, engine=engine,
+                                                  B_tiny=B_tiny, n_nodes=n_nodes)
+            if best is None or result.fun < best.fun:
+                best = result
+        return best.x
+
+    #######################################################################
+    # Vectorized evaluation of expected fitness over a CTmin x B grid
+    def _prefactor(self, CTmin, B):
+        '''
+        product of the physiological components w_B * w_CTmin * w_CTmax, which doesn't depend on T.
+        CTmin and B can be arrays of any (broadcastable) shape.
+        '''
+        return self.w_B(B) * self.w_CTmin(CTmin) * self.w_CTmax(CTmin + B)
+
+    def _C_no_recovery(self, r, order=0):
+        '''
+        factor C in the no-recovery model, where r is the probability that the temperature of a day is below CTmax.
+        C = (1 - r) / nr * sum_{k=0}^{nr-2} (k + 1) r^k + r^(nr - 1), which is the same expression used in expected_w_TPC_no_recovery
+        written as a polynomial, so it has no cancellation error as r -> 1.
+        order = 1 or 2 returns dC/dr or d^2C/dr^2 instead (dC/dr = 1 / nr * sum_{k=0}^{nr-2} (k + 1) r^k).
+        '''
+        nr = int(self.num_days_per_gen)
+        r = np.asarray(r, dtype=float)
+        k = np.arange(nr - 1)
+        dC_dr_coefficients = (k + 1) / nr
+        if order == 2:
+            dC_dr_coefficients = (k * dC_dr_coefficients)[1:]
+        if len(dC_dr_coefficients) == 0:
+            S = np.zeros(r.shape)
+        else:
+            # polyval wants the coefficient of the highest power first
+            S = np.polyval(dC_dr_coefficients[::-1], r)
+        if order == 0:
+            return (1 - r) * S + r ** (nr - 1)
+        return S
+
+    def _normal_interval_moments(self, za, zb, jmax):
+        '''
+        J[j] = integral of z^j * phi(z) from za to zb (phi = standard normal density) for j = 0..jmax, using
+        J[0] = Phi(zb) - Phi(za), J[1] = phi(za) - phi(zb), J[j] = (j - 1) J[j-2] + za^(j-1) phi(za) - zb^(j-1) phi(zb)
+        '''
+        phi_a = scipy.stats.norm.pdf(za)
+        phi_b = scipy.stats.norm.pdf(zb)
+        J = np.zeros((jmax + 1,) + np.shape(za))
+        # take the difference of upper tails when both ends are above zero to avoid cancellation
+        J[0] = np.where(za > 0, scipy.special.ndtr(-za) - scipy.special.ndtr(-zb),
+                        scipy.special.ndtr(zb) - scipy.special.ndtr(za))
+        if jmax >= 1:
+            J[1] = phi_a - phi_b
+        for j in range(2, jmax + 1):
+            J[j] = (j - 1) * J[j - 2] + za ** (j - 1) * phi_a - zb ** (j - 1) * phi_b
+        return J
+
+    def _gauss_legendre_moments(self, a, b, Topt, s, muT, sigmaT, gaussian, kmax, n_nodes):
+        '''
+        Gauss-Legendre approximation of the integrals of u^k * p(T) (times exp(-u^2) if gaussian) over [a, b], k = 0..kmax.
+        All inputs are arrays of the same shape, and one node set on [-1, 1] is mapped onto each interval.
+        '''
+        x, w = np.polynomial.legendre.leggauss(n_nodes)
+        # empty intervals have zero length
+        half_length = np.maximum(b - a, 0)[..., None] / 2
+        T = a[..., None] + half_length * (x + 1)
+        u = (T - Topt[..., None]) / s[..., None]
+        f = w * half_length * scipy.stats.norm.pdf(T, muT[..., None], sigmaT[..., None])
+        if gaussian:
+            f = f * np.exp(-u ** 2)
+        moments = np.zeros((kmax + 1,) + np.shape(a))
+        for k in range(kmax + 1):
+            moments[k] = f.sum(axis=-1)
+            f = f * u
+        return moments
+
+    def _branch_moments(self, CTmin, B, muT, sigmaT, lo, hi, kmax=0, engine='fixed', n_nodes=64):
+        '''
+        Integrals of the two branches of w_enzymatic against the normal density p(T) = Norm(muT, sigmaT), restricted to [lo, hi].
+        With u = (T - Topt) / (B / 3), returns arrays G and H with a leading axis k = 0..kmax, where
+        G[k] = integral of u^k * exp(-u^2) * p(T) over T <= Topt (Gaussian branch) and
+        H[k] = integral of u^k * p(T) over Topt < T <= CTmax (parabolic branch).
+        w_enzymatic and its derivatives are polynomials in u on each branch, so they can all be built from these.
+        engine : 'fixed' uses Gauss-Legendre quadrature with n_nodes nodes on each branch.
+                 'analytic' uses closed forms. exp(-u^2) * p(T) is proportional to another normal density, so on both branches
+                 the integrals reduce to moments of a normal distribution over an interval (see _normal_interval_moments).
+                 The closed form cancels badly on the parabolic branch when sigmaT > B / 3. The branch is then narrower than
+                 sigmaT, and a 12-node Gauss-Legendre rule there is exact to rounding error, so that is used instead.
+        '''
+        CTmin, B, muT, sigmaT, lo, hi = np.broadcast_arrays(
+            *[np.asarray(x, dtype=float) for x in (CTmin, B, muT, sigmaT, lo, hi)])
+        counters['vectorized_cells'] += CTmin.size
+        Topt = CTmin + 2 / 3 * B
+        CTmax = CTmin + B
+        s = B / 3
+        # u^k * exp(-u^2) < 1e-24 below u = -8 (k <= 4), so the Gaussian branch starts there at the earliest. With 'fixed', nodes
+        # spread over all of [muT - 5 sigmaT, Topt] would miss the peak of exp(-u^2) when B << sigmaT.
+        branches = ((np.maximum(lo, Topt - 8 * s), np.minimum(hi, Topt), True),
+                    (np.maximum(lo, Topt), np.minimum(hi, CTmax), False))
+        if engine == 'fixed':
+            G, H = [self._gauss_legendre_moments(a, b, Topt, s, muT, sigmaT, gaussian, kmax, n_nodes)
+                    for a, b, gaussian in branches]
+        elif engine == 'analytic':
+            # exp(-u^2) = exp(-(T - Topt)^2 / (2 a^2)) with a = s / sqrt(2), and
+            # exp(-u^2) * Norm(T; muT, sigmaT) = K * Norm(T; m, tau)
+            a2 = s ** 2 / 2
+            var_sum = a2 + sigmaT ** 2
+            m = (Topt * sigmaT ** 2 + muT * a2) / var_sum
+            tau = np.sqrt(a2 / var_sum) * sigmaT
+            K = np.sqrt(a2 / var_sum) * np.exp(-(Topt - muT) ** 2 / (2 * var_sum))
+            G, H = [np.zeros((kmax + 1,) + CTmin.shape) for _ in branches]
+            for moments, (a, b, gaussian) in zip((G, H), branches):
+                b = np.maximum(a, b)
+                center, scale, factor = (m, tau, K) if gaussian else (muT, sigmaT, 1)
+                J = self._normal_interval_moments((a - center) / scale, (b - center) / scale, kmax)
+                # u = alpha + beta * z on this branch, where z is the standardized temperature
+                alpha = (center - Topt) / s
+                beta = scale / s
+                for k in range(kmax + 1):
+                    moments[k] = factor * sum(scipy.special.comb(k, j) * alpha ** (k - j) * beta ** j * J[j]
+                                              for j in range(k + 1))
+                # beta <= 1 / sqrt(2) on the Gaussian branch, so this only happens on the parabolic branch
+                narrow = beta > 1
+                if np.any(narrow):
+                    moments[:, narrow] = self._gauss_legendre_moments(
+                        a[narrow], b[narrow], Topt[narrow], s[narrow], muT[narrow], sigmaT[narrow],
+                        gaussian, kmax, n_nodes=12)
+        else:
+            raise ValueError(f"unknown engine {engine!r}, use 'quad', 'fixed' or 'analytic'")
+        return G, H
+
+    def _expected_w_TPC_vectorized(self, CTmin, B, muT, sigmaT, engine='fixed', n_nodes=64):
+        '''
+        integral of w_TPC * Norm(muT, sigmaT) over [CTmin, CTmax] for arrays CTmin, B of the same shape.
+        '''
+        G, H = self._branch_moments(CTmin=CTmin, B=B, muT=muT, sigmaT=sigmaT, lo=CTmin, hi=CTmin + B,
+                                    kmax=2, engine=engine, n_nodes=n_nodes)
+        # w_enzymatic = exp(-u^2) on the Gaussian branch and 1 - u^2 on the parabolic branch
+        return self._prefactor(CTmin, B) * (G[0] + H[0] - H[2])
+
+    def _prefactor_gradient(self, CTmin, B):
+        '''
+        partial derivatives of the prefactor w_B * w_CTmin * w_CTmax with respect to CTmin and B (product rule).
+        '''
+        CTmax = CTmin + B
+        dP_dCTmin = self.w_B(B) * (self.dw_CTmin_dCTmin(CTmin) * self.w_CTmax(CTmax)
+                                   + self.w_CTmin(CTmin) * self.dw_CTmax_dCTmin(CTmin=CTmin, B=B))
+        dP_dB = self.w_CTmin(CTmin) * (self.dw_B_dB(B) * self.w_CTmax(CTmax)
+                                       + self.w_B(B) * self.dw_CTmax_dB(CTmin=CTmin, B=B))
+        return dP_dCTmin, dP_dB
+
+    def _prefactor_hessian(self, CTmin, B):
+        '''
+        second partial derivatives of the prefactor w_B * w_CTmin * w_CTmax, returned as (d2/dCTmin2, d2/dCTmin dB, d2/dB2).
+        '''
+        CTmax = CTmin + B
+        w_B, w_CTmin, w_CTmax = self.w_B(B), self.w_CTmin(CTmin), self.w_CTmax(CTmax)
+        dw_B, dw_CTmin, dw_CTmax = self.dw_B_dB(B), self.dw_CTmin_dCTmin(CTmin), self.dw_CTmax_dCTmin(CTmin=CTmin, B=B)
+        d2w_B, d2w_CTmin, d2w_CTmax = self.d2w_B_dB2(B), self.d2w_CTmin_dCTmin2(CTmin), self.d2w_CTmax_dCTmax2(CTmax)
+        d2P_dCTmin2 = w_B * (d2w_CTmin * w_CTmax + 2 * dw_CTmin * dw_CTmax + w_CTmin * d2w_CTmax)
+        d2P_dCTmin_dB = (dw_B * (dw_CTmin * w_CTmax + w_CTmin * dw_CTmax)
+                         + w_B * (dw_CTmin * dw_CTmax + w_CTmin * d2w_CTmax))
+        d2P_dB2 = w_CTmin * (d2w_B * w_CTmax + 2 * dw_B * dw_CTmax + w_B * d2w_CTmax)
+        return d2P_dCTmin2, d2P_dCTmin_dB, d2P_dB2
+
+    def _dexpected_w_TPC_recovery_vectorized(self, muT, sigmaT, CTmin, B, engine='analytic', n_nodes=64):
+        '''
+        partial E[w_TPC] / partial CTmin and partial E[w_TPC] / partial B (recovery model) for arrays CTmin, B of the same shape,
+        i.e. dw_TPC integrated over [muT - 5 sigmaT, CTmax] as in dexpected_w_TPC_recovery_dCTmin and _dB.
+        '''
+        G, H = self._branch_moments(CTmin=CTmin, B=B, muT=muT, sigmaT=sigmaT, lo=muT - 5 * sigmaT, hi=CTmin + B,
+                                    kmax=2, engine=engine, n_nodes=n_nodes)
+        # w_enzymatic and its partial derivatives as polynomials in u (see dw_enzymatic_dCTmin, dw_enzymatic_dB)
+        W = G[0] + H[0] - H[2]
+        dW_dCTmin = 6 / B * (G[1] + H[1])
+        dW_dB = 2 / B * (G[2] + 2 * G[1] + H[2] + 2 * H[1])
+        P = self._prefactor(CTmin, B)
+        dP_dCTmin, dP_dB = self._prefactor_gradient(CTmin, B)
+        return dP_dCTmin * W + P * dW_dCTmin, dP_dB * W + P * dW_dB
+
+    def _grad_expected_w_TPC_recovery_quad(self, muT, sigmaT, CTmin, B):
+        '''
+        E[w_TPC] and its partials for a single (CTmin, B) using scipy's adaptive quadrature (recovery model).
+        The value (over [CTmin, CTmax]) and both partials (over [muT - 5 sigmaT, CTmax]) are integrated together with quad_vec,
+        so w_enzymatic is evaluated once per T; the two lower limits are passed to it as break points.
+        As with the other engines, an empty interval integrates to zero.
+        '''
+        CTmax = CTmin + B
+        lo = muT - sigmaT * 5
+        start = min(CTmin, lo)
+        if not start < CTmax:
+            return 0.0, 0.0, 0.0
+        P = self._prefactor(CTmin, B)
+        dP_dCTmin, dP_dB = self._prefactor_gradient(CTmin, B)
+        def integrand(T):
+            w_enzymatic = self.w_enzymatic(CTmin=CTmin, B=B, T=T)
+            return np.array([
+                w_enzymatic * P * (T >= CTmin),
+                (self.dw_enzymatic_dCTmin(CTmin=CTmin, B=B, T=T) * P + w_enzymatic * dP_dCTmin) * (T >= lo),
+                (self.dw_enzymatic_dB(CTmin=CTmin, B=B, T=T) * P + w_enzymatic * dP_dB) * (T >= lo)
+                ]) * scipy.stats.norm.pdf(T, loc=muT, scale=sigmaT)
+        points = [x for x in (CTmin, lo) if start < x < CTmax]
+        (value, dCTmin, dB), err = _quad_vec(integrand, start, CTmax, points=points or None)
+        return value, dCTmin, dB
+
+    def _exact_grad_expected_w_TPC(self, muT, sigmaT, CTmin, B, recovery=True, engine='analytic', n_nodes=64):
+        '''
+        expected w_TPC over [CTmin, CTmax] (the value of expected_w_TPC_recovery or _no_recovery) and its exact gradient
+        [d / dCTmin, d / dB], for arrays CTmin, B evaluated element-wise.
+        The dexpected_* partials integrate dw_TPC from muT - 5 sigmaT instead, so they are not exactly the gradient of this value.
+        Here the lower limit CTmin moves with CTmin, where w_enzymatic = exp(-4), which adds -P * exp(-4) * p(CTmin) to d / dCTmin.
+        (At the upper limit CTmax w_enzymatic is zero, so it adds nothing.)
+        '''
+        CTmin, B = np.broadcast_arrays(np.asarray(CTmin, dtype=float), np.asarray(B, dtype=float))
+        CTmax = CTmin + B
+        G, H = self._branch_moments(CTmin=CTmin, B=B, muT=muT, sigmaT=sigmaT, lo=CTmin, hi=CTmax,
+                                    kmax=2, engine=engine, n_nodes=n_nodes)
+        W = G[0] + H[0] - H[2]
+        dW = [6 / B * (G[1] + H[1]), 2 / B * (G[2] + 2 * G[1] + H[2] + 2 * H[1])]
+        P = self._prefactor(CTmin, B)
+        dP = self._prefactor_gradient(CTmin, B)
+        value = P * W
+        grad = [dP[i] * W + P * dW[i] for i in range(2)]
+        grad[0] = grad[0] - P * np.exp(-4) * scipy.stats.norm.pdf(CTmin, loc=muT, scale=sigmaT)
+        if not recovery:
+            r = scipy.stats.norm.cdf(CTmax, muT, sigmaT)
+            C = self._C_no_recovery(r)
+            dC = self._C_no_recovery(r, order=1) * scipy.stats.norm.pdf(CTmax, loc=muT, scale=sigmaT)
+            value, grad = C * value, [dC * value + C * grad[i] for i in range(2)]
+        return value, grad
+
     #######################################################################
     # Functions for numerically solving ivp
     # PARTIAL DERIVATIVES
@@ -186,6 +775,24 @@ class tpc_functions:
         CTmax = CTmin + B
         return -1 / self.Delta_CTmax * self.w_CTmax(CTmax) * (1 - self.w_CTmax(CTmax))
     
+    def d2w_B_dB2(self, B):
+        '''
+        return partial^2 w_B / partial B^2
+        '''
+        return 1 / self.Delta_B ** 2 * self.w_B(B) * (1 - self.w_B(B)) * (1 - 2 * self.w_B(B))
+
+    def d2w_CTmin_dCTmin2(self, CTmin):
+        '''
+        return partial^2 w_CTmin / partial CTmin^2
+        '''
+        return 1 / self.Delta_CTmin ** 2 * self.w_CTmin(CTmin) * (1 - self.w_CTmin(CTmin)) * (1 - 2 * self.w_CTmin(CTmin))
+
+    def d2w_CTmax_dCTmax2(self, CTmax):
+        '''
+        return partial^2 w_CTmax / partial CTmax^2 (same as the second derivative with respect to CTmin or B, or the mixed one)
+        '''
+        return 1 / self.Delta_CTmax ** 2 * self.w_CTmax(CTmax) * (1 - self.w_CTmax(CTmax)) * (1 - 2 * self.w_CTmax(CTmax))
+
     def dw_enzymatic_dB(self, CTmin, B, T):
         '''
         return partial w_enzymatic / partial B
@@ -237,22 +844,61 @@ class tpc_functions:
                 ) * self.w_B(B)
         return out
 
-    def dexpected_w_TPC_recovery_dB(self, muT, sigmaT, CTmin, B):
+    def d2w_TPC(self, CTmin, B, T):
+        '''
+        return the second partial derivatives of w_TPC with respect to (CTmin, B) at temperature T, as an array of shape (2, 2) + shape,
+        ordered [[d2/dCTmin2, d2/dCTmin dB], [d2/dB dCTmin, d2/dB2]]. CTmin, B, T are broadcast element-wise.
+        With u = (T - Topt) / (B / 3), w_enzymatic is exp(-u^2) below Topt and 1 - u^2 between Topt and CTmax, and
+        du/dCTmin = -3 / B, du/dB = -(u + 2) / B, d2u/dCTmin2 = 0, d2u/dCTmin dB = 3 / B^2, d2u/dB2 = 2 (u + 2) / B^2.
+        '''
+        CTmin, B, T = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (CTmin, B, T)])
+        u = 3 * (T - CTmin) / B - 2
+        gaussian = u <= 0
+        parabolic = (u > 0) & (u <= 1)
+        g = np.exp(-u ** 2)
+        du = [-3 / B, -(u + 2) / B]
+        d2u = [[0, 3 / B ** 2], [3 / B ** 2, 2 * (u + 2) / B ** 2]]
+        w_enzymatic = np.where(gaussian, g, np.where(parabolic, 1 - u ** 2, 0))
+        dw_enzymatic = [np.where(gaussian, -2 * u * du[i] * g, np.where(parabolic, -2 * u * du[i], 0)) for i in range(2)]
+        P = self._prefactor(CTmin, B)
+        dP = self._prefactor_gradient(CTmin, B)
+        d2P_dCTmin2, d2P_dCTmin_dB, d2P_dB2 = self._prefactor_hessian(CTmin, B)
+        d2P = [[d2P_dCTmin2, d2P_dCTmin_dB], [d2P_dCTmin_dB, d2P_dB2]]
+        out = np.zeros((2, 2) + CTmin.shape)
+        for i in range(2):
+            for j in range(2):
+                d2w_enzymatic = np.where(gaussian, g * ((4 * u ** 2 - 2) * du[i] * du[j] - 2 * u * d2u[i][j]),
+                                         np.where(parabolic, -2 * du[i] * du[j] - 2 * u * d2u[i][j], 0))
+                out[i, j] = (d2P[i][j] * w_enzymatic + dP[i] * dw_enzymatic[j] + dP[j] * dw_enzymatic[i]
+                             + P * d2w_enzymatic)
+        return out
+
+    @_memoized
+    def dexpected_w_TPC_recovery_dB(self, muT, sigmaT, CTmin, B, engine='quad', n_nodes=64):
         '''
         return partial E[w_TPC] / partial B, using recovery model.
         Simply integrate dw_TPC_dB over normal distribution p(T) = Norm(muT, sigmaT)
+        engine = 'fixed' or 'analytic' evaluates arrays of CTmin and B element-wise (see expected_w_TPC_recovery and _branch_moments).
         '''
+        if engine != 'quad':
+            return self.grad_expected_w_TPC(muT=muT, sigmaT=sigmaT, CTmin=CTmin, B=B, recovery=True,
+                                            engine=engine, n_nodes=n_nodes)[2]
         CTmax = CTmin + B
         def integrand(T):
             return self.dw_TPC_dB(T=T, CTmin=CTmin, B=B) * scipy.stats.norm.pdf(T, loc=muT, scale=sigmaT)
-        out = quad(integrand, muT-sigmaT * 5, CTmax)
+        out = _quad(integrand, muT-sigmaT * 5, CTmax)
         return out[0]
 
-    def dexpected_w_TPC_no_recovery_dB(self, muT, sigmaT, CTmin, B):
+    @_memoized
+    def dexpected_w_TPC_no_recovery_dB(self, muT, sigmaT, CTmin, B, engine='quad', n_nodes=64):
         '''
         return partial E[w_TPC] / partial B, using no-recovery model.
         Both C and E[w_TPC]_recovery depends on B, so output is  partial C / dB * E[w_TPC]_recovery + C * partial E[w_TPC]_recovery / partial dB.
+        engine = 'fixed' or 'analytic' evaluates arrays of CTmin and B element-wise (see expected_w_TPC_recovery and _branch_moments).
         '''
+        if engine != 'quad':
+            return self.grad_expected_w_TPC(muT=muT, sigmaT=sigmaT, CTmin=CTmin, B=B, recovery=False,
+                                            engine=engine, n_nodes=n_nodes)[2]
         CTmax = CTmin + B
         nr = self.num_days_per_gen
         r = scipy.stats.norm.cdf(CTmax, muT, sigmaT)
@@ -265,20 +911,30 @@ class tpc_functions:
         output = dC_dB * self.expected_w_TPC_recovery(CTmin=CTmin, B=B, muT=muT, sigmaT=sigmaT) + C * self.dexpected_w_TPC_recovery_dB(CTmin=CTmin, B=B, muT=muT, sigmaT=sigmaT)
         return output
 
-    def dexpected_w_TPC_recovery_dCTmin(self, muT, sigmaT, CTmin, B):
+    @_memoized
+    def dexpected_w_TPC_recovery_dCTmin(self, muT, sigmaT, CTmin, B, engine='quad', n_nodes=64):
         '''
         return partial E[w_TPC] / partial CTmin for recovery model 
+        engine = 'fixed' or 'analytic' evaluates arrays of CTmin and B element-wise (see expected_w_TPC_recovery and _branch_moments).
         '''
+        if engine != 'quad':
+            return self.grad_expected_w_TPC(muT=muT, sigmaT=sigmaT, CTmin=CTmin, B=B, recovery=True,
+                                            engine=engine, n_nodes=n_nodes)[1]
         CTmax = CTmin + B
         def integrand(T):
             return self.dw_TPC_dCTmin(T=T, CTmin=CTmin, B=B) * scipy.stats.norm.pdf(T, loc=muT, scale=sigmaT)
-        out = quad(integrand, muT - sigmaT * 5, CTmax)
+        out = _quad(integrand, muT - sigmaT * 5, CTmax)
         return out[0]
 
-    def dexpected_w_TPC_no_recovery_dCTmin(self, muT, sigmaT, CTmin, B):
+    @_memoized
+    def dexpected_w_TPC_no_recovery_dCTmin(self, muT, sigmaT, CTmin, B, engine='quad', n_nodes=64):
         '''
         return partial E[w_TPC] / partial CTmin for no recovery model.
+        engine = 'fixed' or 'analytic' evaluates arrays of CTmin and B element-wise (see expected_w_TPC_recovery and _branch_moments).
         '''
+        if engine != 'quad':
+            return self.grad_expected_w_TPC(muT=muT, sigmaT=sigmaT, CTmin=CTmin, B=B, recovery=False,
+                                            engine=engine, n_nodes=n_nodes)[1]
         CTmax = CTmin + B
         nr = self.num_days_per_gen
         r = scipy.stats.norm.cdf(CTmax, muT, sigmaT)
@@ -291,66 +947,458 @@ class tpc_functions:
         output = dC_dCTmin * self.expected_w_TPC_recovery(CTmin=CTmin, B=B, muT=muT, sigmaT=sigmaT) + C * self.dexpected_w_TPC_recovery_dCTmin(CTmin=CTmin, B=B, muT=muT, sigmaT=sigmaT)
         return output
 
-    def CTmin_B_traj_fixed_T(self, CTmin0, B0, T, t_end=1e9, method="BDF"):
+    @_memoized
+    def grad_expected_w_TPC(self, muT, sigmaT, CTmin, B, recovery=True, engine='analytic', n_nodes=64):
+        '''
+        return (E[w_TPC], partial E[w_TPC] / partial CTmin, partial E[w_TPC] / partial B) for arrays of CTmin and B,
+        evaluated element-wise (CTmin and B are broadcast against each other, not meshed as in expected_w_TPC_recovery).
+        The value is expected_w_TPC_recovery or expected_w_TPC_no_recovery, and the partials are the same as
+        dexpected_w_TPC_(no_)recovery_dCTmin and _dB, but all three share the integrals over T and the no-recovery factors r and C.
+        recovery : use recovery model if True, no-recovery model if False.
+        engine : 'analytic', 'fixed' or 'quad' (see expected_w_TPC_recovery).
+        '''
+        CTmin, B = np.broadcast_arrays(np.asarray(CTmin, dtype=float), np.asarray(B, dtype=float))
+        CTmax = CTmin + B
+        if engine == 'quad':
+            value, dCTmin, dB = [np.zeros(CTmin.shape) for _ in range(3)]
+            for idx in np.ndindex(CTmin.shape):
+                value[idx], dCTmin[idx], dB[idx] = self._grad_expected_w_TPC_recovery_quad(
+                    muT=muT, sigmaT=sigmaT, CTmin=CTmin[idx], B=B[idx])
+        else:
+            value = self._expected_w_TPC_vectorized(CTmin=CTmin, B=B, muT=muT, sigmaT=sigmaT,
+                                                    engine=engine, n_nodes=n_nodes)
+            dCTmin, dB = self._dexpected_w_TPC_recovery_vectorized(muT=muT, sigmaT=sigmaT, CTmin=CTmin, B=B,
+                                                                   engine=engine, n_nodes=n_nodes)
+        if not recovery:
+            # no-recovery model: C * E[w_TPC]_recovery, where C depends on CTmin and B through r = P(T < CTmax),
+            # and dr/dCTmin = dr/dB = p(CTmax)
+            r = scipy.stats.norm.cdf(CTmax, muT, sigmaT)
+            C = self._C_no_recovery(r)
+            dC = self._C_no_recovery(r, order=1) * scipy.stats.norm.pdf(CTmax, loc=muT, scale=sigmaT)
+            value, dCTmin, dB = C * value, dC * value + C * dCTmin, dC * value + C * dB
+        return value, dCTmin, dB
+
+    @_memoized
+    def hess_expected_w_TPC(self, muT, sigmaT, CTmin, B, recovery=True, engine='analytic', n_nodes=64):
+        '''
+        return the Jacobian of the partials (dCTmin, dB) from grad_expected_w_TPC with respect to (CTmin, B), i.e. the second derivatives
+        of expected fitness, as an array of shape (2, 2) + shape, ordered [[d dCTmin / dCTmin, d dCTmin / dB], [d dB / dCTmin, d dB / dB]].
+        CTmin and B are evaluated element-wise. This is the Jacobian of the trajectory ODEs.
+        engine : 'analytic' or 'fixed' (see _branch_moments).
+        '''
+        if engine == 'quad':
+            raise ValueError("hess_expected_w_TPC has no 'quad' engine, use 'analytic' or 'fixed'")
+        CTmin, B = np.broadcast_arrays(np.asarray(CTmin, dtype=float), np.asarray(B, dtype=float))
+        CTmax = CTmin + B
+        lo = muT - 5 * sigmaT
+        G, H = self._branch_moments(CTmin=CTmin, B=B, muT=muT, sigmaT=sigmaT, lo=lo, hi=CTmax,
+                                    kmax=4, engine=engine, n_nodes=n_nodes)
+        # integrals of w_enzymatic and its first and second partial derivatives (polynomials in u, see d2w_TPC)
+        W = G[0] + H[0] - H[2]
+        dW = [6 / B * (G[1] + H[1]), 2 / B * (G[2] + 2 * G[1] + H[2] + 2 * H[1])]
+        d2W_dCTmin2 = (9 * (4 * G[2] - 2 * G[0]) - 18 * H[0]) / B ** 2
+        d2W_dCTmin_dB = (3 * (4 * G[3] + 8 * G[2] - 4 * G[1] - 4 * G[0]) - 12 * (H[1] + H[0])) / B ** 2
+        d2W_dB2 = (4 * G[4] + 16 * G[3] + 10 * G[2] - 16 * G[1] - 8 * G[0] - (6 * H[2] + 16 * H[1] + 8 * H[0])) / B ** 2
+        d2W = [[d2W_dCTmin2, d2W_dCTmin_dB], [d2W_dCTmin_dB, d2W_dB2]]
+        P = self._prefactor(CTmin, B)
+        dP = self._prefactor_gradient(CTmin, B)
+        d2P_dCTmin2, d2P_dCTmin_dB, d2P_dB2 = self._prefactor_hessian(CTmin, B)
+        d2P = [[d2P_dCTmin2, d2P_dCTmin_dB], [d2P_dCTmin_dB, d2P_dB2]]
+        p_CTmax = scipy.stats.norm.pdf(CTmax, loc=muT, scale=sigmaT)
+        # the upper limit CTmax moves with both CTmin and B, and the integrand there is P * 6 / B * p(CTmax)
+        boundary = np.where(lo < CTmax, 6 * P / B * p_CTmax, 0)
+        hess = np.zeros((2, 2) + CTmin.shape)
+        for i in range(2):
+            for j in range(2):
+                hess[i, j] = d2P[i][j] * W + dP[i] * dW[j] + dP[j] * dW[i] + P * d2W[i][j] + boundary
+        if recovery:
+            return hess
+
+        # no-recovery model: the partials are dC * E + C * grad, where E = E[w_TPC]_recovery integrated over [CTmin, CTmax],
+        # C = C(r), r = P(T < CTmax) and dr/dCTmin = dr/dB = p(CTmax)
+        grad = [dP[i] * W + P * dW[i] for i in range(2)]
+        E, dE = self._exact_grad_expected_w_TPC(muT=muT, sigmaT=sigmaT, CTmin=CTmin, B=B, recovery=True,
+                                                engine=engine, n_nodes=n_nodes)
+        r = scipy.stats.norm.cdf(CTmax, muT, sigmaT)
+        C, dC_dr, d2C_dr2 = [self._C_no_recovery(r, order=order) for order in range(3)]
+        dp_CTmax = -(CTmax - muT) / sigmaT ** 2 * p_CTmax
+        for i in range(2):
+            for j in range(2):
+                hess[i, j] = ((d2C_dr2 * p_CTmax ** 2 + dC_dr * dp_CTmax) * E
+                              + dC_dr * p_CTmax * (dE[j] + grad[i]) + C * hess[i, j])
+        return hess
+
+    def _solve_trajectory(self, ode, jacobian, CTmin0, B0, t_end, method, use_jac, verbose):
+        '''
+        solve the trajectory ODE with solve_ivp, passing the analytic Jacobian if use_jac (only implicit methods use it),
+        and print the number of right-hand side and Jacobian evaluations if verbose. The evaluations are also added to counters.
+        '''
+        options = {'jac': jacobian} if use_jac and method in ('BDF', 'Radau', 'LSODA') else {}
+        sol = solve_ivp(ode, [0, t_end], [CTmin0, B0], method=method, dense_output=True, **options)
+        counters['ode_solves'] += 1
+        counters['ode_rhs_evaluations'] += int(sol.nfev)
+        counters['ode_jacobian_evaluations'] += int(sol.njev)
+        counters['ode_lu_decompositions'] += int(sol.nlu)
+        if verbose:
+            print(f"{method} solver: nfev = {sol.nfev}, njev = {sol.njev}, nlu = {sol.nlu}, status = {sol.status}")
+        return sol
+
+    def CTmin_B_traj_fixed_T(self, CTmin0, B0, T, t_end=1e9, method="BDF", use_jac=False, verbose=False):
         '''
         Using scipy's solve_ivp, find the theoretical trajectory of CTmin and B, where initial states are CTmin0, B0.
         Solving for fixed temperature case.
+        use_jac : pass d2w_TPC as the Jacobian instead of letting the solver estimate it by finite differences.
+                  Off by default: the right-hand side jumps where T crosses CTmax, and an exact Jacobian on either side of
+                  the jump makes BDF's Newton iterations fail repeatedly there.
+        verbose : print the number of right-hand side (nfev) and Jacobian (njev) evaluations
         '''
         def ode(t, z):
             CTmin, B = z
             x = self.dw_TPC_dCTmin(CTmin=CTmin, B=B, T=T)
             y = self.dw_TPC_dB(CTmin=CTmin, B=B, T=T)
             return [x,y]
-        sol = solve_ivp(ode, [0, t_end], [CTmin0, B0], method=method, dense_output=True)
-        return sol
+        def jacobian(t, z):
+            CTmin, B = z
+            return self.d2w_TPC(CTmin=CTmin, B=B, T=T)
+        return self._solve_trajectory(ode, jacobian, CTmin0, B0, t_end=t_end, method=method,
+                                      use_jac=use_jac, verbose=verbose)
 
-    def expected_CTmin_B_traj_recovery(self, CTmin0, B0, muT, sigmaT, t_end=1e9, method="BDF"):
+    def expected_CTmin_B_traj_recovery(self, CTmin0, B0, muT, sigmaT, t_end=1e9, method="BDF", engine='quad',
+                                       use_jac=False, verbose=False, surrogate=None):
         '''
         Numerical solution to the ODE describing expected trajectory of mean CTmin, B, using recovery model.
         CTmin0 : initial value of CTmin
         B0 : initial value of B
+        engine : how the partial derivatives are integrated (see dexpected_w_TPC_recovery_dB)
+        use_jac : pass hess_expected_w_TPC as the Jacobian. It only steers the solver's Newton iterations,
+                  so the closed form is used for it even if engine = 'quad'.
+                  Off by default: with BDF it saves no right-hand side evaluations, and for some muT and sigmaT
+                  (e.g. 20 and 3 with recovery) it takes two to four times as many.
+        verbose : print the number of right-hand side (nfev) and Jacobian (njev) evaluations
+        surrogate : take the right-hand side and Jacobian from a gradient_surrogate where it covers the state: True to build one
+                    with engine, 'analytic' or 'fixed' to build it with that engine (needed with 'quad'), or one built before
         '''
         def ode(t, z):
             CTmin, B = z
-            x = self.dexpected_w_TPC_recovery_dCTmin(
+            _, x, y = self.grad_expected_w_TPC(
                         muT=muT,
                         sigmaT=sigmaT,
                         CTmin=CTmin,
-                        B=B
-                    )
-            y = self.dexpected_w_TPC_recovery_dB(
-                        muT=muT,
-                        sigmaT=sigmaT,
-                        CTmin=CTmin,
-                        B=B
+                        B=B,
+                        recovery=True,
+                        engine=engine
                     )
             return [x,y]
-        sol = solve_ivp(ode, [0, t_end], [CTmin0, B0], method=method, dense_output=True)
-        return sol
+        def jacobian(t, z):
+            CTmin, B = z
+            return self.hess_expected_w_TPC(muT=muT, sigmaT=sigmaT, CTmin=CTmin, B=B, recovery=True,
+                                            engine='analytic' if engine == 'quad' else engine)
+        if surrogate is True or isinstance(surrogate, str):
+            surrogate = self.gradient_surrogate_expected_w_TPC(muT=muT, sigmaT=sigmaT, recovery=True, CTmin0=CTmin0, B0=B0,
+                                                               engine=engine if surrogate is True else surrogate,
+                                                               verbose=verbose)
+        ode, jacobian = self._with_surrogate(surrogate, ode, jacobian if use_jac else None)
+        return self._solve_trajectory(ode, jacobian, CTmin0, B0, t_end=t_end, method=method,
+                                      use_jac=use_jac or bool(surrogate), verbose=verbose)
 
-    def expected_CTmin_B_traj_no_recovery(self, CTmin0, B0, muT, sigmaT, t_end=1e9, method='BDF'):
+    def expected_CTmin_B_traj_no_recovery(self, CTmin0, B0, muT, sigmaT, t_end=1e9, method='BDF', engine='quad',
+                                          use_jac=False, verbose=False, surrogate=None):
         '''
         Numerical solution to the ODE describing the expected trajectory of mean CTmin, B, using no recovery model.
         CTmin0 : initial value of CTmin
         B0 : initial value of B
+        engine : how the partial derivatives are integrated (see dexpected_w_TPC_recovery_dB)
+        use_jac : pass hess_expected_w_TPC as the Jacobian (closed form, see expected_CTmin_B_traj_recovery)
+        verbose : print the number of right-hand side (nfev) and Jacobian (njev) evaluations
+        surrogate : True, 'analytic', 'fixed' or a gradient_surrogate, to take the right-hand side and Jacobian from a surrogate
+                    (see expected_CTmin_B_traj_recovery)
         '''
         def ode(t, z):
             CTmin, B = z
-            x = self.dexpected_w_TPC_no_recovery_dCTmin(
-                        muT=muT,
-                        sigmaT=sigmaT,
-                        CTmin=CTmin,
-                        B=B
-                    )
-            y = self.dexpected_w_TPC_no_recovery_dB(
+            _, x, y = self.grad_expected_w_TPC(
                         muT=muT,
                         sigmaT=sigmaT,
                         CTmin=CTmin,
-                        B=B
+                        B=B,
+                        recovery=False,
+                        engine=engine
                     )
             return [x,y]
-        sol = solve_ivp(ode, [0, t_end], [CTmin0, B0], method=method, dense_output=True)
-        return sol
+        def jacobian(t, z):
+            CTmin, B = z
+            return self.hess_expected_w_TPC(muT=muT, sigmaT=sigmaT, CTmin=CTmin, B=B, recovery=False,
+                                            engine='analytic' if engine == 'quad' else engine)
+        if surrogate is True or isinstance(surrogate, str):
+            surrogate = self.gradient_surrogate_expected_w_TPC(muT=muT, sigmaT=sigmaT, recovery=False, CTmin0=CTmin0, B0=B0,
+                                                               engine=engine if surrogate is True else surrogate,
+                                                               verbose=verbose)
+        ode, jacobian = self._with_surrogate(surrogate, ode, jacobian if use_jac else None)
+        return self._solve_trajectory(ode, jacobian, CTmin0, B0, t_end=t_end, method=method,
+                                      use_jac=use_jac or bool(surrogate), verbose=verbose)
+
+    #######################################################################
+    # Expected fitness under an empirical temperature distribution (p, edges) from temperature_histogram,
+    # as sums over its bins instead of integrals against a normal density
+    def _binned_sums(self, p, edges, CTmin, B, gradient=False, chunk_bytes=CHUNK_BYTES):
+        '''
+        sums over the bins of a temperature histogram for arrays CTmin, B of the same shape, with the temperatures spread uniformly
+        within each bin: W = sum of p * (mean of w_enzymatic over the part of the bin within [CTmin, CTmax]), and, if gradient,
+        the partial derivatives of the same sum over all temperatures with respect to CTmin and B (the lower limit CTmin is dropped
+        as in the dexpected_* partials). Returns an array of shape (1 or 3,) + shape.
+        With u = (T - Topt) / (B / 3), the integral of w_enzymatic over a bin is B / 3 * (F(u_upper) - F(u_lower)), where
+        F(u) = sqrt(pi) / 2 * erf(u) on the Gaussian branch (u <= 0) and u - u^3 / 3 on the parabolic branch, so the sums are exact
+        however narrow the TPC is compared to the bins.
+        Cells are evaluated in chunks, so that each temporary array takes at most about chunk_bytes.
+        '''
+        CTmin, B = np.broadcast_arrays(np.asarray(CTmin, dtype=float), np.asarray(B, dtype=float))
+        shape = CTmin.shape
+        CTmin, B = CTmin.ravel(), B.ravel()
+        counters['vectorized_cells'] += CTmin.size
+        p, edges = np.asarray(p, dtype=float), np.asarray(edges, dtype=float)
+        p_per_degree = p / np.diff(edges)
+        def F(u):
+            parabolic = np.clip(u, 0, 1)
+            return np.sqrt(np.pi) / 2 * scipy.special.erf(np.minimum(u, 0)) + parabolic - parabolic ** 3 / 3
+        sums = np.zeros((3 if gradient else 1, CTmin.size))
+        chunk = max(1, chunk_bytes // (8 * len(edges)))
+        for start in range(0, CTmin.size, chunk):
+            cells = slice(start, start + chunk)
+            B_chunk = B[cells, None]
+            u = 3 * (edges - CTmin[cells, None]) / B_chunk - 2
+            # u = -2 at CTmin
+            sums[0, cells] = B[cells] / 3 * (np.diff(F(np.maximum(u, -2)), axis=-1) @ p_per_degree)
+            if gradient:
+                # d/dCTmin and d/dB of B / 3 * (F(u_upper) - F(u_lower)), with du / dCTmin = -3 / B, du / dB = -(u + 2) / B
+                w = np.where(u > 0, np.maximum(1 - u ** 2, 0), np.exp(-u ** 2))
+                sums[1, cells] = -(np.diff(w, axis=-1) @ p_per_degree)
+                sums[2, cells] = (np.diff(F(u) - w * (u + 2), axis=-1) @ p_per_degree) / 3
+        return sums.reshape((-1,) + shape)
 
+    def _empirical_cdf(self, p, edges, x):
+        '''
+        probability that the temperature is below x, and the density at x, for temperatures spread uniformly within each bin
+        '''
+        cumulative = np.concatenate([[0], np.cumsum(p)])
+        r = np.interp(x, edges, cumulative)
+        i = np.searchsorted(edges, x, side='right') - 1
+        inside = (i >= 0) & (i < len(p))
+        density = np.where(inside, np.asarray(p)[np.clip(i, 0, len(p) - 1)] / np.diff(edges)[np.clip(i, 0, len(p) - 1)], 0)
+        return r, density
 
-    
+    @_memoized
+    def expected_w_TPC_empirical(self, p, edges, CTmin, B, recovery=True, prune_eps=0, verbose=False):
+        '''
+        expected w_TPC over the CTmin x B grid (as expected_w_TPC_recovery, or expected_w_TPC_no_recovery if not recovery)
+        when the temperature follows the empirical distribution (p, edges) from temperature_histogram instead of a normal distribution.
+        As in the normal case, the temperatures of different days are independent.
+        prune_eps and verbose skip cells as in expected_w_TPC_recovery.
+        '''
+        CTmin_grid, B_grid = np.meshgrid(np.array(CTmin, dtype=float, ndmin=1), np.array(B, dtype=float, ndmin=1))
+        keep = self._unpruned(CTmin_grid, B_grid, prune_eps, verbose)
+        CTmin_kept, B_kept = CTmin_grid[keep], B_grid[keep]
+        output = np.zeros(CTmin_grid.shape)
+        output[keep] = self._prefactor(CTmin_kept, B_kept) * self._binned_sums(p, edges, CTmin_kept, B_kept)[0]
+        if not recovery:
+            r, _ = self._empirical_cdf(p, edges, CTmin_kept + B_kept)
+            output[keep] = self._C_no_recovery(r) * output[keep]
+        return np.squeeze(output)
+
+    @_memoized
+    def grad_expected_w_TPC_empirical(self, p, edges, CTmin, B, recovery=True):
+        '''
+        return (E[w_TPC], partial E[w_TPC] / partial CTmin, partial E[w_TPC] / partial B) under the empirical temperature distribution
+        (p, edges), for arrays of CTmin and B evaluated element-wise, as grad_expected_w_TPC does for a normal distribution.
+        '''
+        CTmin, B = np.broadcast_arrays(np.asarray(CTmin, dtype=float), np.asarray(B, dtype=float))
+        W, dW_dCTmin, dW_dB = self._binned_sums(p, edges, CTmin, B, gradient=True)
+        P = self._prefactor(CTmin, B)
+        dP_dCTmin, dP_dB = self._prefactor_gradient(CTmin, B)
+        value, dCTmin, dB = P * W, dP_dCTmin * W + P * dW_dCTmin, dP_dB * W + P * dW_dB
+        if not recovery:
+            # dr/dCTmin = dr/dB = density at CTmax, as in grad_expected_w_TPC
+            r, density = self._empirical_cdf(p, edges, CTmin + B)
+            C = self._C_no_recovery(r)
+            dC = self._C_no_recovery(r, order=1) * density
+            value, dCTmin, dB = C * value, dC * value + C * dCTmin, dC * value + C * dB
+        return value, dCTmin, dB
+
+    def optimize_expected_w_TPC_empirical(self, p, edges, CTmin0, B0, recovery=True):
+        '''
+        Find optimal CTmin and B that maximize expected w_TPC under the empirical temperature distribution (p, edges).
+        CTmin0 and B0 are initial guesses
+        '''
+        B_tiny = 1e-3
+        def objective(params):
+            CTmin, B = params
+            return -self.expected_w_TPC_empirical(p=p, edges=edges, CTmin=CTmin, B=B, recovery=recovery)
+        bnds = ((None, None), (B_tiny, None))
+        return _minimize(objective, [CTmin0, B0], method='L-BFGS-B', bounds=bnds).x
+
+    def expected_CTmin_B_traj_empirical(self, CTmin0, B0, p, edges, recovery=True, t_end=1e9, method='BDF', verbose=False):
+        '''
+        Numerical solution to the ODE describing the expected trajectory of mean CTmin, B under the empirical temperature
+        distribution (p, edges), using the recovery model if recovery, and the no-recovery model otherwise.
+        The solver estimates the Jacobian by finite differences.
+        verbose : print the number of right-hand side (nfev) and Jacobian (njev) evaluations
+        '''
+        def ode(t, z):
+            CTmin, B = z
+            _, x, y = self.grad_expected_w_TPC_empirical(p=p, edges=edges, CTmin=CTmin, B=B, recovery=recovery)
+            return [x, y]
+        return self._solve_trajectory(ode, None, CTmin0, B0, t_end=t_end, method=method, use_jac=False, verbose=verbose)
+
+    #######################################################################
+    # Spline surrogates of the gradient field, for the right-hand side of the trajectory ODEs
+    def _surrogate_box(self, muT, sigmaT, CTmin0, B0):
+        '''
+        default CTmin and B ranges of a gradient_surrogate: those of multistart_optimize_expected_w_TPC, extended to the initial
+        state. B starts at 1 (or B0 if smaller), since the partials change steeply as B goes to 0.
+        '''
+        CTmin_range = (min(muT - 5 * sigmaT - self.B_critical, CTmin0), max(muT + 5 * sigmaT, CTmin0))
+        B_range = (min(1, B0), max(self.B_critical + 5 * self.Delta_B, B0))
+        return CTmin_range, B_range
+
+    def gradient_surrogate_expected_w_TPC(self, muT, sigmaT, recovery=True, CTmin_range=None, B_range=None, CTmin0=None, B0=None,
+                                          engine='analytic', n_nodes=64, verbose=False, **options):
+        '''
+        gradient_surrogate of the partials of grad_expected_w_TPC (the right-hand side of the trajectory ODEs) for a normal temperature.
+        CTmin_range, B_range : box of the surrogate, by default one holding every (CTmin, B) with a non-negligible expected w_TPC
+                               and the initial state (CTmin0, B0) of the trajectory (see _surrogate_box)
+        engine : 'analytic' or 'fixed' (see _branch_moments). The grid has 1e5 to 1e6 points, too many for 'quad'.
+        options : passed on to gradient_surrogate (tol, n_start, n_max, exact_factor)
+        '''
+        if engine == 'quad':
+            raise ValueError("gradient_surrogate_expected_w_TPC has no 'quad' engine, use 'analytic' or 'fixed' "
+                             "(surrogate='analytic' for a trajectory with engine='quad')")
+        default_CTmin_range, default_B_range = self._surrogate_box(muT, sigmaT, CTmin0 if CTmin0 is not None else muT,
+                                                                   B0 if B0 is not None else self.B_critical)
+        def gradient(CTmin, B):
+            _, dCTmin, dB = self.grad_expected_w_TPC(muT=muT, sigmaT=sigmaT, CTmin=CTmin, B=B, recovery=recovery,
+                                                      engine=engine, n_nodes=n_nodes)
+            return dCTmin, dB
+        surrogate = gradient_surrogate(gradient, CTmin_range or default_CTmin_range, B_range or default_B_range, **options)
+        if verbose:
+            print(surrogate)
+        return surrogate
+
+    def _with_surrogate(self, surrogate, ode, jacobian):
+        '''
+        right-hand side and Jacobian of a trajectory ODE taken from surrogate inside its box, and from ode and jacobian elsewhere
+        (ode, jacobian unchanged if there is no surrogate)
+        '''
+        if not surrogate:
+            return ode, jacobian
+        def surrogate_ode(t, z):
+            CTmin, B = z
+            if surrogate.covers(CTmin, B):
+                counters['surrogate_evaluations'] += 1
+                return surrogate.gradient(CTmin, B)
+            return ode(t, z)
+        def surrogate_jacobian(t, z):
+            CTmin, B = z
+            if surrogate.inside(CTmin, B):
+                return surrogate.jacobian(CTmin, B)
+            if jacobian is not None:
+                return jacobian(t, z)
+            f = np.array(ode(t, z))
+            step = 1e-6 * np.maximum(np.abs(z), 1)
+            return np.stack([(np.array(ode(t, z + step[i] * np.eye(2)[i])) - f) / step[i] for i in range(2)], axis=-1)
+        return surrogate_ode, surrogate_jacobian
+
+
+class gradient_surrogate:
+    """
+    Bicubic spline interpolants of a gradient field (dE/dCTmin, dE/dB) on a grid of CTmax = CTmin + B and B (so that the drop of
+    w_CTmax around CTmax_critical lies along a grid line), to use as the right-hand side of the trajectory ODEs.
+    gradient : function returning (dE/dCTmin, dE/dB) for arrays of CTmin and B, evaluated element-wise
+    CTmin_range, B_range : (lowest, highest) value of CTmin and B
+    The grid is refined from n_start x n_start points until the error at the cell centers is below tol (see scripts/README.md for
+    its effect on the trajectories), with a RuntimeWarning if an axis would need more than n_max points.
+    exact_factor : states where the interpolated gradient is below exact_factor times the error of its cell are not covered
+    """
+    def __init__(self, gradient, CTmin_range, B_range, tol=1e-5, n_start=17, n_max=513, exact_factor=100):
+        self.CTmax_range = (float(CTmin_range[0] + B_range[0]), float(CTmin_range[1] + B_range[1]))
+        self.B_range = (float(B_range[0]), float(B_range[1]))
+        self.exact_factor = exact_factor
+        CTmax_nodes, B_nodes = np.linspace(*self.CTmax_range, n_start), np.linspace(*self.B_range, n_start)
+        while True:
+            self.CTmax_nodes, self.B_nodes = CTmax_nodes, B_nodes
+            self.splines = [scipy.interpolate.RectBivariateSpline(CTmax_nodes, B_nodes, value)
+                            for value in self._exact(gradient, CTmax_nodes, B_nodes)]
+            CTmax_centers, B_centers = (CTmax_nodes[:-1] + CTmax_nodes[1:]) / 2, (B_nodes[:-1] + B_nodes[1:]) / 2
+            self.error = self._error(gradient, CTmax_centers, B_centers)
+            if self.error.max() <= tol:
+                break
+            # halve the intervals of each axis where the error halfway between grid points along that axis is above tol,
+            # or, if it is below tol there everywhere, the intervals of both axes of the cells with a center error above tol
+            split_CTmax = self._error(gradient, CTmax_centers, B_nodes).max(axis=(0, 2)) > tol
+            split_B = self._error(gradient, CTmax_nodes, B_centers).max(axis=(0, 1)) > tol
+            if not (np.any(split_CTmax) or np.any(split_B)):
+                failed = self.error.max(axis=0) > tol
+                split_CTmax, split_B = failed.any(axis=1), failed.any(axis=0)
+            if (CTmax_nodes.size + np.count_nonzero(split_CTmax) > n_max
+                    or B_nodes.size + np.count_nonzero(split_B) > n_max):
+                warnings.warn(f"gradient_surrogate stopped at n_max = {n_max} points per axis with a largest error of "
+                              f"{self.error.max():.2g}, above tol = {tol:.2g}", RuntimeWarning)
+                break
+            CTmax_nodes = np.sort(np.concatenate([CTmax_nodes, CTmax_centers[split_CTmax]]))
+            B_nodes = np.sort(np.concatenate([B_nodes, B_centers[split_B]]))
+
+    def _exact(self, gradient, CTmax_points, B_points):
+        '''
+        gradient on the CTmax_points x B_points grid, shape (2, len(CTmax_points), len(B_points))
+        '''
+        CTmax_grid, B_grid = np.meshgrid(CTmax_points, B_points, indexing='ij')
+        counters['surrogate_grid_points'] += CTmax_grid.size
+        return np.array(gradient(CTmax_grid - B_grid, B_grid))
+
+    def _error(self, gradient, CTmax_points, B_points):
+        '''
+        absolute error of the splines on the CTmax_points x B_points grid, shape (2, len(CTmax_points), len(B_points))
+        '''
+        CTmax_grid, B_grid = np.meshgrid(CTmax_points, B_points, indexing='ij')
+        return np.abs(np.array([spline.ev(CTmax_grid, B_grid) for spline in self.splines])
+                      - self._exact(gradient, CTmax_points, B_points))
+
+    def __repr__(self):
+        return (f"gradient_surrogate: {self.CTmax_nodes.size} x {self.B_nodes.size} grid on "
+                f"CTmax in [{self.CTmax_range[0]:.3g}, {self.CTmax_range[1]:.3g}], B in [{self.B_range[0]:.3g}, {self.B_range[1]:.3g}], "
+                f"largest error of dE/dCTmin {self.error[0].max():.2g}, of dE/dB {self.error[1].max():.2g}")
+
+    def inside(self, CTmin, B):
+        '''
+        whether (CTmin, B) is in the box of the surrogate
+        '''
+        return (self.CTmax_range[0] <= CTmin + B <= self.CTmax_range[1]) and (self.B_range[0] <= B <= self.B_range[1])
+
+    def cell_error(self, CTmin, B):
+        '''
+        estimated error of the interpolated [dE/dCTmin, dE/dB] in the grid cell of (CTmin, B), which must be inside the box
+        '''
+        i = min(max(np.searchsorted(self.CTmax_nodes, CTmin + B) - 1, 0), self.error.shape[1] - 1)
+        j = min(max(np.searchsorted(self.B_nodes, B) - 1, 0), self.error.shape[2] - 1)
+        return self.error[:, i, j]
+
+    def covers(self, CTmin, B):
+        '''
+        whether the surrogate can replace the exact gradient at (CTmin, B): inside the box, and away from the optimum
+        '''
+        return (self.inside(CTmin, B)
+                and np.hypot(*self.gradient(CTmin, B)) >= self.exact_factor * np.hypot(*self.cell_error(CTmin, B)))
+
+    def gradient(self, CTmin, B):
+        '''
+        interpolated [dE/dCTmin, dE/dB]
+        '''
+        return [float(spline.ev(CTmin + B, B)) for spline in self.splines]
+
+    def jacobian(self, CTmin, B):
+        '''
+        derivative of the interpolated gradient, [[d dCTmin / dCTmin, d dCTmin / dB], [d dB / dCTmin, d dB / dB]].
+        With the splines g(CTmax, B), d/dCTmin = dg/dCTmax and d/dB = dg/dCTmax + dg/dB.
+        '''
+        jacobian = np.zeros((2, 2))
+        for i, spline in enumerate(self.splines):
+            dCTmax, dB = float(spline.ev(CTmin + B, B, dx=1)), float(spline.ev(CTmin + B, B, dy=1))
+            jacobian[i] = [dCTmax, dCTmax + dB]
+        return jacobian
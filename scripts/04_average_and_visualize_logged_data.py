@@ -1,30 +1,47 @@
+import matplotlib
+# figures are only saved to files, so render without a display
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import argparse
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import log_cache
+import run_manifest
+# parameter files and their grouping into replicates are defined in step 1
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '01_prepare_input_parameters'))
+import generate_param_df
 
 parser = argparse.ArgumentParser(description='Prepare simulation parameters')
 parser.add_argument('--task', type=str, required=True,
                     choices=['gaussian', 'sine'],
                     help='Type of simulation task')
-
-args = parser.parse_args()
-
-# Define path to parameter files based on the task (same as python file in step 1 for generating params)
-if args.task == 'gaussian':
-    print("making parameter files for gaussian task.")
-    params_unique_path = "./01_prepare_input_parameters/gaussian_params_unique.csv"
-    params_path = "./01_prepare_input_parameters/gaussian_params.csv"
-
-elif args.task == 'sine':
-    print("making parameter files for sine task.")
-    params_unique_path = "./01_prepare_input_parameters/sine_params_unique.csv"
-    params_path = "./01_prepare_input_parameters/sine_params.csv"
-
-# Load params and full params for replicates
-params_unique = pd.read_csv(params_unique_path)
-params = pd.read_csv(params_path)
+parser.add_argument('--stream', action='store_true',
+                    help='Read each log in chunks and keep running statistics per generation instead of loading all replicates '
+                         '(memory does not grow with the number of replicates). Also saves SD, min, max and confidence intervals.')
+parser.add_argument('--chunksize', type=int, default=5000,
+                    help='Number of log lines read at a time with --stream')
+parser.add_argument('--quantiles', type=str, default='',
+                    help='Comma-separated quantiles to estimate with --stream, e.g. 0.025,0.975')
+parser.add_argument('--reservoir', type=int, default=64,
+                    help='Number of replicates sampled per generation for --quantiles (exact up to this many replicates)')
+parser.add_argument('--no-cache', action='store_true',
+                    help='Parse the .txt logs directly instead of through their columnar cache (see log_cache.py)')
+parser.add_argument('--cache-dir', type=str, default=None,
+                    help='Directory of the columnar log cache (default: .log_cache next to each log)')
+parser.add_argument('--cache-float32', action='store_true',
+                    help='Keep float columns as float32 in the log cache: half the size, but averages differ from those of the '
+                         'text logs by ~1e-6 (default: float64, the same values as parsing the logs)')
+parser.add_argument('--stage', type=str, default='all', choices=['all', 'reduce', 'plot'],
+                    help="'reduce' reads the logs and saves the averages and replicate traces, 'plot' draws the figures "
+                         "from the saved files only (without reading any log), 'all' does both")
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of processes working on different parameter sets at once')
+parser.add_argument('--max-points', type=int, default=0,
+                    help='Keep about this many points of each replicate line for plotting (minimum and maximum of each '
+                         'stretch of generations, so the lines look the same at screen resolution); 0 keeps every point')
 
 # Column titles to extract and plot
 titles = ['day', 'Temp', 'B_mean', 'CTmin_mean', 'CTmax_mean', 'Topt_mean', 'B_CTmin_cov', 'fitness_mean']
@@ -33,108 +50,362 @@ rbw_cmap = plt.get_cmap('rainbow')
 plt.rcParams.update({'font.size': 10})
 
 
-def get_matching_params(unique_row, params_df):
-    """Get all param rows matching a unique_row (all replicates)."""
-    merge_cols = [col for col in unique_row.index if col in params_df.columns and col not in ['seed', 'OUTNAME']]
-    row_df = unique_row.to_frame().T
-    return params_df.merge(row_df[merge_cols], on=merge_cols, how='inner')
-
-
-# Iterate through each unique parameter combination
-for idx, unique_row in params_unique.iterrows():
-    OUTDIR = unique_row['OUTDIR']
-    OUTNAME = unique_row['OUTNAME']
-    RUNTIME = unique_row['RUNTIME']
-    
-    print(f"Processing parameter set: {OUTNAME}")
-    
-    # Get all matching replicate rows
-    replicates = get_matching_params(unique_row, params)
-    # Create figure with 2x4 subplots (8 total)
-    fig, ax = plt.subplots(2, 4, figsize=(20, 10))
-    data_list = []
-    n_complete = 0
-    
-    # Loop through all replicates (different seeds)
+def complete_replicates(OUTDIR, replicates):
+    """Yield (rep_idx, txt_file) for replicates whose simulation completed and whose log has all columns in titles."""
     for rep_idx, rep_row in replicates.iterrows():
-        seed = rep_row['seed']
         rep_outname = rep_row['OUTNAME']
-        
-        # Check if .trees file exists (indicates successful completion)
-        trees_file = f"{OUTDIR}/{rep_outname}.trees"
+
+        # Check that the simulation completed (see run_manifest.py)
         txt_file = f"{OUTDIR}/{rep_outname}.txt"
-        
-        if not os.path.exists(trees_file):
-            print(f"  Trees file not found (simulation didn't complete): {trees_file}")
+        run_status = run_manifest.status(OUTDIR, rep_outname)
+
+        if run_status != 'complete':
+            print(f"  Simulation not complete ({run_status}): {OUTDIR}/{rep_outname}")
             continue
-        
+
         if not os.path.exists(txt_file):
             print(f"  Text file not found: {txt_file}")
             continue
-        
+
+        # Check that all required columns exist
+        try:
+            columns = pd.read_csv(txt_file, nrows=0).columns
+        except Exception as e:
+            print(f"  Error loading {txt_file}: {e}")
+            continue
+        missing_cols = [col for col in titles if col not in columns]
+        if missing_cols:
+            print(f"  Missing columns {missing_cols} in {txt_file}")
+            continue
+
         print(f"  Loading: {txt_file}")
-        
+        yield rep_idx, txt_file
+
+
+def decimate(generation, values, bucket):
+    """
+    Keep the minimum and maximum of every bucket consecutive points (in their original order) and the last point,
+    so a line drawn through them looks the same as the full line once a bucket is narrower than a pixel.
+    bucket <= 1 keeps every point.
+    """
+    n = len(values)
+    if bucket <= 1 or n <= 2:
+        return np.asarray(generation), np.asarray(values)
+    padded = np.concatenate([values, np.full((-n) % bucket, np.nan)]).reshape(-1, bucket)
+    offsets = np.arange(0, len(padded) * bucket, bucket)
+    # NaN (including the padding) is never picked unless a whole bucket is NaN
+    lowest = offsets + np.where(np.isnan(padded), np.inf, padded).argmin(axis=1)
+    highest = offsets + np.where(np.isnan(padded), -np.inf, padded).argmax(axis=1)
+    keep = np.unique(np.minimum(np.concatenate([lowest, highest, [n - 1]]), n - 1))
+    return np.asarray(generation)[keep], np.asarray(values)[keep]
+
+
+def new_traces(stats=False):
+    """
+    Lines of each replicate for the figure: traces['color'] holds the position of each replicate in the colormap, and
+    traces[title] a list (one per replicate) of arrays [generation, value] for each column. stats tells whether stats_df was saved.
+    """
+    traces = {'color': [], 'stats': stats}
+    traces.update({title: [] for title in titles})
+    return traces
+
+
+def new_trace(traces, color):
+    traces['color'].append(color)
+    for title in titles:
+        traces[title].append([])
+
+
+def drop_trace(traces):
+    traces['color'].pop()
+    for title in titles:
+        traces[title].pop()
+
+
+def finish_traces(traces):
+    """join the chunks added to each replicate's line into a single array"""
+    for title in titles:
+        traces[title] = [np.concatenate(chunks, axis=1) for chunks in traces[title]]
+    return traces
+
+
+def add_trace(traces, generation, data, bucket):
+    """Append one replicate (or the next chunk of the last replicate) to the traces plotted for each column."""
+    for title in titles:
+        g, v = decimate(generation, data[title].values, bucket)
+        traces[title][-1].append(np.array([g, v], dtype=float))
+
+
+class running_stats:
+    """
+    Per-generation statistics of the logged columns across replicates, updated one chunk of a log at a time:
+    count, mean and variance (Welford's online algorithm), min and max.
+    If reservoir_size > 0, a uniform random sample of up to reservoir_size replicates is also kept for each generation
+    (reservoir sampling) to estimate quantiles; they are exact while there are at most reservoir_size replicates.
+    Memory depends on the number of generations (rows of a log), not on the number of replicates.
+    """
+    def __init__(self, n_columns, reservoir_size=0, seed=0):
+        self.n_columns = n_columns
+        self.reservoir_size = reservoir_size
+        self.rng = np.random.default_rng(seed)
+        # cycle of each row, as integers like the logs (every row added by _grow is set by the update that adds it)
+        self.generation = np.zeros(0, dtype=np.int64)
+        self.n = np.zeros(0, dtype=int)
+        self.mean = np.zeros((0, n_columns))
+        self.M2 = np.zeros((0, n_columns))
+        self.min = np.zeros((0, n_columns))
+        self.max = np.zeros((0, n_columns))
+        self.reservoir = np.zeros((0, reservoir_size, n_columns))
+
+    def _grow(self, n_rows):
+        # extend the per-generation arrays when a log is longer than all logs seen so far
+        extra = n_rows - len(self.n)
+        if extra <= 0:
+            return
+        self.generation = np.concatenate([self.generation, np.zeros(extra, dtype=np.int64)])
+        self.n = np.concatenate([self.n, np.zeros(extra, dtype=int)])
+        self.mean, self.M2 = [np.concatenate([a, np.zeros((extra, self.n_columns))]) for a in (self.mean, self.M2)]
+        self.min = np.concatenate([self.min, np.full((extra, self.n_columns), np.inf)])
+        self.max = np.concatenate([self.max, np.full((extra, self.n_columns), -np.inf)])
+        self.reservoir = np.concatenate([self.reservoir, np.full((extra, self.reservoir_size, self.n_columns), np.nan)])
+
+    def update(self, rows, generation, values):
+        """Add one replicate's values (shape (len(rows), n_columns)) at the given row positions of the log."""
+        self._grow(rows[-1] + 1)
+        self.generation[rows] = generation
+        self.n[rows] += 1
+        n = self.n[rows][:, None]
+        delta = values - self.mean[rows]
+        self.mean[rows] += delta / n
+        self.M2[rows] += delta * (values - self.mean[rows])
+        self.min[rows] = np.minimum(self.min[rows], values)
+        self.max[rows] = np.maximum(self.max[rows], values)
+        if self.reservoir_size > 0:
+            # the n-th replicate replaces a random sample with probability reservoir_size / n (fills empty slots first)
+            slot = np.where(n[:, 0] <= self.reservoir_size, n[:, 0] - 1, self.rng.integers(0, n[:, 0]))
+            keep = slot < self.reservoir_size
+            self.reservoir[rows[keep], slot[keep]] = values[keep]
+
+    def sd(self):
+        """sample standard deviation (0 where there is a single replicate)"""
+        return np.sqrt(self.M2 / np.maximum(self.n - 1, 1)[:, None])
+
+    def quantile(self, q):
+        """estimated q-quantile for each generation and column, from the reservoir samples"""
+        return np.nanquantile(self.reservoir, q, axis=1)
+
+
+def read_log(txt_file, cache_dir, use_cache, float_dtype=np.float64):
+    """Read a log with pandas, through the columnar cache if use_cache (converted to int64 / float64 as pd.read_csv would)."""
+    if not use_cache:
+        return pd.read_csv(txt_file)
+    data = log_cache.read_log(txt_file, columns=['cycle'] + titles, cache_dir=cache_dir, float_dtype=float_dtype)
+    return data.astype({'cycle': np.int64, **{title: float for title in titles}})
+
+
+def read_log_chunks(txt_file, chunksize, cache_dir, use_cache, float_dtype=np.float64):
+    """Read a log in chunks of chunksize lines, through the columnar cache if use_cache."""
+    if not use_cache:
+        return pd.read_csv(txt_file, chunksize=chunksize)
+    return log_cache.iter_log_chunks(txt_file, chunksize, columns=['cycle'] + titles, cache_dir=cache_dir,
+                                     float_dtype=float_dtype)
+
+
+def aggregate_in_memory(OUTDIR, replicates, traces, bucket=1, cache_dir=None, use_cache=True, float_dtype=np.float64):
+    """Load every complete replicate, add it to traces, and return (avg_df_dict, end_df, n_complete)."""
+    data_list = []
+    for rep_idx, txt_file in complete_replicates(OUTDIR, replicates):
         try:
             # Load data using pandas to access columns by name
-            data = pd.read_csv(txt_file)
-            
-            # Check that all required columns exist
-            missing_cols = [col for col in titles if col not in data.columns]
-            if missing_cols:
-                print(f"  Missing columns {missing_cols} in {txt_file}")
-                continue
-            
-            data_list.append(data)
-            n_complete += 1
-            
-            # Plot each replicate
-            for i, title in enumerate(titles):
-                ax.flat[i].plot(data['cycle'], data[title], 
-                               color=rbw_cmap(rep_idx / len(replicates)), 
-                               linewidth=0.2)
-                ax.flat[i].set_title(title)
-                ax.flat[i].set_xlabel("generation")
-        
+            data = read_log(txt_file, cache_dir, use_cache, float_dtype)
         except Exception as e:
             print(f"  Error loading {txt_file}: {e}")
             continue
-    
-    # Check if we have any complete simulations
+        data_list.append(data)
+        # Keep each replicate's line for the figure
+        new_trace(traces, rep_idx / len(replicates))
+        add_trace(traces, data['cycle'].values, data, bucket)
+
     if len(data_list) == 0:
-        print(f"No complete simulations for {OUTNAME}, skipping...")
-        plt.close(fig)
-        continue
-    
-    print(f"  {n_complete} complete simulations found")
-    
+        return None, None, 0
+
     # Calculate average across replicates
     # Create average dataframe
     avg_df_dict = {'generation': data_list[0]['cycle'].values}
     end_df = {}
-    
+
     for title in titles:
         # Stack all replicate data for this column
         all_values = np.array([df[title].values for df in data_list])
-        
+
         # Calculate mean across replicates
         avg_values = np.mean(all_values, axis=0)
         avg_df_dict[title] = avg_values
-        
+
         # Get end values from each replicate
         end_df[title] = [df[title].iloc[-1] for df in data_list]
-    
-    # Plot the averages
+    return avg_df_dict, end_df, len(data_list)
+
+
+def aggregate_streaming(OUTDIR, replicates, traces, chunksize, quantiles, reservoir_size, bucket=1, cache_dir=None, use_cache=True,
+                        float_dtype=np.float64):
+    """
+    Read every complete replicate in chunks of chunksize lines, add it to traces and fold it into running_stats.
+    Return (avg_df_dict, end_df, n_complete, stats_dict), where stats_dict holds n, mean, sd, min, max,
+    the half-width of the 95% confidence interval of the mean, and the requested quantiles for each column in titles.
+    """
+    stats = running_stats(len(titles), reservoir_size=reservoir_size if quantiles else 0)
+    end_df = {title: [] for title in titles}
+    n_complete = 0
+    for rep_idx, txt_file in complete_replicates(OUTDIR, replicates):
+        new_trace(traces, rep_idx / len(replicates))
+        start = 0
+        last = None
+        for chunk in read_log_chunks(txt_file, chunksize, cache_dir, use_cache, float_dtype):
+            rows = np.arange(start, start + len(chunk))
+            stats.update(rows, chunk['cycle'].values, chunk[titles].values.astype(float))
+            add_trace(traces, chunk['cycle'].values, chunk, bucket)
+            last = chunk.iloc[[-1]]
+            start += len(chunk)
+        if last is None:
+            drop_trace(traces)
+            continue
+        for title in titles:
+            end_df[title].append(np.float64(last[title].iloc[0]))
+        n_complete += 1
+
+    if n_complete == 0:
+        return None, None, 0, None
+
+    # cycle of each line of the logs (taken from the longest log if their lengths differ)
+    avg_df_dict = {'generation': stats.generation}
+    avg_df_dict.update({title: stats.mean[:, i] for i, title in enumerate(titles)})
+    sd = stats.sd()
+    stats_dict = {'generation': stats.generation, 'n': stats.n,
+                  'mean': {title: stats.mean[:, i] for i, title in enumerate(titles)},
+                  'sd': {title: sd[:, i] for i, title in enumerate(titles)},
+                  'min': {title: stats.min[:, i] for i, title in enumerate(titles)},
+                  'max': {title: stats.max[:, i] for i, title in enumerate(titles)},
+                  'ci95': {title: 1.96 * sd[:, i] / np.sqrt(stats.n) for i, title in enumerate(titles)},
+                  'quantiles': {q: dict(zip(titles, stats.quantile(q).T)) for q in quantiles}}
+    return avg_df_dict, end_df, n_complete, stats_dict
+
+
+def reduce_parameter_set(unique_row, replicates, args, quantiles):
+    """
+    Reduction stage for one parameter set: read its replicate logs and save avg_df, end_df, traces_df
+    (the decimated replicate lines) and, with --stream, stats_df.
+    """
+    OUTDIR = unique_row['OUTDIR']
+    OUTNAME = unique_row['OUTNAME']
+    RUNTIME = unique_row['RUNTIME']
+
+    print(f"Processing parameter set: {OUTNAME}")
+    # a log has at most RUNTIME lines; two points (minimum and maximum) are kept per bucket
+    bucket = int(np.ceil(2 * RUNTIME / args.max_points)) if args.max_points > 0 else 1
+    traces = new_traces(stats=args.stream)
+    float_dtype = np.float32 if args.cache_float32 else np.float64
+
+    if args.stream:
+        avg_df_dict, end_df, n_complete, stats_dict = aggregate_streaming(
+            OUTDIR, replicates, traces, args.chunksize, quantiles, args.reservoir, bucket=bucket,
+            cache_dir=args.cache_dir, use_cache=not args.no_cache, float_dtype=float_dtype)
+    else:
+        avg_df_dict, end_df, n_complete = aggregate_in_memory(OUTDIR, replicates, traces, bucket=bucket,
+                                                              cache_dir=args.cache_dir, use_cache=not args.no_cache,
+                                                              float_dtype=float_dtype)
+
+    # Check if we have any complete simulations
+    if n_complete == 0:
+        print(f"No complete simulations for {OUTNAME}, skipping...")
+        return
+
+    print(f"  {n_complete} complete simulations found for {OUTNAME}")
+
+    # Save data using OUTNAME from params_unique
+    np.save(f"{OUTDIR}/avg_df_{OUTNAME}.npy", avg_df_dict)
+    np.save(f"{OUTDIR}/end_df_{OUTNAME}.npy", end_df)
+    np.save(f"{OUTDIR}/traces_df_{OUTNAME}.npy", finish_traces(traces))
+    saved = f"avg_df_{OUTNAME}.npy, end_df_{OUTNAME}.npy, and traces_df_{OUTNAME}.npy"
+    if args.stream:
+        np.save(f"{OUTDIR}/stats_df_{OUTNAME}.npy", stats_dict)
+        saved = f"avg_df_{OUTNAME}.npy, end_df_{OUTNAME}.npy, traces_df_{OUTNAME}.npy, and stats_df_{OUTNAME}.npy"
+    print(f"  Saved: {saved}")
+
+
+def plot_parameter_set(OUTDIR, OUTNAME):
+    """
+    Plotting stage for one parameter set: draw every replicate line and the average (with a +- 1 SD band if stats_df was saved)
+    from the files saved by reduce_parameter_set.
+    """
+    if not os.path.exists(f"{OUTDIR}/traces_df_{OUTNAME}.npy"):
+        print(f"No reduced data for {OUTNAME} (run with --stage reduce first), skipping...")
+        return
+    avg_df_dict = np.load(f"{OUTDIR}/avg_df_{OUTNAME}.npy", allow_pickle=True).item()
+    traces = np.load(f"{OUTDIR}/traces_df_{OUTNAME}.npy", allow_pickle=True).item()
+    stats_dict = np.load(f"{OUTDIR}/stats_df_{OUTNAME}.npy", allow_pickle=True).item() if traces['stats'] else None
+
+    # Create figure with 2x4 subplots (8 total)
+    fig, ax = plt.subplots(2, 4, figsize=(20, 10))
     for i, title in enumerate(titles):
-        ax.flat[i].plot(avg_df_dict['generation'], avg_df_dict[title], 
-                       linewidth=2, color='black')
-    
-    # Save figure and data using OUTNAME from params_unique
+        # Plot each replicate
+        for color, (generation, values) in zip(traces['color'], traces[title]):
+            ax.flat[i].plot(generation, values, color=rbw_cmap(color), linewidth=0.2)
+        ax.flat[i].set_title(title)
+        ax.flat[i].set_xlabel("generation")
+        # Plot the averages
+        ax.flat[i].plot(avg_df_dict['generation'], avg_df_dict[title],
+                        linewidth=2, color='black')
+        if stats_dict is not None:
+            ax.flat[i].fill_between(avg_df_dict['generation'],
+                                    avg_df_dict[title] - stats_dict['sd'][title],
+                                    avg_df_dict[title] + stats_dict['sd'][title],
+                                    color='black', alpha=0.2, linewidth=0)
     fig.tight_layout()
     fig.savefig(f"{OUTDIR}/summary_{OUTNAME}.png")
-    np.save(f"{OUTDIR}/avg_df_{OUTNAME}.npy", avg_df_dict)
-    np.save(f"{OUTDIR}/end_df_{OUTNAME}.npy", end_df)
-    
     plt.close(fig)
-    print(f"  Saved: summary_Fig_{OUTNAME}.png, avg_df_{OUTNAME}.npy, and end_df_{OUTNAME}.npy")
+    print(f"  Saved: summary_{OUTNAME}.png")
+
+
+def run(function, arguments, workers):
+    """call function(*a) for each a in arguments, in a pool of worker processes if workers > 1"""
+    if workers <= 1:
+        return [function(*a) for a in arguments]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(function, *zip(*arguments)))
+
+
+def main(args):
+    # Define path to parameter files based on the task (same as python file in step 1 for generating params)
+    if args.task == 'gaussian':
+        print("making parameter files for gaussian task.")
+        params_unique_path = "./01_prepare_input_parameters/gaussian_params_unique.csv"
+        params_path = "./01_prepare_input_parameters/gaussian_params.csv"
+
+    elif args.task == 'sine':
+        print("making parameter files for sine task.")
+        params_unique_path = "./01_prepare_input_parameters/sine_params_unique.csv"
+        params_path = "./01_prepare_input_parameters/sine_params.csv"
+
+    quantiles = [float(q) for q in args.quantiles.split(',') if q.strip()]
+
+    # Load params and full params for replicates
+    params_unique = pd.read_csv(params_unique_path)
+    params = pd.read_csv(params_path)
+    unique_rows = [unique_row for idx, unique_row in params_unique.iterrows()]
+    # Get all matching replicate rows of each unique row
+    replicates = generate_param_df.replicates_of(params_unique, params)
+
+    # Reduce each unique parameter combination (all replicates), then draw the figures from the saved reductions
+    if args.stage in ('all', 'reduce'):
+        run(reduce_parameter_set,
+            [(unique_row, rows, args, quantiles) for unique_row, rows in zip(unique_rows, replicates)],
+            args.workers)
+    if args.stage in ('all', 'plot'):
+        run(plot_parameter_set, [(unique_row['OUTDIR'], unique_row['OUTNAME']) for unique_row in unique_rows], args.workers)
+
+    print(f"Finished processing all log files.")
+
 
-print(f"Finished processing all log files.")
+if __name__ == '__main__':
+    main(parser.parse_args())
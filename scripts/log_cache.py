@@ -0,0 +1,92 @@
+## Columnar cache of SLiM log files (OUTNAME.txt written by community.createLogFile in master_WF.slim)
+
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+def _cache_path(txt_file, cache_dir=None):
+    """Directory holding the cached columns of txt_file (by default in .log_cache next to the log)."""
+    txt_file = os.path.abspath(txt_file)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(txt_file), '.log_cache')
+    name = os.path.basename(txt_file) + '-' + hashlib.sha1(txt_file.encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, name)
+
+
+def _compact(values, float_dtype=np.float64):
+    """Convert a column to float_dtype / int32 (int64 if the values do not fit), or fixed-width strings for text."""
+    if np.issubdtype(values.dtype, np.integer):
+        if values.size == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+            return values.astype(np.int32)
+        return values
+    if np.issubdtype(values.dtype, np.floating):
+        return values.astype(float_dtype)
+    return values.astype(str)
+
+
+def _replace(path, write):
+    # write to a temporary file next to path, then rename it, so readers never see a partial file
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(descriptor, 'wb') as f:
+        write(f)
+    os.replace(temporary_path, path)
+
+
+def cached_log(txt_file, cache_dir=None, float_dtype=np.float64):
+    """
+    Return the cache directory of txt_file, converting the log first if it has not been converted yet, if it has changed since
+    (the cache records the log's path, modification time and size), or if it was cached with another float_dtype.
+    The cache holds one .npy file per column and meta.json (source, mtime_ns, size, rows, columns, float_dtype).
+    float_dtype : np.float64 keeps the values of pd.read_csv exactly. np.float32 halves the size of the cache, but rounds
+                  the values to ~7 significant digits (averages then differ from those of the text logs by ~1e-6).
+    """
+    path = _cache_path(txt_file, cache_dir)
+    stat = os.stat(txt_file)
+    meta_file = os.path.join(path, 'meta.json')
+    float_name = np.dtype(float_dtype).name
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        # caches written before float_dtype was recorded hold float32 columns
+        if (meta['mtime_ns'] == stat.st_mtime_ns and meta['size'] == stat.st_size
+                and meta.get('float_dtype', 'float32') == float_name):
+            return path
+
+    os.makedirs(path, exist_ok=True)
+    data = pd.read_csv(txt_file)
+    for i, column in enumerate(data.columns):
+        values = _compact(data[column].values, float_dtype)
+        _replace(os.path.join(path, f"{i}.npy"), lambda f: np.save(f, values))
+    meta = {'source': os.path.abspath(txt_file), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size,
+            'rows': len(data), 'columns': list(data.columns), 'float_dtype': float_name}
+    # meta.json is written last, so it only matches the log once every column is in place
+    _replace(meta_file, lambda f: f.write(json.dumps(meta).encode()))
+    return path
+
+
+def read_log(txt_file, columns=None, cache_dir=None, float_dtype=np.float64):
+    """
+    Read a SLiM log as a pandas DataFrame through the cache (see cached_log).
+    Columns are memory-mapped float_dtype / int32 arrays; columns selects a subset of them (default: all).
+    """
+    path = cached_log(txt_file, cache_dir, float_dtype)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if columns is None:
+        columns = meta['columns']
+    missing = [column for column in columns if column not in meta['columns']]
+    if missing:
+        raise KeyError(f"columns {missing} not in {txt_file}")
+    return pd.DataFrame({column: np.load(os.path.join(path, f"{meta['columns'].index(column)}.npy"), mmap_mode='r')
+                         for column in columns}, copy=False)
+
+
+def iter_log_chunks(txt_file, chunksize, columns=None, cache_dir=None, float_dtype=np.float64):
+    """Yield a SLiM log as DataFrames of chunksize rows, like pd.read_csv(txt_file, chunksize=chunksize), through the cache."""
+    data = read_log(txt_file, columns=columns, cache_dir=cache_dir, float_dtype=float_dtype)
+    for start in range(0, len(data), chunksize):
+        yield data.iloc[start:start + chunksize]
@@ -0,0 +1,166 @@
+## Manifest of the simulations of a params csv: status, wall time and output checksums of each row
+# Each simulation has its own record, OUTDIR/.manifest/OUTNAME.json, written under a temporary name and then renamed,
+# so the tasks of a job array can update their records at the same time.
+# Rows are numbered as SLURM_ARRAY_TASK_ID in 02_run_simulations/*_job_array.sh (1 = first row after the header).
+# Usage:
+#   python run_manifest.py start CSV ROW          record that the simulation of ROW started
+#   python run_manifest.py finish CSV ROW CODE    record that it ended with exit code CODE (complete if CODE is 0 and OUTNAME.trees exists)
+#   python run_manifest.py done CSV ROW           exit with status 0 if ROW is complete, 1 otherwise (used to skip completed rows)
+#   python run_manifest.py pending CSV            rows that are not complete, formatted for sbatch --array
+#   python run_manifest.py table CSV [--verify]   print the status of every row (--verify recomputes the output checksums)
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import pandas as pd
+
+# statuses of a simulation: not started, started (or killed without reaching finish), ended with an error,
+# interrupted with a checkpoint to resume from, and finished with all outputs written
+statuses = ['missing', 'running', 'failed', 'partial', 'complete']
+
+
+def _record_path(OUTDIR, OUTNAME):
+    return os.path.join(OUTDIR, '.manifest', OUTNAME + '.json')
+
+
+def checkpoint_path(OUTDIR, OUTNAME):
+    '''checkpoint written by master_WF.slim every CHECKPOINT_INTERVAL cycles (removed once the simulation finishes)'''
+    return f"{OUTDIR}/{OUTNAME}_checkpoint.trees"
+
+
+def checksum(path):
+    '''sha1 of a file, read in blocks'''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def read_record(OUTDIR, OUTNAME):
+    '''record of a simulation, or None if it has none'''
+    path = _record_path(OUTDIR, OUTNAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_record(OUTDIR, OUTNAME, record):
+    path = _record_path(OUTDIR, OUTNAME)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file next to path, then rename it, so readers never see a partial file
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(descriptor, 'w') as f:
+        json.dump(record, f, indent=1)
+    os.replace(temporary_path, path)
+
+
+def start(row, OUTDIR, OUTNAME):
+    '''record that the simulation of a params row started (counting the attempts)'''
+    record = read_record(OUTDIR, OUTNAME) or {'OUTNAME': OUTNAME, 'row': row, 'attempts': 0}
+    record.update({'status': 'running', 'start': time.time(), 'end': None, 'wall_time': None,
+                   'host': socket.gethostname(), 'attempts': record['attempts'] + 1,
+                   'resumed_from_checkpoint': os.path.exists(checkpoint_path(OUTDIR, OUTNAME))})
+    write_record(OUTDIR, OUTNAME, record)
+    return record
+
+
+def finish(row, OUTDIR, OUTNAME, exit_code):
+    '''record the end of a simulation, with the checksums of its outputs if it completed'''
+    record = read_record(OUTDIR, OUTNAME) or {'OUTNAME': OUTNAME, 'row': row, 'attempts': 1, 'start': None}
+    record['end'] = time.time()
+    record['wall_time'] = record['end'] - record['start'] if record.get('start') else None
+    record['exit_code'] = exit_code
+    outputs = {'trees': f"{OUTDIR}/{OUTNAME}.trees", 'txt': f"{OUTDIR}/{OUTNAME}.txt"}
+    if exit_code == 0 and all(os.path.exists(path) for path in outputs.values()):
+        record['status'] = 'complete'
+        record['checksums'] = {name: checksum(path) for name, path in outputs.items()}
+    else:
+        record['status'] = 'failed'
+    write_record(OUTDIR, OUTNAME, record)
+    return record
+
+
+def status(OUTDIR, OUTNAME, verify=False):
+    '''
+    status of a simulation (one of statuses). Simulations without a record (run before the manifest existed)
+    are complete if OUTNAME.trees exists. With verify, a complete simulation whose outputs no longer match
+    their recorded checksums is reported as failed.
+    '''
+    record = read_record(OUTDIR, OUTNAME)
+    if record is None:
+        if os.path.exists(f"{OUTDIR}/{OUTNAME}.trees"):
+            return 'complete'
+        return 'partial' if os.path.exists(checkpoint_path(OUTDIR, OUTNAME)) else 'missing'
+    if record['status'] == 'complete':
+        outputs = {'trees': f"{OUTDIR}/{OUTNAME}.trees", 'txt': f"{OUTDIR}/{OUTNAME}.txt"}
+        if not all(os.path.exists(path) for path in outputs.values()):
+            return 'missing'
+        if verify and any(checksum(path) != record['checksums'][name] for name, path in outputs.items()):
+            return 'failed'
+        return 'complete'
+    if record['status'] == 'failed' and os.path.exists(checkpoint_path(OUTDIR, OUTNAME)):
+        return 'partial'
+    return record['status']
+
+
+def table(params, verify=False):
+    '''status, attempts and wall time (in seconds) of every row of params (as in *_params.csv), numbered from 1'''
+    rows = []
+    for row, (_, params_row) in enumerate(params.iterrows(), start=1):
+        record = read_record(params_row['OUTDIR'], params_row['OUTNAME']) or {}
+        rows.append({'row': row, 'OUTNAME': params_row['OUTNAME'],
+                     'status': status(params_row['OUTDIR'], params_row['OUTNAME'], verify),
+                     'attempts': record.get('attempts', 0), 'wall_time': record.get('wall_time')})
+    return pd.DataFrame(rows)
+
+
+def array_spec(rows):
+    '''format row numbers for sbatch --array, e.g. [1, 2, 3, 7] -> 1-3,7'''
+    ranges = []
+    for row in sorted(rows):
+        if ranges and row == ranges[-1][1] + 1:
+            ranges[-1][1] = row
+        else:
+            ranges.append([row, row])
+    return ','.join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+parser = argparse.ArgumentParser(description='Manifest of the simulations of a params csv')
+parser.add_argument('command', choices=['start', 'finish', 'done', 'pending', 'table'])
+parser.add_argument('csv', help='params csv, e.g. 01_prepare_input_parameters/gaussian_params.csv')
+parser.add_argument('row', type=int, nargs='?', help='row of the csv (1 = first row after the header)')
+parser.add_argument('exit_code', type=int, nargs='?', default=0, help='exit code of the simulation (finish)')
+parser.add_argument('--verify', action='store_true', help='recompute the checksums of complete simulations (table, pending)')
+parser.add_argument('--out', type=str, default=None, help='also save the table as this csv file (table)')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    params = pd.read_csv(args.csv)
+    if args.command in ('start', 'finish', 'done'):
+        if args.row is None:
+            parser.error(f"{args.command} needs a row")
+        params_row = params.iloc[args.row - 1]
+        OUTDIR, OUTNAME = params_row['OUTDIR'], params_row['OUTNAME']
+        if args.command == 'start':
+            start(args.row, OUTDIR, OUTNAME)
+        elif args.command == 'finish':
+            print(f"{OUTNAME}: {finish(args.row, OUTDIR, OUTNAME, args.exit_code)['status']}")
+        else:
+            sys.exit(0 if status(OUTDIR, OUTNAME) == 'complete' else 1)
+    else:
+        manifest = table(params, args.verify)
+        if args.command == 'pending':
+            print(array_spec(manifest.loc[manifest['status'] != 'complete', 'row']))
+        else:
+            print(manifest.to_string(index=False))
+            print(manifest['status'].value_counts().to_string())
+            if args.out is not None:
+                manifest.to_csv(args.out, index=False)
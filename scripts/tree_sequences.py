@@ -0,0 +1,221 @@
+## Analysis of the tree sequences (OUTNAME.trees written by sim.treeSeqOutput in master_WF.slim) of all runs in a params csv
+# Loads the tree sequences in a pool of worker processes, collects the final B and CTmin of every individual
+# (Bs_final / CTmins_final in the user metadata) into one table, optionally recapitates and overlays neutral mutations,
+# and computes diversity statistics. The results of each file are cached next to it.
+# Usage: python tree_sequences.py --task gaussian --workers 8 --recapitate --mutate
+
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import tskit
+
+# Genome of master_WF.slim: neutral flanks around the QTN region (positions 20001-80000),
+# which is split into NUM_LINKAGE_GROUPS linkage groups (recombination rate 0.5 between them)
+SEQUENCE_LENGTH = 100_000
+QTN_REGION = (20_001, 80_001)
+MU = 1e-7
+RECOMBINATION_RATE = 1e-8
+NUM_LINKAGE_GROUPS = 12
+# windows in which statistics are computed
+regions = {'neutral_left': (0, QTN_REGION[0]), 'QTN': QTN_REGION, 'neutral_right': (QTN_REGION[1], SEQUENCE_LENGTH)}
+
+
+def recombination_map():
+    '''recombination map of master_WF.slim (see initializeRecombinationRate there) as an msprime.RateMap'''
+    import msprime
+    group_length = (QTN_REGION[1] - QTN_REGION[0]) // NUM_LINKAGE_GROUPS
+    rates = [RECOMBINATION_RATE, 0.5] * (NUM_LINKAGE_GROUPS - 1) + [RECOMBINATION_RATE]
+    ends = []
+    for i in range(1, NUM_LINKAGE_GROUPS):
+        ends += [20_000 + group_length * i, 20_000 + group_length * i + 1]
+    ends.append(SEQUENCE_LENGTH - 1)
+    # SLiM's rate applies to the positions up to and including each end
+    return msprime.RateMap(position=[0] + [end + 1 for end in ends], rate=rates)
+
+
+def neutral_mutation_map(mutation_rate=MU):
+    '''mutation rate map that is mutation_rate in the neutral flanks and 0 in the QTN region (simulated by SLiM)'''
+    import msprime
+    return msprime.RateMap(position=[0, QTN_REGION[0], QTN_REGION[1], SEQUENCE_LENGTH], rate=[mutation_rate, 0, mutation_rate])
+
+
+def final_traits(ts):
+    '''(B, CTmin) of every individual alive at the end of the simulation, stored in the tree sequence's user metadata'''
+    metadata = ts.metadata['SLiM']['user_metadata']
+    return np.array(metadata['Bs_final'], dtype=float), np.array(metadata['CTmins_final'], dtype=float)
+
+
+def add_neutral_history(ts, recapitate=False, mutate=False, mutation_rate=MU, seed=None):
+    '''
+    Recapitate ts (coalesce the lineages remaining at the start of the SLiM simulation, with pyslim and msprime)
+    and/or overlay neutral mutations on the neutral flanks (with msprime), as deferred in master_WF.slim.
+    The ancestral population size is N_POP of the simulation, and seed defaults to the simulation's seed (+ 1, as msprime needs seed > 0).
+    '''
+    if not (recapitate or mutate):
+        return ts
+    import msprime
+    params = ts.metadata['SLiM']['user_metadata']
+    if seed is None:
+        seed = int(np.ravel(params['seed'])[0]) + 1
+    if recapitate:
+        try:
+            import pyslim
+        except ImportError:
+            raise ImportError("recapitation needs pyslim (pip install pyslim)")
+        ts = pyslim.recapitate(ts, ancestral_Ne=float(np.ravel(params['N_POP'])[0]),
+                               recombination_rate=recombination_map(), random_seed=seed)
+    if mutate:
+        # the new mutations get SLiM metadata (type m1), next to the m2 / m3 QTNs already in ts
+        ts = msprime.sim_mutations(ts, rate=neutral_mutation_map(mutation_rate),
+                                   model=msprime.SLiMMutationModel(type=1), keep=True, random_seed=seed)
+    return ts
+
+
+def diversity_statistics(ts):
+    '''
+    Dictionary of statistics of the sampled genomes in each of the regions (neutral flanks and QTN region):
+    nucleotide diversity, number of segregating sites, Tajima's D, and the mean divergence between the two genomes
+    of each individual (i.e. heterozygosity).
+    '''
+    windows = [0] + [end for start, end in regions.values()]
+    samples = ts.samples()
+    stats = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = {'diversity': ts.diversity(windows=windows),
+                  'segregating_sites': ts.segregating_sites(windows=windows),
+                  'tajimas_D': ts.Tajimas_D(windows=windows)}
+    # the two genomes (sample nodes) of each individual
+    genomes = [ind.nodes for ind in ts.individuals() if len(ind.nodes) == 2 and np.all(np.isin(ind.nodes, samples))]
+    if genomes:
+        values['heterozygosity'] = ts.divergence(sample_sets=[[node] for pair in genomes for node in pair],
+                                                 indexes=[(2 * i, 2 * i + 1) for i in range(len(genomes))],
+                                                 windows=windows).mean(axis=1)
+    else:
+        values['heterozygosity'] = np.full(len(regions), np.nan)
+    for name, value in values.items():
+        for region, v in zip(regions, np.ravel(value)):
+            stats[f"{name}_{region}"] = float(v)
+    stats['num_samples'] = len(samples)
+    stats['num_trees'] = ts.num_trees
+    stats['num_mutations'] = ts.num_mutations
+    return stats
+
+
+def _cache_file(trees_file, options, cache_dir=None):
+    """File holding the cached results of trees_file for options (by default in .tree_cache next to the tree sequence)."""
+    trees_file = os.path.abspath(trees_file)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(trees_file), '.tree_cache')
+    key = json.dumps([trees_file, options], sort_keys=True)
+    return os.path.join(cache_dir, os.path.basename(trees_file) + '-' + hashlib.sha1(key.encode()).hexdigest()[:12] + '.npz')
+
+
+def analyze(trees_file, recapitate=False, mutate=False, mutation_rate=MU, seed=None, cache_dir=None, use_cache=True):
+    '''
+    Load trees_file and return (B, CTmin, stats): the final traits of every individual (see final_traits)
+    and the statistics of its genomes (see diversity_statistics) after add_neutral_history.
+    Results are cached per file and per options, and recomputed only when the file's modification time or size changes.
+    '''
+    options = {'recapitate': recapitate, 'mutate': mutate, 'mutation_rate': mutation_rate, 'seed': seed}
+    path = _cache_file(trees_file, options, cache_dir)
+    stat = os.stat(trees_file)
+    if use_cache and os.path.exists(path):
+        with np.load(path) as cached:
+            meta = json.loads(str(cached['meta']))
+            if meta['mtime_ns'] == stat.st_mtime_ns and meta['size'] == stat.st_size:
+                return cached['B'], cached['CTmin'], meta['stats']
+
+    ts = tskit.load(trees_file)
+    B, CTmin = final_traits(ts)
+    stats = diversity_statistics(add_neutral_history(ts, recapitate, mutate, mutation_rate, seed))
+
+    if use_cache:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = {'source': os.path.abspath(trees_file), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size,
+                'options': options, 'stats': stats}
+        # write to a temporary file next to path, then rename it, so readers never see a partial file
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(descriptor, 'wb') as f:
+            np.savez(f, B=B, CTmin=CTmin, meta=np.array(json.dumps(meta)))
+        os.replace(temporary_path, path)
+    return B, CTmin, stats
+
+
+def analyze_runs(params, workers=1, **options):
+    '''
+    Analyze the tree sequence of every row of params (as in *_params.csv) that has one, in a pool of worker processes.
+    Returns (traits, stats): traits is one table with a row per individual (OUTNAME, seed, individual, B, CTmin),
+    stats a table with a row per run (OUTNAME, seed, and the statistics of diversity_statistics).
+    options are passed to analyze.
+    '''
+    rows = []
+    for _, row in params.iterrows():
+        trees_file = f"{row['OUTDIR']}/{row['OUTNAME']}.trees"
+        if os.path.exists(trees_file):
+            rows.append(row)
+        else:
+            print(f"  Trees file not found (simulation didn't complete): {trees_file}")
+    trees_files = [f"{row['OUTDIR']}/{row['OUTNAME']}.trees" for row in rows]
+    if workers <= 1:
+        results = [analyze(trees_file, **options) for trees_file in trees_files]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(analyze, trees_file, **options) for trees_file in trees_files]
+            results = [future.result() for future in futures]
+
+    traits = {'OUTNAME': [], 'seed': [], 'individual': [], 'B': [], 'CTmin': []}
+    stats = []
+    for row, (B, CTmin, run_stats) in zip(rows, results):
+        traits['OUTNAME'].append(np.full(len(B), row['OUTNAME'], dtype=object))
+        traits['seed'].append(np.full(len(B), row['seed']))
+        traits['individual'].append(np.arange(len(B)))
+        traits['B'].append(B)
+        traits['CTmin'].append(CTmin)
+        stats.append({'OUTNAME': row['OUTNAME'], 'seed': row['seed'], **run_stats})
+    if not stats:
+        return pd.DataFrame(columns=list(traits)), pd.DataFrame(columns=['OUTNAME', 'seed'])
+    traits = pd.DataFrame({column: np.concatenate(values) for column, values in traits.items()})
+    return traits, pd.DataFrame(stats)
+
+
+parser = argparse.ArgumentParser(description='Analyze the tree sequences of all simulations of a task')
+parser.add_argument('--task', type=str, required=True,
+                    choices=['gaussian', 'sine'],
+                    help='Type of simulation task')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of tree sequences loaded at once')
+parser.add_argument('--recapitate', action='store_true',
+                    help='Recapitate the tree sequences before computing statistics (needs pyslim)')
+parser.add_argument('--mutate', action='store_true',
+                    help='Overlay neutral mutations on the neutral flanks before computing statistics')
+parser.add_argument('--mutation-rate', type=float, default=MU,
+                    help='Rate of the neutral mutations overlaid with --mutate')
+parser.add_argument('--no-cache', action='store_true',
+                    help='Analyze every tree sequence again instead of reading cached results')
+parser.add_argument('--cache-dir', type=str, default=None,
+                    help='Directory of the cached results (default: .tree_cache next to each tree sequence)')
+parser.add_argument('--outdir', type=str, default=None,
+                    help='Where to save the tables (default: OUTDIR of the first simulation)')
+
+
+def main(args):
+    params = pd.read_csv(f"./01_prepare_input_parameters/{args.task}_params.csv")
+    print(f"Analyzing {len(params)} tree sequences of the {args.task} task")
+    traits, stats = analyze_runs(params, workers=args.workers, recapitate=args.recapitate, mutate=args.mutate,
+                                 mutation_rate=args.mutation_rate, cache_dir=args.cache_dir, use_cache=not args.no_cache)
+    print(f"  {len(stats)} tree sequences analyzed")
+
+    outdir = args.outdir if args.outdir is not None else params['OUTDIR'].iloc[0]
+    # one column per key, like the other *_df_*.npy files
+    np.save(f"{outdir}/traits_df_{args.task}.npy", {column: traits[column].to_numpy() for column in traits.columns})
+    stats.to_csv(f"{outdir}/tree_stats_{args.task}.csv", index=False)
+    print(f"  Saved: traits_df_{args.task}.npy and tree_stats_{args.task}.csv")
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())